@@ -0,0 +1,5 @@
+'''
+Reproducible benchmarks on a synthetic Goodreads-like corpus, no download needed.
+
+python -m bench.run --out base.json, then python -m bench.compare base.json new.json
+'''
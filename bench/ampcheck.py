@@ -0,0 +1,61 @@
+'''
+Throughput and metric parity of bf16 autocast against fp32 for a trained model.
+'''
+import argparse
+import os
+import time
+
+import numpy as np
+import torch
+
+from bench.rundata import RunData, add_args
+from inference import build_model
+from trainer import evaluate, make_optimizer, train_one_epoch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_args(parser, n_docs=2000)
+    args = parser.parse_args(argv)
+
+    run = RunData(args)
+    params, device = run.params, run.device
+    dl_train = run.dataloader('train', shuffle=True)
+    dl_dev = run.dataloader('dev')
+    state_dict = torch.load(os.path.join('model_', args.model_id + '.pt'), map_location=device)
+
+    results = {}
+    for name, amp_dtype in (('fp32', None), ('bf16', torch.bfloat16)):
+        model = build_model(params, run.char_vocab_size)
+        model.load_state_dict(state_dict)
+        model.to(device)
+        start_time = time.time()
+        scores, loss, f1, roc_auc = evaluate(model, dl_dev, run.criterion, params, device,
+                                             amp_dtype)
+        eval_docs_per_sec = len(run.datasets['dev']) / (time.time() - start_time)
+
+        optimizer = make_optimizer(model, 1e-3)
+        start_time = time.time()
+        train_one_epoch(0,
+                        model,
+                        dl_train,
+                        optimizer,
+                        run.criterion,
+                        params,
+                        device,
+                        log_interval=0,
+                        amp_dtype=amp_dtype)
+        train_docs_per_sec = len(run.datasets['train']) / (time.time() - start_time)
+
+        results[name] = scores.preds
+        print('| {} | train {:8.1f} docs/s | eval {:8.1f} docs/s | dev_loss {:.6f} '
+              '| dev_f1 {:.3f} | dev_roc_auc {:.4f} |'.format(name, train_docs_per_sec,
+                                                              eval_docs_per_sec, loss, f1,
+                                                              roc_auc))
+
+    print('max abs prob diff bf16 vs fp32: {:.6f}'.format(
+        np.max(np.abs(results['bf16'] - results['fp32']))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+'''
+Throughput and convergence of gradient accumulation over several effective batch sizes, using
+the architecture of an existing run.
+'''
+import argparse
+import time
+
+import torch
+
+from bench.rundata import RunData, add_args
+from inference import build_model
+from trainer import evaluate, make_optimizer, train_one_epoch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_args(parser)
+    parser.add_argument('--accum-steps', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--lr-scale', choices=['none', 'linear', 'sqrt'], default='sqrt')
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    run = RunData(args)
+    params, device = run.params, run.device
+    dl_train = run.dataloader('train', shuffle=True)
+    dl_dev = run.dataloader('dev')
+
+    for accum_steps in args.accum_steps:
+        torch.manual_seed(0)
+        model = build_model(params, run.char_vocab_size).to(device)
+        lr = 1e-3 * {'none': 1., 'linear': accum_steps, 'sqrt': accum_steps**0.5}[args.lr_scale]
+        optimizer = make_optimizer(model, lr)
+
+        train_time = 0
+        dev_roc_aucs = []
+        for epoch in range(args.epochs):
+            start_time = time.time()
+            train_one_epoch(epoch,
+                            model,
+                            dl_train,
+                            optimizer,
+                            run.criterion,
+                            params,
+                            device,
+                            log_interval=0,
+                            accum_steps=accum_steps)
+            train_time += time.time() - start_time
+            dev_roc_aucs.append(evaluate(model, dl_dev, run.criterion, params, device)[3])
+
+        print('| effective_batch_size {:4d} | lr {:.2e} | train {:8.1f} docs/s '
+              '| dev_roc_auc {} |'.format(args.batch_size * accum_steps, lr,
+                                          args.epochs * len(run.datasets['train']) / train_time,
+                                          ' '.join('{:.4f}'.format(roc_auc)
+                                                   for roc_auc in dev_roc_aucs)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''
+Compares two bench.run results stage by stage, exits with status 1 if any stage regressed.
+'''
+import argparse
+import json
+import sys
+
+# arguments that change the workload, results are not comparable if they differ
+WORKLOAD_ARGS = ('n_reviews', 'vocab_size', 'freq_ge', 'max_sent_len', 'max_doc_len', 'batch_size',
+                 'n_batches', 'device', 'seed')
+
+
+def load(fp):
+    with open(fp) as f:
+        return json.load(f)
+
+
+def compare(base, new, threshold=0.1):
+    '''
+    Returns (stage, base seconds, new seconds, new / base, flag) rows, flag is 'REGRESSION' or
+    'improved' when the ratio is off by more than threshold.
+    '''
+    rows = []
+    for stage, base_result in base['stages'].items():
+        if stage not in new['stages']:
+            continue
+        base_s, new_s = base_result['seconds'], new['stages'][stage]['seconds']
+        ratio = new_s / base_s if base_s else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = 'REGRESSION'
+        elif ratio < 1 - threshold:
+            flag = 'improved'
+        rows.append((stage, base_s, new_s, ratio, flag))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('base')
+    parser.add_argument('new')
+    parser.add_argument('--threshold',
+                        type=float,
+                        default=0.1,
+                        help='relative slowdown flagged as a regression')
+    args = parser.parse_args(argv)
+
+    base, new = load(args.base), load(args.new)
+    base_args, new_args = base['meta']['args'], new['meta']['args']
+    for key in WORKLOAD_ARGS:
+        if base_args.get(key) != new_args.get(key):
+            print('warning: {} differs ({} vs {}), workloads are not the same'.format(
+                key, base_args.get(key), new_args.get(key)))
+    for key in ('platform', 'cpu_count', 'torch_threads', 'torch'):
+        if base['meta'].get(key) != new['meta'].get(key):
+            print('warning: {} differs ({} vs {})'.format(key, base['meta'].get(key),
+                                                          new['meta'].get(key)))
+
+    rows = compare(base, new, args.threshold)
+    print('| {:16s} | {:>10s} | {:>10s} | {:>7s} | {:10s} |'.format('stage', 'base', 'new',
+                                                                    'ratio', ''))
+    for stage, base_s, new_s, ratio, flag in rows:
+        print('| {:16s} | {:9.3f}s | {:9.3f}s | {:6.2f}x | {:10s} |'.format(
+            stage, base_s, new_s, ratio, flag))
+
+    if any(flag == 'REGRESSION' for *_, flag in rows):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+'''
+Gradient accumulation under DistributedDataParallel, against a single process.
+
+--world-size gloo processes train the train.py model on their DistributedSampler shards of a
+synthetic corpus, accumulating --accum-steps batches per optimizer step. A window of all
+ranks covers the same documents as one window of world_size * accum_steps batches in a single
+process, so both runs must end with the same parameters. Dropout is off and the optimizer
+is SGD for that. Any parameter that differs fails the run.
+'''
+import argparse
+import os
+import sys
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from bench import synth
+from dataloading import make_dataloader
+from model import SpoilerNet
+from trainer import train_one_epoch, unwrap, wrap_ddp
+
+PARAMS = {'use_idf': True, 'use_char': True}
+
+
+def make_model(vocab_size, char_vocab_size):
+    torch.manual_seed(0)
+    return SpoilerNet(cell_dim=16,
+                      att_dim=8,
+                      vocab_size=vocab_size,
+                      emb_size=16,
+                      attent_type='coAtt',
+                      use_idf=True,
+                      char_emb_size=8,
+                      char_cell_dim=4,
+                      use_char=True,
+                      char_vocab_size=char_vocab_size,
+                      dropout_rate=0.)
+
+
+def train(model, ds, args, accum_steps, sampler=None):
+    dl = make_dataloader(ds, args.batch_size, sampler=sampler)
+    # Adam would blow float differences of near-zero gradients up to full steps
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.1)
+    for epoch in range(args.epochs):
+        train_one_epoch(epoch,
+                        model,
+                        dl,
+                        optimizer,
+                        torch.nn.BCEWithLogitsLoss(reduction='none'),
+                        PARAMS,
+                        'cpu',
+                        log_interval=0,
+                        n_prefetch=0,
+                        accum_steps=accum_steps)
+    return unwrap(model).state_dict()
+
+
+def worker(rank, args, data, init_file, out_file):
+    torch.set_num_threads(1)
+    dist.init_process_group('gloo',
+                            init_method='file://' + init_file,
+                            rank=rank,
+                            world_size=args.world_size)
+    ds, vocab_size, char_vocab_size = data
+    sampler = torch.utils.data.distributed.DistributedSampler(ds, shuffle=False)
+    state = train(wrap_ddp(make_model(vocab_size, char_vocab_size)), ds, args, args.accum_steps,
+                  sampler)
+    if rank == 0:
+        torch.save(state, out_file)
+    dist.destroy_process_group()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--world-size', type=int, default=2)
+    parser.add_argument('--accum-steps', type=int, default=2)
+    parser.add_argument('--n-reviews', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--atol', type=float, default=1e-5)
+    args = parser.parse_args(argv)
+
+    torch.set_num_threads(1)
+    # built once, the vocabulary order depends on the string hash seed of the process
+    ds, vocab_size, char_vocab_size = data = synth.make_dataset(args.n_reviews)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        out_file = os.path.join(tmp_dir, 'ddp.pt')
+        mp.spawn(worker,
+                 (args, data, os.path.join(tmp_dir, 'init'), out_file),
+                 nprocs=args.world_size,
+                 join=True)
+        ddp_state = torch.load(out_file)
+
+    # the sampler pads the shards to equal length, so the single process may see fewer docs
+    n_docs = len(ds) // args.world_size * args.world_size
+    ref_state = train(make_model(vocab_size, char_vocab_size),
+                      torch.utils.data.Subset(ds, range(n_docs)), args,
+                      args.world_size * args.accum_steps)
+
+    n_diff = 0
+    for name, ref in ref_state.items():
+        diff = (ddp_state[name].float() - ref.float()).abs().max().item() if ref.numel() else 0.
+        if diff > args.atol:
+            n_diff += 1
+            print('MISMATCH {} max abs diff {:.2e}'.format(name, diff))
+    print('world_size {} | accum_steps {} | {} of {} tensors differ'.format(
+        args.world_size, args.accum_steps, n_diff, len(ref_state)))
+    if n_diff:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+'''
+Scoring throughput against test ROC-AUC of students distilled from a trained teacher run, over
+GRU sizes, word encoders and with or without char features. train.py --distill-from trains the
+chosen student on the full data.
+'''
+import argparse
+import itertools
+import time
+
+import torch
+
+from bench.rundata import RunData, add_args
+from inference import build_model, load_model
+from trainer import evaluate, make_optimizer, train_one_epoch
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_args(parser)
+    parser.add_argument('--cell-dims', type=int, nargs='+', default=[64, 32, 16])
+    parser.add_argument('--word-encoders',
+                        nargs='+',
+                        choices=['gru', 'conv'],
+                        default=['gru', 'conv'])
+    parser.add_argument('--with-char',
+                        action='store_true',
+                        help='also students with char features')
+    parser.add_argument('--distill-alpha', type=float, default=0.5)
+    parser.add_argument('--distill-temp', type=float, default=2.)
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    run = RunData(args)
+    device = run.device
+    teacher, teacher_params = load_model(args.model_id,
+                                         run.char_vocab_size,
+                                         device=device,
+                                         paramstore=run.paramstore)
+    dl_train = run.dataloader('train', shuffle=True)
+    dl_test = run.dataloader('test')
+
+    def report(name, model, params):
+        n_params = sum(p.numel() for p in model.parameters()) / 1e6
+        start_time = time.time()
+        _, _, _, test_roc_auc = evaluate(model, dl_test, run.criterion, params, device)
+        print('| {:12s} | {:6.2f}M params | score {:8.1f} docs/s | test_roc_auc {:.4f} |'.format(
+            name, n_params, len(run.datasets['test']) / (time.time() - start_time),
+            test_roc_auc))
+
+    report('teacher', teacher, teacher_params)
+
+    char_options = [False, True] if args.with_char else [False]
+    for cell_dim, word_encoder, use_char in itertools.product(args.cell_dims, args.word_encoders,
+                                                              char_options):
+        torch.manual_seed(0)
+        params = dict(teacher_params,
+                      cell_dim=cell_dim,
+                      word_encoder=word_encoder,
+                      use_char=use_char)
+        model = build_model(params, run.char_vocab_size).to(device)
+        optimizer = make_optimizer(model, 1e-3)
+        for epoch in range(args.epochs):
+            train_one_epoch(epoch,
+                            model,
+                            dl_train,
+                            optimizer,
+                            run.criterion,
+                            params,
+                            device,
+                            log_interval=0,
+                            teacher=teacher,
+                            teacher_params=teacher_params,
+                            distill_alpha=args.distill_alpha,
+                            distill_temp=args.distill_temp)
+        report('{} {}{}'.format(word_encoder, cell_dim, ' char' if use_char else ''), model,
+               params)
+
+
+if __name__ == '__main__':
+    main()
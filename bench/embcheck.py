@@ -0,0 +1,97 @@
+'''
+Memory, step time and dev metrics of the embedding variants (dense, sparse gradients, frequency
+tiers) for the architecture of an existing run. Run it on an artifact prepared with dataprepgr
+n_hash_buckets for the effect of hashing the rare words.
+'''
+import argparse
+import statistics
+import time
+
+import numpy as np
+import torch
+
+from bench.rundata import RunData, add_args
+from inference import build_model
+from profiling import StageTimer
+from trainer import evaluate, make_optimizer, optimizer_state_mb, train_one_epoch
+
+
+def frequency_cutoffs(itow, wc, shares):
+    '''
+    First word ids past the given shares of corpus tokens, itow being ordered by frequency.
+    '''
+    counts = np.fromiter((wc.get(w, 0) for w in itow), dtype=np.float64, count=len(itow))
+    cum = np.cumsum(counts) / max(1, counts.sum())
+    cutoffs = np.searchsorted(cum, shares, side='right') + 1
+    return sorted(set(int(c) for c in cutoffs if 0 < c < len(itow)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_args(parser)
+    parser.add_argument('--token-shares',
+                        type=float,
+                        nargs='+',
+                        default=[0.9, 0.98],
+                        help='share of the corpus tokens covered by the tiers before each cutoff')
+    parser.add_argument('--emb-div', type=int, default=4)
+    parser.add_argument('--epochs', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    run = RunData(args)
+    data, device = run.data, run.device
+    dl_train = run.dataloader('train', shuffle=True)
+    dl_dev = run.dataloader('dev')
+
+    cutoffs = frequency_cutoffs(data['itow'], data['wc'], args.token_shares)
+    print('vocab_size {} | hash buckets {} | tier cutoffs {}'.format(
+        len(data['itow']), data.get('n_hash_buckets', 0), cutoffs))
+    params = dict(run.params, vocab_size=len(data['itow']))
+
+    variants = [
+        ('dense', {}),
+        ('sparse', {'sparse_emb': True}),
+        ('tiered', {'emb_cutoffs': cutoffs, 'emb_div': args.emb_div}),
+        ('tiered+sparse', {'emb_cutoffs': cutoffs, 'emb_div': args.emb_div, 'sparse_emb': True}),
+    ]
+
+    for name, variant in variants:
+        torch.manual_seed(0)
+        variant_params = {
+            k: v
+            for k, v in params.items() if k not in ('emb_cutoffs', 'emb_div', 'sparse_emb')
+        }
+        variant_params.update(variant)
+        model = build_model(variant_params, run.char_vocab_size).to(device)
+        model.timer = StageTimer(True, device)
+        optimizer = make_optimizer(model, 1e-3)
+        emb_mb = sum(p.numel() * p.element_size() for p in model.emb_layer.parameters()) / 2**20
+
+        records = []
+        train_time = 0
+        dev_roc_aucs = []
+        for epoch in range(args.epochs):
+            start_time = time.time()
+            train_one_epoch(epoch,
+                            model,
+                            dl_train,
+                            optimizer,
+                            run.criterion,
+                            variant_params,
+                            device,
+                            log_interval=0,
+                            step_log=records.append)
+            train_time += time.time() - start_time
+            dev_roc_aucs.append(evaluate(model, dl_dev, run.criterion, variant_params, device)[3])
+
+        print('| {:13s} | emb {:7.1f} MB | optimizer state {:7.1f} MB | step {:6.1f} ms '
+              '| optimizer {:6.2f} ms | train {:7.1f} docs/s | dev_roc_auc {} |'.format(
+                  name, emb_mb, optimizer_state_mb(optimizer),
+                  statistics.median(r['step_time'] for r in records) * 1000,
+                  statistics.median(r['optimizer'] for r in records) * 1000,
+                  args.epochs * len(run.datasets['train']) / train_time,
+                  ' '.join('{:.4f}'.format(roc_auc) for roc_auc in dev_roc_aucs)))
+
+
+if __name__ == '__main__':
+    main()
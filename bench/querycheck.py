@@ -0,0 +1,163 @@
+'''
+Results, query plans and latency of RunIndex queries over a synthetic index of many runs.
+
+Every query is compared with the same filter and sort done in Python over the run records, any
+difference fails the run. The statements of the selective queries (filters matching a few runs)
+must not SCAN a table of the index, their latency is reported at --n-runs runs and at a tenth
+of them, and should not grow with the number of runs.
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+from paramstore import RunIndex
+
+
+def make_run(i, rng):
+    params = {
+        'cell_dim': rng.choice([16, 32, 64, 128]),
+        'use_char': rng.random() < 0.5,
+        'word_encoder': 'gru' if rng.random() < 0.9 else 'conv',
+        'batch': i // 20,
+        'seed': i,
+    }
+    if rng.random() < 0.9:
+        params['metrics_'] = {'dev_roc_auc': rng.random()}
+    return params
+
+
+def sort_value(run, order_by):
+    return run.get('metrics_', {}).get(order_by, run.get(order_by))
+
+
+def reference(runs, where=None, order_by=None, descending=True, limit=None, model_name=None):
+    '''
+    The matching model_ids with order_by, sorted as RunIndex.query, and those without it.
+    '''
+    matches = [
+        model_id for model_id, run in runs.items()
+        if all(run.get(k) == v for k, v in (where or {}).items()) and (
+            model_name is None or model_id.rsplit('_', 1)[0] == model_name)
+    ]
+    if order_by is None:
+        return [], matches
+    ranked = sorted((model_id for model_id in matches
+                     if sort_value(runs[model_id], order_by) is not None),
+                    key=lambda model_id: sort_value(runs[model_id], order_by),
+                    reverse=descending)
+    return ranked, [
+        model_id for model_id in matches if sort_value(runs[model_id], order_by) is None
+    ]
+
+
+def check(index, runs, query):
+    '''
+    Returns a description of the difference between RunIndex.query and reference, None if equal.
+    Runs with equal values of order_by, and the runs without it, may come in any order.
+    '''
+    model_ids = index.query(**query)
+    ranked, unranked = reference(runs, **query)
+    n_expected = len(ranked) + len(unranked)
+    if query.get('limit') is not None:
+        n_expected = min(query['limit'], n_expected)
+    if len(model_ids) != n_expected:
+        return '{} model_ids, expected {}'.format(len(model_ids), n_expected)
+    n_ranked = min(len(ranked), n_expected)
+    if not set(model_ids[:n_ranked]) <= set(ranked) or not set(
+            model_ids[n_ranked:]) <= set(unranked):
+        return 'model_ids not matching the query'
+    order_by = query.get('order_by')
+    values = [sort_value(runs[model_id], order_by) for model_id in model_ids[:n_ranked]]
+    expected = [sort_value(runs[model_id], order_by) for model_id in ranked[:n_ranked]]
+    if values != expected:
+        return 'sorted by {}, expected {}'.format(values, expected)
+    return None
+
+
+def query_plans(index, query):
+    '''
+    EXPLAIN QUERY PLAN details of each statement the query runs.
+    '''
+    statements = []
+    index.conn.set_trace_callback(statements.append)
+    try:
+        index.query(**query)
+    finally:
+        index.conn.set_trace_callback(None)
+    return [(statement, [row[-1] for row in index.conn.execute('EXPLAIN QUERY PLAN ' + statement)])
+            for statement in statements]
+
+
+def timed(index, query, repeat=20):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        index.query(**query)
+    return (time.perf_counter() - start_time) / repeat
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-runs', type=int, default=200000)
+    args = parser.parse_args(argv)
+
+    # filters matching a few runs whatever the size of the index, with and without a sort
+    selective = [
+        {'where': {'seed': 7}},
+        {'where': {'batch': 7}},
+        {'where': {'batch': 7, 'use_char': True}},
+        {'where': {'batch': 7}, 'model_name': 'han'},
+        {'where': {'batch': 7}, 'order_by': 'dev_roc_auc', 'limit': 5},
+        {'where': {'batch': 7, 'word_encoder': 'conv'}, 'order_by': 'dev_roc_auc', 'limit': 50},
+        {'where': {'batch': 7}, 'order_by': 'cell_dim', 'descending': False},
+        {'where': {'seed': 7}, 'order_by': 'dev_roc_auc', 'limit': 5, 'model_name': 'han'},
+    ]
+    broad = [
+        {'order_by': 'dev_roc_auc', 'limit': 5},
+        {'order_by': 'dev_roc_auc', 'descending': False, 'limit': 5},
+        {'where': {'word_encoder': 'gru'}, 'order_by': 'dev_roc_auc', 'limit': 5},
+        {'where': {'use_char': True}, 'order_by': 'dev_roc_auc', 'limit': 5},
+        {'model_name': 'spoilernet', 'order_by': 'dev_roc_auc', 'limit': 5},
+        {'where': {'use_char': False}, 'limit': 5},
+    ]
+
+    rng = random.Random(0)
+    runs = {}
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        index = RunIndex(os.path.join(tmp_dir, 'index.sqlite'))
+        index.conn.execute('PRAGMA synchronous = OFF')
+        latencies = []
+        for n_runs in (args.n_runs // 10, args.n_runs):
+            with index.conn:
+                for i in range(len(runs), n_runs):
+                    model_id = '{}_{:08x}'.format('han' if i % 4 == 0 else 'spoilernet', i)
+                    runs[model_id] = make_run(i, rng)
+                    index.put(model_id, runs[model_id])
+            latencies.append([timed(index, query) for query in selective])
+
+        for query in selective + broad:
+            problem = check(index, runs, query)
+            if problem is not None:
+                print('{}: {}'.format(query, problem))
+                failed = True
+
+        for query in selective:
+            for statement, details in query_plans(index, query):
+                scans = [d for d in details if d.startswith('SCAN')]
+                if scans:
+                    print('{} scans {}: {}'.format(query, ', '.join(scans), statement))
+                    failed = True
+        index.close()
+
+    for query, small, large in zip(selective, *latencies):
+        print('| {:96s} | {:8.3f} ms at {} runs | {:8.3f} ms at {} runs |'.format(
+            str(query), small * 1000, args.n_runs // 10, large * 1000, args.n_runs))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+'''
+Resumed training against an uninterrupted run, with DataLoader worker processes.
+
+Each run is a fresh process, as with train.py --resume: one trains --epochs epochs, one stops
+after --stop-epoch epochs with a checkpoint of the model, optimizer and RNG state, and one
+resumes from it. The per-epoch losses and the final parameters of the resumed run must equal
+those of the uninterrupted one exactly, any difference fails the run.
+'''
+import argparse
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+import torch
+
+from bench import synth
+from checkpoint import get_rng_state, set_rng_state
+from dataloading import EpochRandomSampler, make_dataloader
+from model import SpoilerNet
+from trainer import train_one_epoch
+
+PARAMS = {'use_idf': True, 'use_char': True}
+
+
+def run(args):
+    '''
+    Trains epochs [start, stop) of a stage, from the checkpoint of the previous stage if any.
+    '''
+    torch.set_num_threads(1)
+    with open(os.path.join(args.tmp_dir, 'data.pkl'), 'rb') as f:
+        ds, vocab_size, char_vocab_size = pickle.load(f)
+    torch.manual_seed(0)
+    model = SpoilerNet(cell_dim=16,
+                       att_dim=8,
+                       vocab_size=vocab_size,
+                       emb_size=16,
+                       attent_type='coAtt',
+                       use_idf=True,
+                       char_emb_size=8,
+                       char_cell_dim=4,
+                       use_char=True,
+                       char_vocab_size=char_vocab_size)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    sampler = EpochRandomSampler(ds, seed=0)
+    dl = make_dataloader(ds,
+                         args.batch_size,
+                         shuffle=True,
+                         num_workers=args.num_workers,
+                         sampler=sampler)
+
+    start, stop = {'full': (0, args.epochs), 'first': (0, args.stop_epoch),
+                   'resume': (args.stop_epoch, args.epochs)}[args.stage]
+    ckpt_file = os.path.join(args.tmp_dir, 'ckpt.pt')
+    if args.stage == 'resume':
+        state = torch.load(ckpt_file, weights_only=False)
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        set_rng_state(state['rng'])
+
+    losses = []
+    for epoch in range(start, stop):
+        sampler.set_epoch(epoch)
+        losses.append(
+            train_one_epoch(epoch,
+                            model,
+                            dl,
+                            optimizer,
+                            torch.nn.BCEWithLogitsLoss(reduction='none'),
+                            PARAMS,
+                            'cpu',
+                            log_interval=0))
+
+    if args.stage == 'first':
+        torch.save(
+            {
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'rng': get_rng_state()
+            }, ckpt_file)
+    torch.save({'losses': losses, 'model': model.state_dict()},
+               os.path.join(args.tmp_dir, args.stage + '.pt'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--epochs', type=int, default=4)
+    parser.add_argument('--stop-epoch', type=int, default=2)
+    parser.add_argument('--num-workers', type=int, default=2)
+    parser.add_argument('--n-reviews', type=int, default=128)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--stage', choices=['full', 'first', 'resume'], help=argparse.SUPPRESS)
+    parser.add_argument('--tmp-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.stage:
+        run(args)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # built once, the vocabulary order depends on the string hash seed of the process
+        with open(os.path.join(tmp_dir, 'data.pkl'), 'wb') as f:
+            pickle.dump(synth.make_dataset(args.n_reviews), f)
+        for stage in ['full', 'first', 'resume']:
+            subprocess.run([sys.executable, '-m', 'bench.resumecheck', '--stage', stage] +
+                           ['--tmp-dir', tmp_dir, '--epochs', str(args.epochs)] +
+                           ['--stop-epoch', str(args.stop_epoch)] +
+                           ['--num-workers', str(args.num_workers)] +
+                           ['--batch-size', str(args.batch_size)],
+                           check=True)
+        full = torch.load(os.path.join(tmp_dir, 'full.pt'))
+        resumed = torch.load(os.path.join(tmp_dir, 'resume.pt'))
+
+    n_diff = sum(not torch.equal(full['model'][name], resumed['model'][name])
+                 for name in full['model'])
+    print('num_workers {} | epoch losses {} | resumed at epoch {} {} | {} of {} tensors differ'.
+          format(args.num_workers, ' '.join('{:.6f}'.format(loss) for loss in full['losses']),
+                 args.stop_epoch, ' '.join('{:.6f}'.format(loss) for loss in resumed['losses']),
+                 n_diff, len(full['model'])))
+    if n_diff or full['losses'][args.stop_epoch:] != resumed['losses']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+'''
+Times each stage of the pipeline on a synthetic corpus and saves the results as JSON.
+
+Preprocessing stages (tokenization, word counts, encoding, df-idf, dataset padding) run on the
+whole corpus, training and evaluation on the first --n-batches batches with the train.py model.
+'''
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+
+import numpy as np
+import torch
+
+import dataprepgr
+import textproc
+from bench import synth
+from dataloading import make_dataloader
+from dataset import GoodreadsReviewsSpoilerDataset
+from model import SpoilerNet
+from trainer import evaluate, train_one_epoch
+
+
+def timeit(fn, repeat):
+    '''
+    Returns the result of the last call and the wall time of each call.
+    '''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    return result, times
+
+
+def stage_result(times, n_items, unit):
+    seconds = statistics.median(times)
+    return {
+        'seconds': seconds,
+        'min_seconds': min(times),
+        'repeat': len(times),
+        'items': n_items,
+        'unit': unit,
+        'items_per_sec': n_items / seconds if seconds else None
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'],
+                              cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True,
+                              text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    results = {}
+
+    def record(name, times, n_items, unit):
+        results[name] = stage_result(times, n_items, unit)
+        print('| {:16s} | {:9.3f}s | {:12.1f} {}/s |'.format(name, results[name]['seconds'],
+                                                             results[name]['items_per_sec'],
+                                                             unit))
+
+    records, keywords = synth.generate(args.n_reviews, vocab_size=args.vocab_size, seed=args.seed)
+    sents = [sent for record in records for _, sent in record['review_sentences']]
+
+    def cold(fn):
+        # every repetition of a stage that tokenizes starts with an empty memo, repeated
+        # sentences within the corpus still hit it
+        def run_cold():
+            textproc._tokenizer.cache_clear()
+            return fn()
+
+        return run_cold
+
+    _, times = timeit(cold(lambda: [textproc.get_sent_words(sent) for sent in sents]), args.repeat)
+    record('get_sent_words', times, len(sents), 'sents')
+
+    (wc, wc_artwork, wc_doc), times = timeit(cold(lambda: dataprepgr.word_count(records)),
+                                             args.repeat)
+    record('word_count', times, len(records), 'reviews')
+
+    wtoi, itow = dataprepgr.get_word_dict(wc, None, args.freq_ge)
+    ctoi, _ = dataprepgr.get_char_dict(wc)
+
+    (doc_encode, doc_artwork, doc_key_encode, doc_char_encode), times = timeit(
+        cold(lambda: dataprepgr.process(records, wtoi, ctoi, keywords)), args.repeat)
+    record('process', times, len(records), 'reviews')
+
+    def df_idf():
+        atod, wtod, wtoa = dataprepgr.prepare_invmap(doc_artwork, wc_doc, wc_artwork)
+        return dataprepgr.process_df_idf(doc_encode, doc_artwork, itow, atod, wtod, wtoa, 0)
+
+    doc_df_idf, times = timeit(df_idf, args.repeat)
+    n_words = sum(len(words) for doc in doc_encode for _, words in doc)
+    record('process_df_idf', times, n_words, 'words')
+
+    ds, times = timeit(
+        lambda: GoodreadsReviewsSpoilerDataset(doc_encode, doc_df_idf, doc_key_encode, itow, args.
+                                               max_sent_len, args.max_doc_len, ctoi,
+                                               doc_char_encode), args.repeat)
+    record('dataset', times, len(records), 'reviews')
+
+    torch.manual_seed(args.seed)
+    params = {'use_idf': True, 'use_char': True}
+    model = SpoilerNet(cell_dim=128,
+                       att_dim=32,
+                       vocab_size=len(itow),
+                       emb_size=200,
+                       attent_type='coAtt',
+                       use_idf=True,
+                       char_emb_size=64,
+                       char_cell_dim=32,
+                       use_char=True,
+                       char_vocab_size=len(ctoi))
+    criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    device = torch.device(args.device)
+
+    subset = torch.utils.data.Subset(ds, range(min(len(ds), args.n_batches * args.batch_size)))
+    dl = make_dataloader(subset, args.batch_size, device=device)
+    n_sents = int(ds.doc_len_masks[subset.indices].sum())
+
+    def train():
+        return train_one_epoch(0,
+                               model,
+                               dl,
+                               optimizer,
+                               criterion,
+                               params,
+                               device,
+                               log_interval=0,
+                               n_prefetch=0)
+
+    # first epoch warms up allocator and kernels
+    train()
+    _, times = timeit(train, args.repeat)
+    record('train_step', times, n_sents, 'sents')
+
+    _, times = timeit(lambda: evaluate(model, dl, criterion, params, device, n_prefetch=0),
+                      args.repeat)
+    record('evaluate', times, n_sents, 'sents')
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--n-reviews', type=int, default=2000)
+    parser.add_argument('--vocab-size', type=int, default=50000)
+    parser.add_argument('--freq-ge', type=int, default=5)
+    parser.add_argument('--max-sent-len', type=int, default=15)
+    parser.add_argument('--max-doc-len', type=int, default=30)
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--n-batches', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, help='torch intra-op threads')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    stages = run(args)
+    out = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch_threads': torch.get_num_threads(),
+            'args': vars(args)
+        },
+        'stages': stages
+    }
+    with open(args.out, 'w') as f:
+        json.dump(out, f, indent=2)
+    print('Saved {}'.format(args.out))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+'''
+The data of an existing run for the checks in bench/: its params, subsets of the splits of its
+artifact and their dataloaders.
+'''
+import os
+import pickle
+
+import torch
+
+from dataloading import make_dataloader
+from dataset import split_datasets
+from paramstore import ParamStore
+
+DATA_FILE = os.path.join('data_/goodreads-reviews-spoiler', 'mappings_100000_all_ge5.pkl')
+
+
+def add_args(parser, n_docs=5000):
+    parser.add_argument('model_id')
+    parser.add_argument('--data-file', default=DATA_FILE)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--n-docs',
+                        type=int,
+                        default=n_docs,
+                        help='documents of each split used, from its start')
+    parser.add_argument('--batch-size', type=int, default=32)
+
+
+class RunData:
+    def __init__(self, args, paramstore=None):
+        self.paramstore = ParamStore() if paramstore is None else paramstore
+        self.params = self.paramstore[args.model_id]
+        if self.params is None:
+            raise KeyError('Unknown model {}'.format(args.model_id))
+        self.device = torch.device(args.device)
+        self.batch_size = args.batch_size
+        with open(args.data_file, 'rb') as f:
+            self.data = pickle.load(f)
+        self.char_vocab_size = len(self.data['ctoi'])
+        splits = split_datasets(self.data, self.params['max_sent_len'],
+                                self.params['max_doc_len'], 0.7, 0.1)
+        self.datasets = {
+            name: torch.utils.data.Subset(ds, range(min(args.n_docs, len(ds))))
+            for name, ds in zip(('train', 'dev', 'test'), splits)
+        }
+        self.criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
+
+    def dataloader(self, split, shuffle=False):
+        return make_dataloader(self.datasets[split],
+                               self.batch_size,
+                               shuffle=shuffle,
+                               device=self.device)
@@ -0,0 +1,145 @@
+'''
+Synthetic corpus in the goodreads_reviews_spoiler.json.gz record format, with book keywords
+in the data_/book_id_keywords.json format.
+
+The distributions follow the published statistics of the Goodreads spoiler corpus: log-normal
+review and sentence lengths, a Zipf word distribution over a vocabulary whose head is made of
+common English words, Zipf book popularity, and spoilers in about 7% of the reviews, as one
+contiguous block of sentences each.
+'''
+import gzip
+import json
+import string
+
+import numpy as np
+
+import dataprepgr
+from dataset import GoodreadsReviewsSpoilerDataset
+
+# head of the English word frequency curve, so that stopword removal drops a realistic share
+COMMON_WORDS = [
+    'the', 'and', 'i', 'to', 'a', 'of', 'it', 'is', 'was', 'this', 'that', 'in', 'but', 'book',
+    'her', 'for', 'she', 'with', 'not', 'story', 'he', 'so', 'read', 'you', 'as', 'be', 'on',
+    'me', 'my', 'his', 'have', 'really', 'one', 'all', 'just', 'characters', 'at', 'love',
+    'what', 'they', 'series', 'like', 'about', 'there', 'were', 'more', 'an', 'which', 'end'
+]
+
+
+def make_vocab(vocab_size, rng):
+    '''
+    COMMON_WORDS followed by random lowercase words of log-normal length.
+    '''
+    vocab = list(COMMON_WORDS)
+    seen = set(vocab)
+    letters = np.array(list(string.ascii_lowercase))
+    while len(vocab) < vocab_size:
+        n = int(np.clip(rng.lognormal(1.8, 0.35), 2, 18))
+        word = ''.join(rng.choice(letters, n))
+        if word not in seen:
+            seen.add(word)
+            vocab.append(word)
+    return vocab
+
+
+def zipf_probs(n, s):
+    probs = 1. / np.arange(1, n + 1)**s
+    return probs / probs.sum()
+
+
+def _sentence(words, rng):
+    # punctuation, digits and links for the tokenizer to deal with
+    words = list(words)
+    if rng.random() < 0.2:
+        words[rng.integers(len(words))] += ','
+    if rng.random() < 0.05:
+        words[rng.integers(len(words))] = str(rng.integers(1, 2000))
+    if rng.random() < 0.005:
+        words.append('https://www.goodreads.com/book/show/{}'.format(rng.integers(1e6)))
+    if rng.random() < 0.05:
+        words[rng.integers(len(words))] += '-' + words[rng.integers(len(words))]
+    words[0] = words[0].capitalize()
+    return ' '.join(words) + str(rng.choice(['.', '.', '.', '!', '?']))
+
+
+def generate(n_reviews,
+             n_books=None,
+             vocab_size=50000,
+             word_zipf=1.07,
+             book_zipf=1.2,
+             spoiler_review_rate=0.07,
+             n_keywords=8,
+             seed=0):
+    '''
+    Returns the review records and the book keywords.
+    '''
+    rng = np.random.default_rng(seed)
+    n_books = n_books or max(1, n_reviews // 50)
+    vocab = np.array(make_vocab(vocab_size, rng))
+    word_probs = zipf_probs(vocab_size, word_zipf)
+    book_ids = [str(1000 + i) for i in range(n_books)]
+    book_probs = zipf_probs(n_books, book_zipf)
+
+    keywords = {}
+    for book_id in book_ids:
+        keywords[book_id] = [
+            ' '.join(rng.choice(vocab[len(COMMON_WORDS):], rng.integers(1, 4)))
+            for _ in range(n_keywords)
+        ]
+
+    # sample all words at once, sentences are slices of this stream
+    n_sents = np.clip(rng.lognormal(2.3, 0.8, n_reviews).astype(np.int64), 1, 300)
+    sent_lens = np.clip(rng.lognormal(2.4, 0.6, n_sents.sum()).astype(np.int64), 1, 120)
+    words = vocab[rng.choice(vocab_size, sent_lens.sum(), p=word_probs)]
+    ends = np.cumsum(sent_lens)
+
+    records = []
+    sent_idx = 0
+    for i in range(n_reviews):
+        n = n_sents[i]
+        labels = np.zeros(n, dtype=np.int64)
+        if rng.random() < spoiler_review_rate:
+            start = rng.integers(n)
+            labels[start:start + 1 + rng.geometric(0.4)] = 1
+
+        review_sentences = []
+        for j in range(n):
+            k = sent_idx + j
+            sent = _sentence(words[ends[k] - sent_lens[k]:ends[k]], rng)
+            review_sentences.append([int(labels[j]), sent])
+        sent_idx += n
+
+        records.append({
+            'user_id': 'u{}'.format(rng.integers(n_reviews)),
+            'book_id': book_ids[rng.choice(n_books, p=book_probs)],
+            'review_id': 'r{}'.format(i),
+            'rating': int(rng.integers(0, 6)),
+            'has_spoiler': bool(labels.any()),
+            'review_sentences': review_sentences
+        })
+    return records, keywords
+
+
+def write(records, keywords, reviews_fp, keywords_fp):
+    with gzip.open(reviews_fp, 'wt') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+    with open(keywords_fp, 'w') as f:
+        json.dump(keywords, f)
+
+
+def make_dataset(n_reviews, max_sent_len=15, max_doc_len=30, vocab_size=5000, freq_ge=1, seed=0):
+    '''
+    GoodreadsReviewsSpoilerDataset of a synthetic corpus, through the dataprepgr steps. Returns
+    the dataset, the vocabulary size and the char vocabulary size.
+    '''
+    records, keywords = generate(n_reviews, vocab_size=vocab_size, seed=seed)
+    wc, wc_artwork, wc_doc = dataprepgr.word_count(records)
+    wtoi, itow = dataprepgr.get_word_dict(wc, None, freq_ge)
+    ctoi, _ = dataprepgr.get_char_dict(wc)
+    doc_encode, doc_artwork, doc_key_encode, doc_char_encode = dataprepgr.process(
+        records, wtoi, ctoi, keywords)
+    atod, wtod, wtoa = dataprepgr.prepare_invmap(doc_artwork, wc_doc, wc_artwork)
+    doc_df_idf = dataprepgr.process_df_idf(doc_encode, doc_artwork, itow, atod, wtod, wtoa, 0)
+    ds = GoodreadsReviewsSpoilerDataset(doc_encode, doc_df_idf, doc_key_encode, itow, max_sent_len,
+                                        max_doc_len, ctoi, doc_char_encode)
+    return ds, len(itow), len(ctoi)
@@ -0,0 +1,110 @@
+'''
+Conformance check and throughput of the textproc tokenizer.
+
+Every sentence of the sample is tokenized with get_sent_words_reference and with the Tokenizer
+behind get_sent_words, any difference is printed and fails the run. The sample is the synthetic
+corpus plus EDGE_CASES, or the first --n-reviews reviews of the Goodreads dump with --reviews.
+Throughput is reported in sentences/sec for the reference, the Tokenizer without its memo, and
+the Tokenizer with its memo over the corpus as it comes (repeated sentences hit the memo).
+'''
+import argparse
+import gzip
+import itertools
+import json
+import sys
+import time
+
+from bench import synth
+from textproc import Tokenizer, get_sent_words_reference, is_single_sentence, normalize
+
+# sentence boundaries inside the text, contractions and possessives next to them, abbreviations,
+# quotes, brackets, links, digits and hyphens
+EDGE_CASES = [
+    "I don't know. He can't stop!",
+    "John's book. Mary's too.",
+    "It wasn't. Or was it?",
+    "Loved it!!! Can't wait for the sequel...",
+    "Mr. Smith's dog didn't bark.",
+    "e.g. the ending, i.e. the twist.",
+    '"Wow." she said.',
+    'She said "wow!"',
+    '(Really?) Yes.',
+    'What?! No way!?',
+    'The 2nd book was better than the 1st one.',
+    'See https://www.goodreads.com/book/show/123. It is great.',
+    'A well-known, so-called "twist"... meh.',
+    "Harry's wand -- and Ron's -- broke.",
+    'U.S. edition vs. U.K. edition.',
+    'Chapter 12.5 was weird.',
+    "They're gonna wanna read it, aren't they?",
+    "It ends.'",
+    'Three dots... then more.',
+    'no punctuation at all',
+    '',
+    '   ',
+]
+
+
+def dump_sents(fp, n_reviews):
+    with gzip.open(fp) as f:
+        for line in itertools.islice(f, n_reviews):
+            for _, sent in json.loads(line)['review_sentences']:
+                yield sent
+
+
+def check(sents, tokenizer):
+    '''
+    Returns the (sentence, reference, fast) triples that differ.
+    '''
+    mismatches = []
+    for sent in sents:
+        expected = get_sent_words_reference(sent)
+        actual = tokenizer(sent)
+        if actual != expected:
+            mismatches.append((sent, expected, actual))
+    return mismatches
+
+
+def throughput(fn, sents):
+    start = time.perf_counter()
+    for sent in sents:
+        fn(sent)
+    seconds = time.perf_counter() - start
+    return len(sents) / seconds if seconds else float('inf')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--reviews', help='goodreads_reviews_spoiler.json.gz instead of synth')
+    parser.add_argument('--n-reviews', type=int, default=2000)
+    parser.add_argument('--cache-size', type=int, default=1 << 16)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.reviews:
+        sents = list(dump_sents(args.reviews, args.n_reviews))
+    else:
+        records, _ = synth.generate(args.n_reviews, seed=args.seed)
+        sents = [sent for record in records for _, sent in record['review_sentences']]
+        sents += EDGE_CASES
+
+    mismatches = check(sents, Tokenizer(cache_size=0))
+    for sent, expected, actual in mismatches[:20]:
+        print('{!r}\n  reference: {}\n  fast:      {}'.format(sent, expected, actual))
+    n_fast = sum(map(is_single_sentence, map(normalize, sents)))
+    print('{} sentences, {} mismatches, {:.1%} on the Treebank fast path'.format(
+        len(sents), len(mismatches), n_fast / len(sents)))
+
+    cached = Tokenizer(cache_size=args.cache_size)
+    for name, fn in (('reference', get_sent_words_reference),
+                     ('fast', Tokenizer(cache_size=0)),
+                     ('fast+memo', cached)):
+        print('| {:10s} | {:12.1f} sents/s |'.format(name, throughput(fn, sents)))
+    print(cached.cache_info())
+
+    if mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+'''
+Early-exit cascade: a linear bag-of-words model screens reviews before SpoilerNet.
+
+The first stage scores every sentence from a learned weight per word id (the get_sent_words
+tokens of the artifact) and the mean and max of its DF-IDF values. A review goes on to
+SpoilerNet only if its highest sentence score reaches a threshold tuned on the dev split to keep
+--target-recall of the spoiler sentences; the sentences of skipped reviews score 0. Reviews
+are gated whole since SpoilerNet reads every sentence of a review for context.
+
+    python cascade.py <model_id> --target-recall 0.95
+
+trains the first stage, reports the skipped traffic and the recall loss on the test split, and
+saves model_/<model_id>.cascade.pt for score.py --cascade.
+'''
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from dataloading import make_dataloader
+from dataset import split_datasets
+from evaluation import StreamingMetrics
+from inference import load_model
+from paramstore import ParamStore
+from profiling import StageTimer
+from trainer import evaluate, train_one_epoch
+
+SCORER_PARAMS = {'use_idf': True, 'use_char': False}
+
+
+class BagOfWordsScorer(nn.Module):
+    '''
+    Sentence logits from the sum of per-word weights and a linear map of DF-IDF mean and max.
+    Same call signature as SpoilerNet, to train and evaluate with trainer.
+    '''
+    def __init__(self, vocab_size):
+        super().__init__()
+        self.vocab_size = vocab_size
+        self.bag = nn.EmbeddingBag(vocab_size, 1, mode='sum', padding_idx=0)
+        nn.init.zeros_(self.bag.weight)
+        self.idf_linear = nn.Linear(2, 1)
+        self.timer = StageTimer(enabled=False)
+
+    def init_hidden(self, batch_size):
+        return torch.zeros(0)
+
+    def forward(self, x, word_h0, sent_h0, x_df_idf=None, chars=None, doc_ab=None, book_ids=None):
+        '''
+        x size: (batch, sent_seq_len, word_seq_len)
+        Output size: (batch * sent_seq_len)
+        '''
+        words = x.reshape(-1, x.size(-1))
+        df_idf = x_df_idf.reshape(-1, x.size(-1)).float()
+        mask = words != 0
+        n_words = mask.sum(1).clamp(min=1)
+        df_idf_mean = (df_idf * mask).sum(1) / n_words
+        df_idf_max = df_idf.masked_fill(~mask, float('-inf')).max(1)[0]
+        df_idf_max = torch.where(mask.any(1), df_idf_max, torch.zeros_like(df_idf_max))
+        logits = self.bag(words).squeeze(1) + self.idf_linear(
+            torch.stack((df_idf_mean, df_idf_max), 1)).squeeze(1)
+        return logits, word_h0, sent_h0
+
+
+def cascade_file(model_id, model_dir='model_'):
+    return os.path.join(model_dir, model_id + '.cascade.pt')
+
+
+def per_doc(scores, n_slots):
+    '''
+    Highest sentence prediction and number of positive sentences of each doc, from the
+    StreamingMetrics of a sequential pass with n_slots sentence slots per doc.
+    '''
+    masks = scores.masks.astype(bool)
+    preds = np.full(len(masks), -np.inf, dtype=np.float32)
+    labels = np.zeros(len(masks), dtype=np.int64)
+    preds[masks] = scores.preds
+    labels[masks] = scores.labels
+    return preds.reshape(-1, n_slots).max(1), labels.reshape(-1, n_slots).sum(1)
+
+
+def tune_threshold(doc_max, doc_pos, target_recall):
+    '''
+    Highest threshold on doc_max whose passing docs hold target_recall of the positives.
+    '''
+    order = np.argsort(-doc_max, kind='stable')
+    kept = np.cumsum(doc_pos[order]) / max(1, doc_pos.sum())
+    k = min(np.searchsorted(kept, target_recall - 1e-9), len(kept) - 1)
+    return doc_max[order][k].item()
+
+
+class Cascade:
+    '''
+    First stage of score.py: gate() picks the docs of a batch that go on to SpoilerNet.
+    '''
+    def __init__(self, scorer, threshold):
+        self.scorer = scorer.eval()
+        self.threshold = threshold
+        self.n_docs = 0
+        self.n_passed = 0
+
+    @classmethod
+    def load(cls, fp, device='cpu'):
+        state = torch.load(fp, map_location=device)
+        scorer = BagOfWordsScorer(state['vocab_size'])
+        scorer.load_state_dict(state['model'])
+        return cls(scorer.to(device), state['threshold'])
+
+    def gate(self, elems, x_df_idf):
+        '''
+        Boolean numpy mask of the docs whose highest sentence probability reaches threshold.
+        '''
+        with torch.no_grad():
+            logits, _, _ = self.scorer(elems, None, None, x_df_idf=x_df_idf)
+        probs = torch.sigmoid(logits).view(len(elems), -1)
+        # empty sentence slots are all padding
+        probs = probs.masked_fill((elems == 0).all(2), 0)
+        passed = (probs.max(1)[0] >= self.threshold).cpu().numpy()
+        self.n_docs += len(passed)
+        self.n_passed += passed.sum().item()
+        return passed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('model_id')
+    parser.add_argument('--data-file', help='defaults to the one the model was trained on')
+    parser.add_argument('--target-recall', type=float, default=0.95)
+    parser.add_argument('--epochs', type=int, default=5)
+    parser.add_argument('--lr', type=float, default=1e-2)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--device', default='cpu')
+    args = parser.parse_args(argv)
+
+    device = torch.device(args.device)
+    paramstore = ParamStore()
+    params = paramstore[args.model_id]
+    with open(args.data_file or params['data_file'], 'rb') as f:
+        data = pickle.load(f)
+    ds_train, ds_dev, ds_test = split_datasets(data, params['max_sent_len'],
+                                               params['max_doc_len'], 0.7, 0.1)
+    dl_train = make_dataloader(ds_train, args.batch_size, shuffle=True, device=device)
+    dl_dev = make_dataloader(ds_dev, args.batch_size, device=device)
+    dl_test = make_dataloader(ds_test, args.batch_size, device=device)
+    criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
+    n_slots = params['max_doc_len']
+
+    # first stage, the epoch with the best dev ROC-AUC is kept
+    torch.manual_seed(0)
+    scorer = BagOfWordsScorer(len(data['itow']))
+    optimizer = torch.optim.Adam(scorer.parameters(), lr=args.lr)
+    best_roc_auc, best_state = -1, None
+    for epoch in range(args.epochs):
+        train_one_epoch(epoch,
+                        scorer,
+                        dl_train,
+                        optimizer,
+                        criterion,
+                        SCORER_PARAMS,
+                        device,
+                        log_interval=0)
+        _, _, _, dev_roc_auc = evaluate(scorer, dl_dev, criterion, SCORER_PARAMS, device)
+        print('| epoch {} | first stage dev_roc_auc {:.4f} |'.format(epoch, dev_roc_auc))
+        if dev_roc_auc > best_roc_auc:
+            best_roc_auc = dev_roc_auc
+            best_state = {k: v.clone() for k, v in scorer.state_dict().items()}
+    scorer.load_state_dict(best_state)
+
+    dev_scores, _, _, _ = evaluate(scorer, dl_dev, criterion, SCORER_PARAMS, device)
+    threshold = tune_threshold(*per_doc(dev_scores, n_slots), args.target_recall)
+
+    # test: SpoilerNet on every doc against the cascade
+    model, _ = load_model(args.model_id, len(data['ctoi']), device=device, paramstore=paramstore)
+    th = (params.get(paramstore.metrics_key) or {}).get('best_th', 0.05)
+
+    start_time = time.time()
+    full_scores, _, _, _ = evaluate(model, dl_test, criterion, params, device)
+    full_time = time.time() - start_time
+
+    start_time = time.time()
+    first_scores, _, _, _ = evaluate(scorer, dl_test, criterion, SCORER_PARAMS, device)
+    doc_max, doc_pos = per_doc(first_scores, n_slots)
+    passed = np.flatnonzero(doc_max >= threshold)
+    passed_preds = np.zeros(0, dtype=np.float32)
+    if len(passed):
+        passed_preds = evaluate(model,
+                                make_dataloader(torch.utils.data.Subset(ds_test, passed),
+                                                args.batch_size,
+                                                device=device), criterion, params, device)[0].preds
+    cascade_time = time.time() - start_time
+
+    # sentences of skipped docs score 0, all of them if no doc passed
+    masks = full_scores.masks.astype(bool).reshape(-1, n_slots)
+    slot_labels = np.zeros(masks.shape, dtype=np.uint8)
+    slot_labels[masks] = full_scores.labels
+    passed_masks = np.zeros(masks.shape, dtype=bool)
+    passed_masks[passed] = masks[passed]
+    slot_preds = np.zeros(masks.shape, dtype=np.float32)
+    slot_preds[passed_masks] = passed_preds
+    cascade_scores = StreamingMetrics()
+    cascade_scores.update(slot_preds, slot_labels, masks)
+
+    n_docs, n_sents = len(masks), masks.sum()
+    rows = [('spoilernet', full_scores, full_time), ('cascade', cascade_scores, cascade_time)]
+    print('threshold {:.4f} at target recall {} | skipped {:.1%} of docs, {:.1%} of sentences | '
+          'first stage recall {:.4f}'.format(threshold, args.target_recall,
+                                             1 - len(passed) / n_docs,
+                                             1 - masks[passed].sum() / n_sents,
+                                             doc_pos[passed].sum() / max(1, doc_pos.sum())))
+    for name, scores, seconds in rows:
+        _, recall, f1 = scores.threshold_sweep([th])
+        print('| {:10s} | {:8.1f} docs/s | recall@{:.2f} {:.4f} | f1@{:.2f} {:.4f} '
+              '| roc_auc {:.4f} |'.format(name, n_docs / seconds, th, recall[0], th, f1[0],
+                                          scores.roc_auc()))
+
+    torch.save(
+        {
+            'model': scorer.state_dict(),
+            'vocab_size': scorer.vocab_size,
+            'threshold': threshold,
+            'target_recall': args.target_recall
+        }, cascade_file(args.model_id))
+    print('Saved {}'.format(cascade_file(args.model_id)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import glob
+import os
+import queue
+import random
+import threading
+
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    '''
+    Deep copy of a (nested) state with every tensor cloned to CPU, safe to write while
+    training keeps updating the originals.
+    '''
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def checkpoint_dir(model_id, root_dir='ckpt_'):
+    return os.path.join(root_dir, model_id)
+
+
+def list_checkpoints(ckpt_dir):
+    return sorted(glob.glob(os.path.join(ckpt_dir, 'epoch_*.pt')))
+
+
+def latest_checkpoint(ckpt_dir):
+    ckpts = list_checkpoints(ckpt_dir)
+    return ckpts[-1] if ckpts else None
+
+
+def resolve_checkpoint(resume, root_dir='ckpt_'):
+    '''
+    resume is either a checkpoint file or a model id, for its latest checkpoint.
+    '''
+    if os.path.isfile(resume):
+        return resume
+    ckpt = latest_checkpoint(checkpoint_dir(resume, root_dir))
+    if ckpt is None:
+        raise FileNotFoundError('No checkpoint found for {}'.format(resume))
+    return ckpt
+
+
+class AsyncCheckpointer:
+    '''
+    Writes snapshots with torch.save from a background thread, keeping the keep_last most
+    recent epoch checkpoints. At most one write is pending, a further save waits for it.
+    '''
+    def __init__(self, ckpt_dir, keep_last=3):
+        self.ckpt_dir = ckpt_dir
+        self.keep_last = keep_last
+        self._queue = queue.Queue(1)
+        self._error = None
+
+        if not os.path.exists(ckpt_dir):
+            os.makedirs(ckpt_dir)
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, fp, retain = item
+            try:
+                tmp_fp = fp + '.tmp'
+                torch.save(state, tmp_fp)
+                os.replace(tmp_fp, fp)
+                if retain:
+                    self._apply_retention()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _apply_retention(self):
+        if not self.keep_last:
+            return
+        for fp in list_checkpoints(self.ckpt_dir)[:-self.keep_last]:
+            os.remove(fp)
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def save_file(self, state, fp, retain=False):
+        self._check()
+        self._queue.put((snapshot(state), fp, retain))
+
+    def save(self, state, epoch):
+        self.save_file(state, os.path.join(self.ckpt_dir, 'epoch_{:04d}.pt'.format(epoch)), True)
+
+    def wait(self):
+        self._queue.join()
+        self._check()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._check()
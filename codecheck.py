@@ -1,35 +1,311 @@
-# %%
-import collections
+'''
+Integrity checks of preprocessing artifacts (the mappings_*.pkl files of dataprepgr.py).
+
+The nested per-document lists are flattened once into value arrays and length arrays, and
+every check is an array comparison: documents, sentences and words line up across labels,
+tokens, DF-IDF, chars and keys, ids are in the range of itow/ctoi, labels are 0/1 and DF-IDF
+values are finite. A validated artifact gets a checksum file next to it, that train.py
+compares against before training, and its flat arrays saved as .npy files for the tools that
+read the corpus without unpickling it. The per-array content checksums check an artifact that
+was pickled again, and the flat arrays when they are loaded with verify.
+'''
+import argparse
+import hashlib
+import itertools
+import json
 import os
 import pickle
-from typing import Sequence
+import shutil
+import sys
+
+import numpy as np
+
+UNK_IDX = 1
+
+
+def _lens(seqs):
+    return np.fromiter(map(len, seqs), dtype=np.int64)
+
 
-# %%
-data_dir = 'data_/goodreads-reviews-spoiler'
-data_file = os.path.join(data_dir, 'mappings_20000_all.pkl')
+def _flat(seqs, dtype):
+    return np.fromiter(itertools.chain.from_iterable(seqs), dtype=dtype)
 
-with open(data_file, 'rb') as f:
-    data = pickle.load(f)
 
-# %%
-# df-idf
-doc_label_sents = data['doc_label_sents']
-doc_df_idf = data['doc_df_idf']
+def flatten(data):
+    '''
+    Flat arrays of an artifact, the *_n_* arrays hold the number of items of each parent.
+    '''
+    doc_label_sents = data['doc_label_sents']
+    label_sents = list(itertools.chain.from_iterable(doc_label_sents))
+    df_idf_sents = list(itertools.chain.from_iterable(data['doc_df_idf']))
+    char_sents = list(itertools.chain.from_iterable(data['doc_char_encode']))
+    char_words = list(itertools.chain.from_iterable(char_sents))
+    token_sents = [sent for _, sent in label_sents]
+    return {
+        'n_docs': {
+            key: len(data[key])
+            for key in ('doc_label_sents', 'doc_df_idf', 'doc_char_encode', 'doc_key_encode',
+                        'doc_artwork')
+        },
+        'doc_n_sents': _lens(doc_label_sents),
+        'doc_n_df_idf_sents': _lens(data['doc_df_idf']),
+        'doc_n_char_sents': _lens(data['doc_char_encode']),
+        'labels': np.fromiter((label for label, _ in label_sents), dtype=np.int64),
+        'sent_n_words': _lens(token_sents),
+        'sent_n_df_idf': _lens(df_idf_sents),
+        'sent_n_char_words': _lens(char_sents),
+        'tokens': _flat(token_sents, np.int64),
+        'df_idf': _flat(df_idf_sents, np.float64),
+        'word_n_chars': _lens(char_words),
+        'chars': _flat(char_words, np.int64),
+        'doc_n_keys': _lens(data['doc_key_encode']),
+        'keys': _flat(data['doc_key_encode'], np.int64),
+    }
 
 
-# check size
-def check_seq_same_shape(a: Sequence, b: Sequence):
+def _mismatch(a, b):
+    '''
+    Index of the first difference of two length arrays, None if they are equal.
+    '''
     if len(a) != len(b):
-        return False
-    for i in range(len(a)):
-        if len(a[i]) != len(b[i]):
-            return False
-        for j in range(len(a[i])):
-            if len(a[i][j][1]) != len(b[i][j]):
-                return False
-    return True
+        return min(len(a), len(b))
+    diff = np.flatnonzero(a != b)
+    return diff[0].item() if len(diff) else None
+
+
+def validate(data, flat=None):
+    '''
+    Returns the list of problems found, empty if the artifact is consistent.
+    '''
+    flat = flatten(data) if flat is None else flat
+    n_words, n_chars = len(data['itow']), len(data['ctoi'])
+    problems = []
+
+    if len(set(flat['n_docs'].values())) > 1:
+        problems.append('document counts differ: {}'.format(flat['n_docs']))
+        return problems
+
+    for name, a, b in (
+        ('sentences per doc (labels vs df_idf)', flat['doc_n_sents'], flat['doc_n_df_idf_sents']),
+        ('sentences per doc (labels vs chars)', flat['doc_n_sents'], flat['doc_n_char_sents']),
+        ('words per sentence (tokens vs df_idf)', flat['sent_n_words'], flat['sent_n_df_idf']),
+        ('words per sentence (tokens vs chars)', flat['sent_n_words'], flat['sent_n_char_words']),
+    ):
+        i = _mismatch(a, b)
+        if i is not None:
+            problems.append('{} differ first at index {}'.format(name, i))
+    if problems:
+        return problems
+
+    def check_range(name, ids, low, high):
+        bad = np.flatnonzero((ids < low) | (ids >= high))
+        if len(bad):
+            problems.append('{} {} ids out of [{}, {}), first {} at {}'.format(
+                len(bad), name, low, high, ids[bad[0]], bad[0]))
+
+    check_range('token', flat['tokens'], UNK_IDX, n_words)
+    check_range('key', flat['keys'], UNK_IDX, n_words)
+    check_range('char', flat['chars'], 0, n_chars)
+    if np.any(flat['doc_n_keys'] == 0):
+        problems.append('{} docs without keys'.format(np.count_nonzero(flat['doc_n_keys'] == 0)))
+
+    bad_labels = np.flatnonzero((flat['labels'] != 0) & (flat['labels'] != 1))
+    if len(bad_labels):
+        problems.append('{} labels not in {{0, 1}}, first {} at sentence {}'.format(
+            len(bad_labels), flat['labels'][bad_labels[0]], bad_labels[0]))
+
+    not_finite = np.flatnonzero(~np.isfinite(flat['df_idf']))
+    if len(not_finite):
+        problems.append('{} non-finite df_idf values, first at word {}'.format(
+            len(not_finite), not_finite[0]))
+
+    # chars are encoded from the word itself, <unk> and hashed words keep their own length
+    itow_lens = np.fromiter(map(len, data['itow']), dtype=np.int64)
+    bucket_start = n_words - data.get('n_hash_buckets', 0)
+    known = (flat['tokens'] != UNK_IDX) & (flat['tokens'] < bucket_start)
+    bad_chars = np.flatnonzero(known & (flat['word_n_chars'] != itow_lens[flat['tokens']]))
+    if len(bad_chars):
+        problems.append('{} words whose char count differs from itow, first at word {}'.format(
+            len(bad_chars), bad_chars[0]))
+
+    return problems
+
+
+def _array_sha256(value, chunk_size=1 << 20):
+    '''
+    sha256 of the bytes of an array, fed chunk_size items at a time so that a memory-mapped
+    array is hashed without a copy of it in memory.
+    '''
+    h = hashlib.sha256()
+    items = value.reshape(-1)
+    for start in range(0, len(items), chunk_size):
+        h.update(memoryview(np.ascontiguousarray(items[start:start + chunk_size])))
+    return h.hexdigest()
+
+
+def content_checksums(data, flat=None):
+    '''
+    sha256 of each flat array and of the vocabularies, independent of the pickling.
+    '''
+    flat = flatten(data) if flat is None else flat
+    checksums = {
+        key: _array_sha256(value) for key, value in flat.items() if isinstance(value, np.ndarray)
+    }
+    checksums['itow'] = hashlib.sha256('\n'.join(data['itow']).encode()).hexdigest()
+    checksums['ctoi'] = hashlib.sha256(json.dumps(sorted(
+        data['ctoi'].items())).encode()).hexdigest()
+    checksums['doc_artwork'] = hashlib.sha256('\n'.join(map(
+        str, data['doc_artwork'])).encode()).hexdigest()
+    return checksums
+
+
+def file_sha256(fp, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(fp, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def checksum_file(data_file):
+    return data_file + '.checksums.json'
+
+
+def write_checksums(data_file, data, flat=None):
+    flat = flatten(data) if flat is None else flat
+    obj = {
+        'file': os.path.basename(data_file),
+        'size': os.path.getsize(data_file),
+        'sha256': file_sha256(data_file),
+        'n_docs': len(flat['doc_n_sents']),
+        'n_sents': len(flat['sent_n_words']),
+        'n_words': len(flat['tokens']),
+        'content': content_checksums(data, flat)
+    }
+    fp = checksum_file(data_file)
+    tmp_fp = fp + '.tmp'
+    with open(tmp_fp, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_fp, fp)
+    return obj
+
+
+def flat_dir(data_file):
+    return data_file + '.flat'
+
+
+def write_flat(data_file, data, flat=None):
+    '''
+    Saves the flat arrays to flat_dir(data_file) as .npy files, with itow and wc in vocab.json.
+    '''
+    flat = flatten(data) if flat is None else flat
+    out_dir = flat_dir(data_file)
+    tmp_dir = out_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for key, value in flat.items():
+        if isinstance(value, np.ndarray):
+            np.save(os.path.join(tmp_dir, key + '.npy'), value)
+    with open(os.path.join(tmp_dir, 'vocab.json'), 'w') as f:
+        json.dump({'itow': list(data['itow']), 'wc': dict(data['wc'])}, f)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+def _changed_arrays(expected, checksums):
+    '''
+    Names of the arrays whose content checksum differs from, or is missing in, expected.
+    '''
+    return sorted(key for key in checksums if expected.get(key) != checksums[key])
+
+
+def load_flat(data_file, mmap_mode='r', verify=False):
+    '''
+    The arrays of write_flat, memory-mapped by default, and itow and wc. With verify, each array
+    and itow is compared with the content checksums of the artifact, if it has a checksum file.
+    Raises ValueError if the flat arrays are not those of data_file.
+    '''
+    in_dir = flat_dir(data_file)
+    flat = {
+        name[:-len('.npy')]: np.load(os.path.join(in_dir, name), mmap_mode=mmap_mode)
+        for name in os.listdir(in_dir) if name.endswith('.npy')
+    }
+    with open(os.path.join(in_dir, 'vocab.json')) as f:
+        flat.update(json.load(f))
+
+    fp = checksum_file(data_file)
+    if verify and os.path.exists(fp):
+        with open(fp) as f:
+            expected = json.load(f)['content']
+        checksums = {
+            key: _array_sha256(value)
+            for key, value in flat.items() if isinstance(value, np.ndarray)
+        }
+        checksums['itow'] = hashlib.sha256('\n'.join(flat['itow']).encode()).hexdigest()
+        changed = _changed_arrays(expected, checksums)
+        if changed:
+            raise ValueError('{} differ from {}, run codecheck.py {} again'.format(
+                ', '.join(changed), data_file, data_file))
+    return flat
+
+
+def verify_artifact(data_file, data):
+    '''
+    Compares data_file with its checksum file, which only needs a hash of the file. If the file
+    hash differs, e.g. the artifact was pickled again, the content checksums of the loaded data
+    decide, and the checksum file is updated when the content is unchanged. Without a checksum
+    file the loaded data is validated first, and the checksum file written.
+    Raises ValueError if the artifact is inconsistent or changed since it was validated.
+    '''
+    fp = checksum_file(data_file)
+    if not os.path.exists(fp):
+        flat = flatten(data)
+        problems = validate(data, flat)
+        if problems:
+            raise ValueError('Invalid artifact {}: {}'.format(data_file, '; '.join(problems)))
+        write_checksums(data_file, data, flat)
+        return
+
+    with open(fp) as f:
+        expected = json.load(f)
+    if (os.path.getsize(data_file) == expected['size']
+            and file_sha256(data_file) == expected['sha256']):
+        return
+
+    flat = flatten(data)
+    changed = _changed_arrays(expected['content'], content_checksums(data, flat))
+    if changed:
+        raise ValueError('{} changed since it was validated ({}), run codecheck.py {} again'.format(
+            data_file, ', '.join(changed), data_file))
+    write_checksums(data_file, data, flat)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('data_file')
+    parser.add_argument('--no-write',
+                        action='store_true',
+                        help='do not write the checksum file and flat arrays of a valid artifact')
+    args = parser.parse_args(argv)
 
+    with open(args.data_file, 'rb') as f:
+        data = pickle.load(f)
+    flat = flatten(data)
+    problems = validate(data, flat)
+    for problem in problems:
+        print(problem)
+    if problems:
+        sys.exit(1)
+    print('{}: {} docs, {} sentences, {} words, OK'.format(args.data_file,
+                                                          len(flat['doc_n_sents']),
+                                                          len(flat['sent_n_words']),
+                                                          len(flat['tokens'])))
+    if not args.no_write:
+        write_checksums(args.data_file, data, flat)
+        print('Wrote {}'.format(checksum_file(args.data_file)))
+        print('Wrote {}'.format(write_flat(args.data_file, data, flat)))
 
-print('Same shape: {}'.format(check_seq_same_shape(doc_label_sents, doc_df_idf)))
 
-# %%
+if __name__ == '__main__':
+    main()
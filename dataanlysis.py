@@ -1,107 +1,164 @@
 # %%
-import collections
+import argparse
+import itertools
 import os
 import pickle
-import itertools
+import time
 
 import numpy as np
 import matplotlib.pyplot as plt
 
-# %%
-data_dir = 'data_/goodreads-reviews-spoiler'
-data_file = os.path.join(data_dir, 'mappings_10000_all_ge5.pkl')
-
-# %%
-# Load
-with open(data_file, 'rb') as f:
-    data = pickle.load(f)
-doc_label_sents = data['doc_label_sents']
-itow = data['itow']
-wc = data['wc']
-wc_artwork = data['wc_artwork']
-doc_artwork = data['doc_artwork']
-doc_df_idf = data['doc_df_idf']
-
+import codecheck
 
-def inv_doc_sent_word(doc_sent_word):
-    inv = []
-    for docid, doc in enumerate(doc_sent_word):
-        for sentid, sent in enumerate(doc):
-            for wid, w in enumerate(sent):
-                inv.append((w, (docid, sentid, wid)))
-    return inv
+# Reads the memory-mapped flat arrays codecheck.py writes next to an artifact, a chunk at a
+# time. Length statistics are computed from bincounts and DF-IDF top-k over the chunks, so
+# memory is bounded by the chunk size and the vocabulary, not the corpus.
 
 
-inv_doc_idf_idf = inv_doc_sent_word(doc_df_idf)
-
 # %%
-# doc len, sent len
-n_docs = len(doc_label_sents)
-print('# of docs: {}'.format(n_docs))
-
-doc_lens = [len(label_sents) for label_sents in doc_label_sents]
-doc_len_count = collections.Counter(doc_lens)
-min_doc_len, max_doc_len = min(doc_len_count.keys()), max(doc_len_count.keys())
-
-fig, axes = plt.subplots(1, 1)
-axes.set_xlim(xmin=0, xmax=max_doc_len)
-axes.hist(doc_lens, bins=max_doc_len)
-plt.savefig('plot_/hist_doc_len.pdf')
-
-fig, axes = plt.subplots(1, 1)
-axes.set_ylim(ymin=0, ymax=max_doc_len)
-axes.boxplot(doc_lens)
-plt.savefig('plot_/box_doc_len.pdf')
-
-print('25, 50, 75 percentile of doc len: {}'.format(str(np.percentile(doc_lens, [25, 50, 75]))))
+def count_percentiles(counts, qs):
+    '''
+    Percentiles of the values whose bincount is counts, same as np.percentile on the values.
+    '''
+    cum = np.cumsum(counts)
+    pos = np.asarray(qs, dtype=np.float64) / 100 * (cum[-1] - 1)
+    lo = np.searchsorted(cum, np.floor(pos), side='right')
+    hi = np.searchsorted(cum, np.ceil(pos), side='right')
+    return lo + (hi - lo) * (pos - np.floor(pos))
+
+
+def box_stats(counts, label=''):
+    '''
+    matplotlib bxp stats of the values whose bincount is counts, whiskers at 1.5 IQR.
+    '''
+    values = np.nonzero(counts)[0]
+    q1, med, q3 = count_percentiles(counts, [25, 50, 75])
+    iqr = q3 - q1
+    inside = values[(values >= q1 - 1.5 * iqr) & (values <= q3 + 1.5 * iqr)]
+    return {
+        'label': label,
+        'med': med,
+        'q1': q1,
+        'q3': q3,
+        'whislo': inside.min(),
+        'whishi': inside.max(),
+        # distinct outlier values only
+        'fliers': values[(values < inside.min()) | (values > inside.max())]
+    }
+
+
+def plot_lengths(counts, name, plot_dir='plot_'):
+    max_len = len(counts) - 1
+
+    fig, axes = plt.subplots(1, 1)
+    axes.set_xlim(xmin=0, xmax=max_len)
+    axes.hist(np.arange(len(counts)), bins=max_len, weights=counts)
+    plt.savefig(os.path.join(plot_dir, 'hist_{}_len.pdf'.format(name)))
+
+    fig, axes = plt.subplots(1, 1)
+    axes.set_ylim(ymin=0, ymax=max_len)
+    axes.bxp([box_stats(counts)])
+    plt.savefig(os.path.join(plot_dir, 'box_{}_len.pdf'.format(name)))
+    plt.close('all')
+
+
+def report_lengths(counts, name, max_len):
+    n = counts.sum()
+    print('# of {}s: {}'.format(name, n))
+    print('25, 50, 75 percentile of {} len: {}'.format(name,
+                                                      str(count_percentiles(counts, [25, 50, 75]))))
+    print('percentile for {} len {}: {}'.format(name, max_len, counts[:max_len + 1].sum() / n))
 
-max_doc_len = 30
-print('percentile for doc len {}: {}'.format(
-    max_doc_len,
-    np.count_nonzero(np.array(doc_lens) <= max_doc_len) / n_docs))
 
 # %%
-sent_lens = [len(label_sent[1]) for label_sent in itertools.chain(*doc_label_sents)]
-n_sents = len(sent_lens)
+def chunks(values, chunk_size=1 << 22):
+    for start in range(0, len(values), chunk_size):
+        yield start, np.asarray(values[start:start + chunk_size])
+
+
+def chunked_bincount(values, chunk_size=1 << 22):
+    counts = np.zeros(0, dtype=np.int64)
+    for _, chunk in chunks(values, chunk_size):
+        chunk_counts = np.bincount(chunk)
+        if len(chunk_counts) > len(counts):
+            counts = np.pad(counts, (0, len(chunk_counts) - len(counts)))
+        counts[:len(chunk_counts)] += chunk_counts
+    return counts
+
+
+def top_k(values, k=1000, chunk_size=1 << 22):
+    '''
+    (values, indices) of the k largest values, largest first.
+    '''
+    top_vals = np.zeros(0, dtype=values.dtype)
+    top_idx = np.zeros(0, dtype=np.int64)
+    for start, chunk in chunks(values, chunk_size):
+        vals = np.concatenate((top_vals, chunk))
+        idx = np.concatenate((top_idx, np.arange(start, start + len(chunk))))
+        if len(vals) > k:
+            keep = np.argpartition(vals, -k)[-k:]
+            vals, idx = vals[keep], idx[keep]
+        top_vals, top_idx = vals, idx
+
+    order = np.argsort(-top_vals, kind='stable')
+    return top_vals[order], top_idx[order]
 
-print('# of sents: {}'.format(n_sents))
-
-sent_len_count = collections.Counter(sent_lens)
-min_sent_len, max_sent_len = min(sent_len_count.keys()), max(sent_len_count.keys())
-
-fig, axes = plt.subplots(1, 1)
-axes.set_xlim(xmin=0, xmax=max_sent_len)
-axes.hist(sent_lens, bins=max_sent_len)
-plt.savefig('plot_/hist_sent_len.pdf')
-
-fig, axes = plt.subplots(1, 1)
-axes.set_ylim(ymin=0, ymax=max_sent_len)
-axes.boxplot(sent_lens)
-plt.savefig('plot_/box_sent_len.pdf')
-
-print('25, 50, 75 percentile of sent len: {}'.format(str(np.percentile(sent_lens, [25, 50, 75]))))
-
-max_sent_len = 25
-print('percentile for doc len {}: {}'.format(
-    max_sent_len,
-    np.count_nonzero(np.array(sent_lens) <= max_sent_len) / n_sents))
 
 # %%
-freq = 1
-words = list(itertools.islice(filter(lambda t: t[1] <= freq, wc.items()), 100))
-print(words)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Corpus statistics of a preprocessed artifact')
+    parser.add_argument('--data-file',
+                        default=os.path.join('data_/goodreads-reviews-spoiler',
+                                             'mappings_10000_all_ge5.pkl'))
+    parser.add_argument('--plot-dir', default='plot_')
+    parser.add_argument('--max-doc-len', type=int, default=30)
+    parser.add_argument('--max-sent-len', type=int, default=25)
+    parser.add_argument('--top-k', type=int, default=1000)
+    parser.add_argument('--freq', type=int, default=1)
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='check the flat arrays against the checksum file, one more read')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.plot_dir):
+        os.makedirs(args.plot_dir)
+
+    # Load
+    if not os.path.exists(codecheck.flat_dir(args.data_file)):
+        print('No flat arrays, unpickling {} whole. Run codecheck.py {} to write them'.format(
+            args.data_file, args.data_file))
+        with open(args.data_file, 'rb') as f:
+            data = pickle.load(f)
+        codecheck.write_flat(args.data_file, data)
+        del data
+    flat = codecheck.load_flat(args.data_file, verify=args.verify)
+    start_time = time.time()
+
+    # doc len, sent len
+    doc_len_counts = chunked_bincount(flat['doc_n_sents'])
+    plot_lengths(doc_len_counts, 'doc', args.plot_dir)
+    report_lengths(doc_len_counts, 'doc', args.max_doc_len)
+
+    sent_len_counts = chunked_bincount(flat['sent_n_words'])
+    plot_lengths(sent_len_counts, 'sent', args.plot_dir)
+    report_lengths(sent_len_counts, 'sent', args.max_sent_len)
+
+    words = list(itertools.islice(filter(lambda t: t[1] <= args.freq, flat['wc'].items()), 100))
+    print(words)
+
+    # df-idf
+    # Which word has highest df-idf
+    _, top_idx = top_k(flat['df_idf'], args.top_k)
+    itow = flat['itow']
+    top_words = set(itow[token] for token in flat['tokens'][np.sort(top_idx)])
+    print('{} distinct words in the top {} df-idf tokens: {}'.format(
+        len(top_words), args.top_k, sorted(top_words)[:100]))
+
+    print('Done in {:.1f}s'.format(time.time() - start_time))
+    return top_words
+
+
+if __name__ == '__main__':
+    main()
 
 # %%
-# df-idf
-# Which word has highest df-idf
-dfidftop100 = sorted(inv_doc_idf_idf, key=lambda e: e[0], reverse=True)[:1000]
-
-
-def word_of_idx(doc_label_sents, idx, itow):
-    return itow[doc_label_sents[idx[0]][idx[1]][1][idx[2]]]
-
-
-top100w = set(map(lambda i: word_of_idx(doc_label_sents, i, itow), map(lambda e: e[1],
-                                                                       dfidftop100)))
-
-# %%
\ No newline at end of file
@@ -0,0 +1,146 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class EpochRandomSampler(torch.utils.data.Sampler):
+    '''
+    Random permutation seeded from seed + epoch, like DistributedSampler on a single process.
+    The order of an epoch does not depend on the global RNG, so a run resumed at any epoch
+    shuffles as the uninterrupted one did. The epoch advances after each pass unless set_epoch
+    is called.
+    '''
+    def __init__(self, data_source, seed=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        self.epoch += 1
+        return iter(torch.randperm(len(self.data_source), generator=generator).tolist())
+
+
+def make_dataloader(dataset,
+                    batch_size,
+                    shuffle=False,
+                    num_workers=0,
+                    device='cpu',
+                    sampler=None,
+                    seed=0):
+    '''
+    Whole batches are gathered with one index per tensor instead of collating batch_size items.
+    The worker base seed comes from a generator seeded with seed, not from the global RNG, which
+    persistent workers would only draw from in the epoch that first iterates.
+    '''
+    if sampler is None:
+        sampler = (EpochRandomSampler(dataset, seed)
+                   if shuffle else torch.utils.data.SequentialSampler(dataset))
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False)
+    return torch.utils.data.DataLoader(dataset,
+                                       batch_size=None,
+                                       sampler=batch_sampler,
+                                       num_workers=num_workers,
+                                       persistent_workers=num_workers > 0,
+                                       pin_memory=torch.device(device).type == 'cuda',
+                                       generator=torch.Generator().manual_seed(seed))
+
+
+def to_device(batch, device, params, non_blocking=False):
+    elems, labels, sentmasks, dfidf, chars, doc_ab = batch
+    elems = elems.to(device, non_blocking=non_blocking)
+    labels = labels.float().view(-1).to(device, non_blocking=non_blocking)
+    sentmasks = sentmasks.view(-1).to(device, non_blocking=non_blocking)
+    doc_ab = doc_ab.to(device, non_blocking=non_blocking)
+    if params['use_idf']:
+        dfidf = dfidf.to(device, non_blocking=non_blocking)
+    if params['use_char']:
+        chars = chars.to(device, non_blocking=non_blocking)
+    return elems, labels, sentmasks, dfidf, chars, doc_ab
+
+
+class Prefetcher:
+    '''
+    Keeps up to n_prefetch batches moved to device ahead of the training loop, from a
+    background thread. With n_prefetch=0 batches are moved in the caller's thread.
+    h2d_time adds up the copy time of the batches yielded so far.
+    '''
+    _end = object()
+
+    def __init__(self, dataloader, device, params, n_prefetch=2):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.params = params
+        self.n_prefetch = n_prefetch
+        self.h2d_time = 0
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def _produce(self, batches, stop):
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        try:
+            for batch in self.dataloader:
+                start = time.perf_counter()
+                if stream is not None:
+                    with torch.cuda.stream(stream):
+                        batch = to_device(batch, self.device, self.params, non_blocking=True)
+                    stream.synchronize()
+                else:
+                    batch = to_device(batch, self.device, self.params)
+                if not put((batch, time.perf_counter() - start)):
+                    return
+            put(self._end)
+        except Exception as e:
+            put(e)
+
+    def __iter__(self):
+        if not self.n_prefetch:
+            for batch in self.dataloader:
+                start = time.perf_counter()
+                batch = to_device(batch, self.device, self.params)
+                self.h2d_time += time.perf_counter() - start
+                yield batch
+            return
+
+        batches = queue.Queue(self.n_prefetch)
+        stop = threading.Event()
+        thread = threading.Thread(target=self._produce, args=(batches, stop), daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is self._end:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                batch, h2d_time = batch
+                self.h2d_time += h2d_time
+                if self.device.type == 'cuda':
+                    # allocated on the copy stream: keeps the caching allocator from reusing the
+                    # memory for a later copy while kernels of this stream still read it
+                    consumer = torch.cuda.current_stream(self.device)
+                    for t in batch:
+                        if isinstance(t, torch.Tensor) and t.is_cuda:
+                            t.record_stream(consumer)
+                yield batch
+        finally:
+            stop.set()
+            thread.join()
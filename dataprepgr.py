@@ -7,22 +7,20 @@ import os
 import gzip
 import json
 import pickle
-import re
-import string
 import math
 
 # import nltk
 # nltk.download('stopwords')
 # nltk.download('punkt')
 
-import gdown
 from nltk.tokenize import word_tokenize
-from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer
 import numpy as np
 from sklearn.preprocessing import StandardScaler
 
+import codecheck
 import loggingutil
+from textproc import STOP_WORDS, WordIndex, remove_punc, get_sent_words, get_label_sent_words
 
 # %%
 root = 'data_'
@@ -33,25 +31,34 @@ filename = 'goodreads_reviews_spoiler.json.gz'
 logger = loggingutil.get_logger('dataprepgr')
 
 # %%
-STOP_WORDS = set(stopwords.words('english'))
 _porter = PorterStemmer()
 _stdscale = StandardScaler()
 # %%
-# Download
 file_dir = os.path.join(root, base_folder)
-if not os.path.exists(file_dir):
-    os.makedirs(file_dir)
 file_path = os.path.join(file_dir, filename)
-if not os.path.exists(file_path):
-    gdown.download(URL, output=file_path)
+keyword_path = "data_/book_id_keywords.json"
+
+
+# Download
+def download():
+    import gdown
+
+    if not os.path.exists(file_dir):
+        os.makedirs(file_dir)
+    if not os.path.exists(file_path):
+        gdown.download(URL, output=file_path)
+
 
 # keywords
-keyword_path = "data_/book_id_keywords.json"
-keywords = json.load(open(keyword_path, "r"))
+def load_keywords(fp=keyword_path):
+    with open(fp, "r") as f:
+        return json.load(f)
 
 
 # Load
-def generate_records(limit=None, log_every=100000):
+def generate_records(limit=None, log_every=100000, keywords=None):
+    if keywords is None:
+        keywords = load_keywords()
     count = 0
     with gzip.open(file_path) as fin:
         for l in itertools.islice(fin, limit):
@@ -68,65 +75,30 @@ def generate_records(limit=None, log_every=100000):
             yield d
 
 
-def load_records(limit=None):
-    return list(generate_records(limit))
+def load_records(limit=None, keywords=None):
+    return list(generate_records(limit, keywords=keywords))
 
 
 # %%
 # Reusable
-def remove_punc(token):
-    return token.translate(str.maketrans('', '', string.punctuation))
-
-
-def get_sent_words(sent):
-    # case-folding
-    sent = sent.lower()
-
-    # replace http
-    sent = re.sub(r'(http|https)://\S+', '^http', sent)
-
-    # replace digits
-    sent = re.sub(r'\d+', ' ^num ', sent)
-
-    # tokenize
-    words = word_tokenize(sent)
-
-    # split '-'
-    words = itertools.chain(*map(lambda w: w.split('-'), words))
-
-    # remove punctuation
-    words = map(lambda w: remove_punc(w) if w not in ['^http', '^num'] else w, words)
-
-    # remove empty
-    words = filter(lambda w: w, words)
-
-    # remove stopwords
-    words = filter(lambda w: w not in STOP_WORDS, words)
-
-    # stemming
-    # words = map(lambda w: _porter.stem(w), words)
-
-    words = list(words)
-    return words
-
-
-def get_label_sent_words(label_sents):
-    return [(lb_s[0], get_sent_words(lb_s[1])) for lb_s in label_sents]
-
-
-def get_word_dict(wc, n_most_common, freq=1):
+def get_word_dict(wc, n_most_common, freq=1, n_hash_buckets=0):
+    '''
+    itow is ordered by frequency. With n_hash_buckets, the words left out share that many
+    hashed ids at the end of itow instead of <unk>.
+    '''
     itow = ['<pad>', '<unk>']
     wcs = wc.most_common(n_most_common)
     wcs = filter(lambda wc: wc[1] >= freq, wcs)
     words = map(lambda wc: wc[0], wcs)
     itow.extend(words)
-    wtoi = {w: i for i, w in enumerate(itow)}
-    logger.info("Vocabulary size = {}".format(len(wtoi)))
+    itow.extend('<hash_{}>'.format(i) for i in range(n_hash_buckets))
+    wtoi = WordIndex(itow, n_hash_buckets)
+    logger.info("Vocabulary size = {} ({} hash buckets)".format(len(wtoi), n_hash_buckets))
     return wtoi, itow
 
 
 def get_doc_label_sent_encodes(label_sents, word2idx):
-    return [(lb_sw[0], [word2idx[w if w in word2idx else '<unk>'] for w in lb_sw[1]], lb_sw[1])
+    return [(lb_sw[0], [word2idx.encode(w) for w in lb_sw[1]], lb_sw[1])
             for lb_sw in get_label_sent_words(label_sents)]
 
 
@@ -150,7 +122,9 @@ def word_count(records):
     return wc, wc_artwork, wc_doc
 
 
-def process(records, word2idx, ctoi):
+def process(records, word2idx, ctoi, keywords=None):
+    if keywords is None:
+        keywords = load_keywords()
     doc_artwork, doc_encode, doc_key_encode, doc_char_encode = [], [], [], []
     for record in records:
 
@@ -231,7 +205,8 @@ def process_df_idf(doc_encode, doc_artwork, itow, atod, wtod, wtoa, log_every=10
             for w in lb_s[1]:
                 word = itow[w]
                 dfidf = 1.
-                if word != '<unk>':
+                # <unk> and hash buckets are no corpus words
+                if word in wtod:
                     dfidf = df_idf(word, artwork_id, atod, wtod, wtoa)
                 all_df_idf.append(dfidf)
                 c += 1
@@ -273,18 +248,23 @@ if __name__ == '__main__':
     limit = 10000
     n_most_common = None
     freq_ge = 5
+    # > 0 to hash the words below freq_ge into buckets instead of <unk>
+    n_hash_buckets = 0
+
+    download()
+    keywords = load_keywords()
 
     logger.info('# of reviews: {}'.format(limit))
     logger.info('Getting word counts...')
-    wc, wc_artwork, wc_doc = word_count(generate_records(limit))
+    wc, wc_artwork, wc_doc = word_count(generate_records(limit, keywords=keywords))
     logger.info('Building dictionaries...')
-    wtoi, itow = get_word_dict(wc, n_most_common, freq_ge)
+    wtoi, itow = get_word_dict(wc, n_most_common, freq_ge, n_hash_buckets)
     logger.info('Building char-level dictionaries...')
     ctoi, itoc = get_char_dict(wc)
 
     logger.info('Encoding reviews...')
     doc_encode, doc_artwork, doc_key_encode, doc_char_encode = process(
-        generate_records(limit), wtoi, ctoi)
+        generate_records(limit, keywords=keywords), wtoi, ctoi, keywords)
     logger.info('Calculating DF-IDF...')
     atod, wtod, wtoa = prepare_invmap(doc_artwork, wc_doc, wc_artwork)
     doc_df_idf = process_df_idf(doc_encode, doc_artwork, itow, atod, wtod, wtoa)
@@ -292,6 +272,7 @@ if __name__ == '__main__':
     obj = {
         'doc_label_sents': doc_encode,
         'itow': itow,
+        'n_hash_buckets': n_hash_buckets,
         'wc': dict(wc),
         'wc_artwork': dict(wc_artwork),
         'doc_artwork': doc_artwork,
@@ -303,7 +284,16 @@ if __name__ == '__main__':
     filename = 'mappings_{}_{}_ge{}'.format('all' if limit is None else str(limit),
                                             'all' if n_most_common is None else str(n_most_common),
                                             str(freq_ge))
+    if n_hash_buckets:
+        filename += '_h{}'.format(n_hash_buckets)
     with open(os.path.join(file_dir, filename + '.pkl'), 'wb') as f:
         pickle.dump(obj, f)
+    logger.info('Validating...')
+    flat = codecheck.flatten(obj)
+    problems = codecheck.validate(obj, flat)
+    if problems:
+        raise ValueError('; '.join(problems))
+    codecheck.write_checksums(os.path.join(file_dir, filename + '.pkl'), obj, flat)
+    codecheck.write_flat(os.path.join(file_dir, filename + '.pkl'), obj, flat)
 
 # %%
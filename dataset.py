@@ -1,5 +1,7 @@
 import itertools
+import math
 import pickle
+from typing import Sequence
 
 import nltk
 import numpy as np
@@ -26,6 +28,18 @@ class Dictionary:
         self.word2idx = {word: idx for idx, word in enumerate(self.idx2word)}
 
 
+def get_max_n_chars(itow):
+    char_length = [len(w) for w in itow]
+    char_length = sorted(char_length)
+    return char_length[int(0.99 * len(char_length))]
+
+
+def get_max_n_keys(doc_keys):
+    key_length = [len(d) for d in doc_keys]
+    key_length = sorted(key_length)
+    return key_length[int(0.9 * len(key_length))]
+
+
 class GoodreadsReviewsSpoilerDataset(torch.utils.data.Dataset):
     '''
     Credits: Mengting Wan, Rishabh Misra, Ndapa Nakashole, Julian McAuley, "Fine-Grained Spoiler Detection from Large-Scale Review Corpora", in ACL'19.
@@ -42,18 +56,9 @@ class GoodreadsReviewsSpoilerDataset(torch.utils.data.Dataset):
         self.max_n_sents = max_n_sents
 
         self.itow = itow
-        self.wtoi = {w: i for i, w in enumerate(self.itow)}
-
-        self.doc_char_encode = doc_char_encode
-
-
-        char_length = [len(w) for w in self.wtoi]
-        char_length = sorted(char_length)
-        self.max_n_chars = char_length[int(0.99*len(char_length))]
 
-        key_length = [len(d) for d in doc_keys]
-        key_length = sorted(key_length)
-        self.max_n_keys = key_length[int(0.9*len(key_length))]
+        self.max_n_chars = get_max_n_chars(self.itow)
+        self.max_n_keys = get_max_n_keys(doc_keys)
 
 
         docs, labels, doc_len_masks, doc_sent_lens, doc_chars, doc_abs = self.pad(doc_label_sents, doc_keys, doc_char_encode, itow=itow, ctoi=ctoi)
@@ -65,7 +70,7 @@ class GoodreadsReviewsSpoilerDataset(torch.utils.data.Dataset):
         self.doc_chars = torch.from_numpy(doc_chars)
         self.doc_abs = torch.from_numpy(doc_abs)
 
-        self.doc_dfidf = self.paddfidf(doc_df_idf)
+        self.doc_dfidf = torch.from_numpy(self.paddfidf(doc_df_idf))
 
     def pad(self, doc_label_sents, doc_keys, doc_char_encode, pad_idx=0, itow=None, ctoi=None):
         docs, labels, doc_lens, doc_sent_lens, doc_chars, doc_abs = [], [], [], [], [], []
@@ -73,14 +78,14 @@ class GoodreadsReviewsSpoilerDataset(torch.utils.data.Dataset):
 
             # refers
             _abs = doc_keys[k]
-            doc_ab = np.full((self.max_n_keys), pad_idx, dtype=np.long)
+            doc_ab = np.full((self.max_n_keys), pad_idx, dtype=np.int64)
             ab_len = min((self.max_n_keys, len(_abs)))
             doc_ab[:ab_len] = _abs[:ab_len]
             doc_abs.append(doc_ab)
 
             # chars
-            doc_char = np.full((self.max_n_sents, self.max_n_words, self.max_n_chars), pad_idx, dtype=np.long)
-            doc = np.full((self.max_n_sents, self.max_n_words), pad_idx, dtype=np.long)
+            doc_char = np.full((self.max_n_sents, self.max_n_words, self.max_n_chars), pad_idx, dtype=np.int64)
+            doc = np.full((self.max_n_sents, self.max_n_words), pad_idx, dtype=np.int64)
             sent_labels = []
             sent_lens = []
             for i, (label, sent) in enumerate(itertools.islice(label_sent_encodes,
@@ -92,7 +97,7 @@ class GoodreadsReviewsSpoilerDataset(torch.utils.data.Dataset):
                 sent_lens.append(sent_len)
 
                 for j, wid in enumerate(sent[:sent_len]):
-                    w_c_list = self.doc_char_encode[k][i][j]
+                    w_c_list = doc_char_encode[k][i][j]
                     # word = itow[wid]
                     # w_c_list = []
                     # for char in word:
@@ -102,7 +107,7 @@ class GoodreadsReviewsSpoilerDataset(torch.utils.data.Dataset):
                     doc_char[i, j, :word_len] = np.array(w_c_list)[:word_len]
 
             doc_len = min((self.max_n_sents, len(label_sent_encodes)))
-            sent_labels = np.pad(np.array(sent_labels, dtype=np.long),
+            sent_labels = np.pad(np.array(sent_labels, dtype=np.int64),
                                  ((0, self.max_n_sents - doc_len)))
             docs.append(doc)
             labels.append(sent_labels)
@@ -132,7 +137,48 @@ class GoodreadsReviewsSpoilerDataset(torch.utils.data.Dataset):
         return docs
 
     def __getitem__(self, idx):
+        # idx can also be a list of indices, to fetch a whole batch at once
         return self.docs[idx], self.labels[idx], self.doc_len_masks[idx], self.doc_dfidf[idx], self.doc_chars[idx], self.doc_abs[idx]
 
     def __len__(self):
         return len(self.docs)
+
+    def share_memory(self):
+        '''
+        Moves the padded tensors to shared memory, so that worker processes get them without
+        a copy.
+        '''
+        for tensor in (self.docs, self.labels, self.doc_len_masks, self.doc_dfidf, self.doc_chars,
+                       self.doc_abs):
+            tensor.share_memory_()
+        return self
+
+
+def train_dev_test_split_idx(rand_idx, d: Sequence, n_train: int, n_dev: int):
+    d_train = [d[idx] for idx in rand_idx[:n_train]]
+    d_dev = [d[idx] for idx in rand_idx[n_train:n_train + n_dev]]
+    d_test = [d[idx] for idx in rand_idx[n_train + n_dev:]]
+    return d_train, d_dev, d_test
+
+
+def split_datasets(data, max_n_words, max_n_sents, train_portion, dev_portion, seed=0):
+    '''
+    Random train/dev/test split of a preprocessed artifact, returns the three datasets.
+    '''
+    doc_label_sents = data['doc_label_sents']
+
+    np.random.seed(seed)
+
+    n_d = len(doc_label_sents)
+    n_train = math.floor(n_d * train_portion)
+    n_dev = math.floor(n_d * dev_portion)
+    rand_idx = np.random.choice(n_d, n_d, replace=False)
+
+    splits = [
+        train_dev_test_split_idx(rand_idx, data[key], n_train, n_dev)
+        for key in ('doc_label_sents', 'doc_df_idf', 'doc_key_encode', 'doc_char_encode')
+    ]
+    return tuple(
+        GoodreadsReviewsSpoilerDataset(d, d_idf, d_key, data['itow'], max_n_words, max_n_sents,
+                                       data['ctoi'], d_char)
+        for d, d_idf, d_key, d_char in zip(*splits))
@@ -0,0 +1,207 @@
+'''
+Pretrained word vectors (GloVe or word2vec text format) for the SpoilerNet embedding layer.
+
+The text file is parsed once by convert() into <prefix>.f32, the raw float32 matrix in file
+order, <prefix>.hashes.npy and <prefix>.rows.npy, the sorted 64-bit hashes of the words with
+their rows, and <prefix>.json. Loading only maps these files, an itow vocabulary is looked up
+with one searchsorted and its vectors gathered from the mapped matrix.
+
+    python embeddings.py convert glove.6B.200d.txt
+    python embeddings.py coverage emb_/glove.6B.200d data_/goodreads-reviews-spoiler/mappings_...
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import pickle
+
+import numpy as np
+
+emb_dir = 'emb_'
+
+
+def hash_word(word):
+    return int.from_bytes(hashlib.blake2b(word.encode('utf8'), digest_size=8).digest(), 'little')
+
+
+def hash_words(words):
+    return np.fromiter(map(hash_word, words), dtype=np.uint64, count=len(words))
+
+
+def _split_line(line, dim):
+    # words may contain spaces (GloVe 840B), the last dim fields are the vector
+    line = line.rstrip()
+    word = line.rsplit(' ', dim)[0]
+    return word, line[len(word) + 1:]
+
+
+def convert(txt_file, prefix=None, chunk_lines=100000, encoding='utf8'):
+    '''
+    Converts a pretrained vector text file, with or without the word2vec "<n> <dim>" header.
+    Of repeated words the first vector is kept. Returns the metadata written to <prefix>.json.
+    '''
+    if prefix is None:
+        prefix = os.path.join(emb_dir, os.path.splitext(os.path.basename(txt_file))[0])
+    if os.path.dirname(prefix) and not os.path.exists(os.path.dirname(prefix)):
+        os.makedirs(os.path.dirname(prefix))
+
+    n_rows = 0
+    hash_chunks = []
+    with open(txt_file, encoding=encoding, errors='replace') as f, \
+            open(prefix + '.f32.tmp', 'wb') as out:
+        first = f.readline()
+        header = first.split()
+        if len(header) == 2 and all(map(str.isdigit, header)):
+            dim = int(header[1])
+            lines = f
+        else:
+            dim = len(first.rstrip().split(' ')) - 1
+            lines = itertools.chain([first], f)
+
+        for chunk in iter(lambda: list(itertools.islice(lines, chunk_lines)), []):
+            words, vectors = zip(*(_split_line(line, dim) for line in chunk))
+            values = np.fromstring(' '.join(vectors), dtype=np.float32, sep=' ')
+            if values.size != len(chunk) * dim:
+                raise ValueError('{}: expected {} values per line in lines {}-{}'.format(
+                    txt_file, dim, n_rows + 1, n_rows + len(chunk)))
+            values.tofile(out)
+            hash_chunks.append(hash_words(words))
+            n_rows += len(chunk)
+
+    hashes = np.concatenate(hash_chunks) if hash_chunks else np.zeros(0, dtype=np.uint64)
+    rows = np.argsort(hashes, kind='stable')
+    hashes = hashes[rows]
+    first_of_hash = np.ones(len(hashes), dtype=bool)
+    first_of_hash[1:] = hashes[1:] != hashes[:-1]
+    np.save(prefix + '.hashes.npy', hashes[first_of_hash])
+    np.save(prefix + '.rows.npy', rows[first_of_hash])
+    os.replace(prefix + '.f32.tmp', prefix + '.f32')
+
+    meta = {
+        'source': os.path.basename(txt_file),
+        'n_rows': n_rows,
+        'n_words': int(first_of_hash.sum()),
+        'dim': dim,
+        'dtype': 'float32'
+    }
+    # written last, a prefix without it is an interrupted conversion
+    with open(prefix + '.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class PretrainedEmbeddings:
+    '''
+    Memory-mapped output of convert(), pages of the matrix are read on access.
+    '''
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + '.json') as f:
+            self.meta = json.load(f)
+        self.dim = self.meta['dim']
+        self.vectors = np.memmap(prefix + '.f32',
+                                 dtype=self.meta['dtype'],
+                                 mode='r',
+                                 shape=(self.meta['n_rows'], self.dim))
+        self.hashes = np.load(prefix + '.hashes.npy', mmap_mode='r')
+        self.rows = np.load(prefix + '.rows.npy', mmap_mode='r')
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, words):
+        '''
+        Rows of words in the matrix, -1 for words without a vector.
+        '''
+        hashes = hash_words(words)
+        if not len(self.hashes):
+            return np.full(len(words), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.hashes, hashes), len(self.hashes) - 1)
+        found = self.hashes[pos] == hashes
+        return np.where(found, self.rows[pos], -1)
+
+    def gather(self, rows):
+        '''
+        Vectors of rows, read from the mapped matrix in file order.
+        '''
+        order = np.argsort(rows, kind='stable')
+        out = np.empty((len(rows), self.dim), dtype=np.float32)
+        out[order] = self.vectors[rows[order]]
+        return out
+
+
+def oov_stats(itow, found, wc=None, n_top=20, skip=('<pad>', '<unk>')):
+    '''
+    Coverage of the vocabulary, and of the corpus tokens if the word counts wc are given.
+    '''
+    idx = [i for i, w in enumerate(itow) if w not in skip]
+    found = found[idx]
+    stats = {'n_vocab': len(idx), 'n_found': int(found.sum())}
+    stats['vocab_coverage'] = stats['n_found'] / max(1, len(idx))
+    if wc is not None:
+        counts = np.fromiter((wc.get(itow[i], 0) for i in idx), dtype=np.int64, count=len(idx))
+        stats['token_coverage'] = counts[found].sum().item() / max(1, counts.sum().item())
+        oov = np.flatnonzero(~found)
+        top = oov[np.argsort(-counts[oov], kind='stable')[:n_top]]
+        stats['top_oov'] = [(itow[idx[i]], counts[i].item()) for i in top]
+    return stats
+
+
+def build_matrix(emb, itow, wc=None, padding_idx=0, seed=0):
+    '''
+    (len(itow), emb.dim) float32 initialization of the embedding layer, and its OOV stats.
+    Words without a vector are drawn from a normal with the mean and std of the found vectors,
+    the padding row is zero.
+    '''
+    rows = emb.lookup(itow)
+    found = rows >= 0
+    matrix = np.empty((len(itow), emb.dim), dtype=np.float32)
+    matrix[found] = emb.gather(rows[found])
+
+    rng = np.random.default_rng(seed)
+    if found.any():
+        mean, std = matrix[found].mean(0), matrix[found].std(0)
+    else:
+        mean, std = np.zeros(emb.dim), np.ones(emb.dim)
+    matrix[~found] = rng.normal(mean, std, size=((~found).sum(), emb.dim))
+    if padding_idx is not None:
+        matrix[padding_idx] = 0
+    return matrix, oov_stats(itow, found, wc)
+
+
+def load_pretrained(prefix, itow, wc=None, emb_size=None):
+    '''
+    Embedding initialization for itow from a converted prefix, and its OOV stats.
+    '''
+    emb = PretrainedEmbeddings(prefix)
+    if emb_size is not None and emb_size != emb.dim:
+        raise ValueError('{} has {}-d vectors, the model expects {}'.format(
+            prefix, emb.dim, emb_size))
+    return build_matrix(emb, itow, wc)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert')
+    convert_parser.add_argument('txt_file')
+    convert_parser.add_argument('--prefix', help='output prefix, emb_/<txt_file name> if unset')
+    coverage_parser = subparsers.add_parser('coverage')
+    coverage_parser.add_argument('prefix')
+    coverage_parser.add_argument('data_file')
+    args = parser.parse_args(argv)
+
+    if args.command == 'convert':
+        meta = convert(args.txt_file, args.prefix)
+        print(json.dumps(meta))
+    elif args.command == 'coverage':
+        with open(args.data_file, 'rb') as f:
+            data = pickle.load(f)
+        _, stats = load_pretrained(args.prefix, data['itow'], data.get('wc'))
+        print(json.dumps(stats, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+import numpy as np
+import torch
+
+
+def _to_numpy(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach().float().cpu().numpy()
+    return np.asarray(x)
+
+
+def threshold_sweep(labels, preds, thresholds):
+    '''
+    Precision, recall and F1 of (preds >= threshold) for every threshold, from a single sort
+    and cumulative label counts. Undefined ratios are 0, as in sklearn.
+    '''
+    labels = np.asarray(labels)
+    order = np.argsort(preds, kind='mergesort')
+    sorted_preds = np.asarray(preds)[order]
+    # positives among the i lowest predictions
+    cum_pos = np.concatenate(([0], np.cumsum(labels[order] > 0)))
+    n_pos = cum_pos[-1]
+
+    below = np.searchsorted(sorted_preds, thresholds, side='left')
+    n_pred_pos = len(sorted_preds) - below
+    tp = n_pos - cum_pos[below]
+    return _prf(tp, n_pred_pos, n_pos)
+
+
+def _prf(tp, n_pred_pos, n_pos):
+    tp = tp.astype(np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        precision = np.where(n_pred_pos > 0, tp / n_pred_pos, 0.)
+        recall = np.where(n_pos > 0, tp / n_pos, 0.)
+        f1 = np.where(n_pred_pos + n_pos > 0, 2 * tp / (n_pred_pos + n_pos), 0.)
+    return precision, recall, f1
+
+
+def f1_score(labels, preds, threshold=0.5):
+    return threshold_sweep(labels, preds, [threshold])[2][0].item()
+
+
+def roc_auc_score(labels, preds):
+    '''
+    Exact ROC-AUC as the Mann-Whitney U statistic, ties counted as half.
+    '''
+    labels = np.asarray(labels) > 0
+    n_pos = np.count_nonzero(labels)
+    n_neg = len(labels) - n_pos
+    if not n_pos or not n_neg:
+        raise ValueError('ROC-AUC is undefined with a single class')
+    _, inverse, counts = np.unique(preds, return_inverse=True, return_counts=True)
+    avg_ranks = np.cumsum(counts) - (counts - 1) / 2
+    rank_sum = avg_ranks[inverse][labels].sum()
+    return ((rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)).item()
+
+
+class StreamingMetrics:
+    '''
+    Accumulates masked sentence predictions batch by batch on the host.
+
+    By default predictions are kept as compact arrays, along with the sentence masks they were
+    selected by, and every metric is exact. With n_bins,
+    only per-bin positive and negative counts are kept, memory stays O(n_bins) whatever the
+    dataset size, ROC-AUC treats predictions in the same bin as ties and thresholds are exact
+    on bin edges.
+    '''
+    def __init__(self, n_bins=None):
+        self.n_bins = n_bins
+        self._labels = []
+        self._preds = []
+        self._masks = []
+        if n_bins:
+            self.hist_pos = np.zeros(n_bins, dtype=np.int64)
+            self.hist_neg = np.zeros(n_bins, dtype=np.int64)
+
+    def update(self, preds, labels, masks=None):
+        '''
+        preds are probabilities, entries with a zero mask are dropped.
+        '''
+        preds, labels = _to_numpy(preds).ravel(), _to_numpy(labels).ravel()
+        if masks is not None:
+            masks = _to_numpy(masks).ravel() != 0
+            preds, labels = preds[masks], labels[masks]
+        else:
+            masks = np.ones(len(preds), dtype=bool)
+        labels = labels > 0
+
+        if self.n_bins:
+            bins = np.minimum((preds * self.n_bins).astype(np.int64), self.n_bins - 1)
+            self.hist_pos += np.bincount(bins[labels], minlength=self.n_bins)
+            self.hist_neg += np.bincount(bins[~labels], minlength=self.n_bins)
+        else:
+            self._preds.append(preds.astype(np.float32))
+            self._labels.append(labels.astype(np.uint8))
+            self._masks.append(masks.astype(np.uint8))
+
+    def _concat(self):
+        if len(self._preds) > 1:
+            self._preds = [np.concatenate(self._preds)]
+            self._labels = [np.concatenate(self._labels)]
+            self._masks = [np.concatenate(self._masks)]
+
+    @property
+    def preds(self):
+        if self.n_bins:
+            raise ValueError('Predictions are not kept with n_bins')
+        self._concat()
+        return self._preds[0] if self._preds else np.zeros(0, dtype=np.float32)
+
+    @property
+    def labels(self):
+        if self.n_bins:
+            raise ValueError('Labels are not kept with n_bins')
+        self._concat()
+        return self._labels[0] if self._labels else np.zeros(0, dtype=np.uint8)
+
+    @property
+    def masks(self):
+        '''
+        Masks over every sentence slot, preds and labels hold the nonzero ones in order.
+        '''
+        if self.n_bins:
+            raise ValueError('Masks are not kept with n_bins')
+        self._concat()
+        return self._masks[0] if self._masks else np.zeros(0, dtype=np.uint8)
+
+    def state_dict(self):
+        if self.n_bins:
+            return {'n_bins': self.n_bins, 'hist_pos': self.hist_pos, 'hist_neg': self.hist_neg}
+        return {'preds': self.preds, 'labels': self.labels, 'masks': self.masks}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        n_bins = int(state['n_bins']) if 'n_bins' in state else None
+        scores = cls(n_bins)
+        if n_bins:
+            scores.hist_pos = np.asarray(state['hist_pos'], dtype=np.int64)
+            scores.hist_neg = np.asarray(state['hist_neg'], dtype=np.int64)
+        else:
+            scores._preds = [np.asarray(state['preds'], dtype=np.float32)]
+            scores._labels = [np.asarray(state['labels'], dtype=np.uint8)]
+            scores._masks = [np.asarray(state['masks'], dtype=np.uint8)]
+        return scores
+
+    def threshold_sweep(self, thresholds):
+        if not self.n_bins:
+            return threshold_sweep(self.labels, self.preds, thresholds)
+        # predictions counted from the first bin whose lower edge is >= threshold
+        first_bin = np.ceil(np.asarray(thresholds) * self.n_bins - 1e-6).astype(np.int64)
+        first_bin = np.clip(first_bin, 0, self.n_bins)
+        cum_pos = np.concatenate((np.cumsum(self.hist_pos[::-1])[::-1], [0]))
+        cum_neg = np.concatenate((np.cumsum(self.hist_neg[::-1])[::-1], [0]))
+        tp = cum_pos[first_bin]
+        return _prf(tp, tp + cum_neg[first_bin], cum_pos[0])
+
+    def f1(self, threshold=0.5):
+        return self.threshold_sweep([threshold])[2][0].item()
+
+    def roc_auc(self, exact=False):
+        if not self.n_bins:
+            return roc_auc_score(self.labels, self.preds)
+        if exact:
+            raise ValueError('Exact ROC-AUC needs StreamingMetrics without n_bins')
+        n_pos, n_neg = self.hist_pos.sum(), self.hist_neg.sum()
+        if not n_pos or not n_neg:
+            raise ValueError('ROC-AUC is undefined with a single class')
+        # negatives below each bin, plus half of the same-bin pairs as ties
+        neg_below = np.cumsum(self.hist_neg) - self.hist_neg
+        wins = (self.hist_pos * (neg_below + self.hist_neg / 2)).sum()
+        return (wins / (n_pos * n_neg)).item()
@@ -0,0 +1,262 @@
+import os
+
+from nltk.tokenize import word_tokenize
+import numpy as np
+import torch
+
+from dataset import get_max_n_chars, get_max_n_keys
+from model import SpoilerNet
+from paramstore import ParamStore
+from textproc import WordIndex, get_sent_words
+
+
+class DfIdfTable:
+    '''
+    Scaled DF-IDF of (book, word) pairs as seen in a preprocessed artifact.
+
+    New reviews have no corpus statistics of their own, so a word takes the value it
+    had for the same book in the artifact. Unseen pairs fall back to 0., the mean of the
+    standardized values.
+    '''
+    def __init__(self,
+                 doc_label_sents,
+                 doc_df_idf,
+                 doc_artwork,
+                 vocab_size,
+                 unk_idx=1,
+                 n_hash_buckets=0):
+        self.vocab_size = vocab_size
+        self.book_index = {}
+        self.unk_value = 0.
+
+        keys, values = [], []
+        for label_sents, sents_df_idf, book_id in zip(doc_label_sents, doc_df_idf, doc_artwork):
+            offset = self.book_index.setdefault(book_id, len(self.book_index)) * vocab_size
+            for (_, sent), sent_df_idf in zip(label_sents, sents_df_idf):
+                keys.extend(offset + w for w in sent)
+                values.extend(sent_df_idf)
+        keys = np.array(keys, dtype=np.int64)
+        values = np.array(values, dtype=np.float32)
+
+        word_ids = keys % vocab_size
+        unk = np.nonzero((word_ids == unk_idx) | (word_ids >= vocab_size - n_hash_buckets))[0]
+        if len(unk):
+            self.unk_value = values[unk[0]].item()
+
+        self.keys, first = np.unique(keys, return_index=True)
+        self.values = values[first]
+
+    @classmethod
+    def from_artifact(cls, data):
+        return cls(data['doc_label_sents'],
+                   data['doc_df_idf'],
+                   data['doc_artwork'],
+                   len(data['itow']),
+                   n_hash_buckets=data.get('n_hash_buckets', 0))
+
+    def lookup(self, book_id, word_ids):
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        out = np.zeros(len(word_ids), dtype=np.float32)
+        if book_id not in self.book_index or not len(self.keys):
+            return out
+        keys = self.book_index[book_id] * self.vocab_size + word_ids
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[pos] == keys
+        out[found] = self.values[pos[found]]
+        return out
+
+
+class Featurizer:
+    '''
+    Turns raw review sentences into the padded arrays GoodreadsReviewsSpoilerDataset
+    produces, against a frozen vocabulary.
+    '''
+    def __init__(self,
+                 itow,
+                 ctoi,
+                 max_n_words,
+                 max_n_sents,
+                 book_keys,
+                 max_n_keys,
+                 dfidf_table=None,
+                 tokenize=get_sent_words,
+                 keywords=None,
+                 n_hash_buckets=0):
+        self.itow = itow
+        self.wtoi = WordIndex(itow, n_hash_buckets)
+        self.ctoi = ctoi
+        self.max_n_words = max_n_words
+        self.max_n_sents = max_n_sents
+        self.max_n_chars = get_max_n_chars(itow)
+        self.max_n_keys = max_n_keys
+        self.book_keys = book_keys
+        self.dfidf_table = dfidf_table
+        self.tokenize = tokenize
+        self.keywords = keywords
+        self.unk_idx = self.wtoi['<unk>']
+
+    @classmethod
+    def from_artifact(cls, data, max_n_words, max_n_sents, **kwargs):
+        book_keys = dict(zip(data['doc_artwork'], data['doc_key_encode']))
+        return cls(data['itow'],
+                   data['ctoi'],
+                   max_n_words,
+                   max_n_sents,
+                   book_keys,
+                   get_max_n_keys(data['doc_key_encode']),
+                   dfidf_table=DfIdfTable.from_artifact(data),
+                   n_hash_buckets=data.get('n_hash_buckets', 0),
+                   **kwargs)
+
+    def get_keys(self, book_id):
+        if book_id not in self.book_keys and self.keywords and book_id in self.keywords:
+            # same as dataprepgr.process, for books missing from the artifact
+            self.book_keys[book_id] = [
+                self.wtoi[word] for phase in self.keywords[book_id]
+                for word in word_tokenize(phase) if word in self.wtoi
+            ]
+        return self.book_keys.get(book_id) or [self.unk_idx]
+
+    def encode_keys(self, book_id):
+        keys = self.get_keys(book_id)
+        doc_ab = np.zeros(self.max_n_keys, dtype=np.int64)
+        ab_len = min((self.max_n_keys, len(keys)))
+        doc_ab[:ab_len] = keys[:ab_len]
+        return doc_ab
+
+    def encode_words(self, words, book_id=None):
+        '''
+        Output size: (max_n_words), (max_n_words), (max_n_words, max_n_chars)
+        '''
+        words = words[:self.max_n_words]
+        sent = np.zeros(self.max_n_words, dtype=np.int64)
+        sent_df_idf = np.zeros(self.max_n_words, dtype=np.float32)
+        sent_chars = np.zeros((self.max_n_words, self.max_n_chars), dtype=np.int64)
+
+        ids = [self.wtoi.encode(w) for w in words]
+        sent[:len(ids)] = ids
+        if self.dfidf_table is not None:
+            sent_df_idf[:len(ids)] = self.dfidf_table.lookup(book_id, ids)
+            # hashed words get the DF-IDF of <unk> too in dataprepgr.process_df_idf
+            unk = (sent[:len(ids)] == self.unk_idx) | (sent[:len(ids)] >= self.wtoi.bucket_start)
+            sent_df_idf[:len(ids)][unk] = self.dfidf_table.unk_value
+        for j, word in enumerate(words):
+            chars = [self.ctoi.get(c, 0) for c in word[:self.max_n_chars]]
+            sent_chars[j, :len(chars)] = chars
+        return sent, sent_df_idf, sent_chars
+
+    def encode_sentence(self, sentence, book_id=None):
+        return self.encode_words(self.tokenize(sentence), book_id)
+
+    def encode_doc(self, sentences, book_id=None):
+        '''
+        Output size: (max_n_sents, max_n_words), (max_n_sents, max_n_words),
+        (max_n_sents, max_n_words, max_n_chars), (max_n_keys), (max_n_sents)
+        '''
+        doc = np.zeros((self.max_n_sents, self.max_n_words), dtype=np.int64)
+        doc_df_idf = np.zeros((self.max_n_sents, self.max_n_words), dtype=np.float32)
+        doc_chars = np.zeros((self.max_n_sents, self.max_n_words, self.max_n_chars),
+                             dtype=np.int64)
+        doc_len_mask = np.zeros(self.max_n_sents, dtype=np.float32)
+        for i, sentence in enumerate(sentences[:self.max_n_sents]):
+            doc[i], doc_df_idf[i], doc_chars[i] = self.encode_sentence(sentence, book_id)
+            doc_len_mask[i] = 1
+        return doc, doc_df_idf, doc_chars, self.encode_keys(book_id), doc_len_mask
+
+
+def build_model(params, char_vocab_size, **kwargs):
+    return SpoilerNet(cell_dim=params['cell_dim'],
+                      att_dim=params['att_dim'],
+                      vocab_size=params['vocab_size'],
+                      emb_size=params['emb_size'],
+                      attent_type=params['attent_type'],
+                      use_idf=params['use_idf'],
+                      char_emb_size=params['char_emb_size'],
+                      char_cell_dim=params['char_cell_dim'],
+                      use_char=params['use_char'],
+                      char_vocab_size=char_vocab_size,
+                      emb_cutoffs=params.get('emb_cutoffs'),
+                      emb_div=params.get('emb_div', 4),
+                      sparse_emb=params.get('sparse_emb', False),
+                      word_encoder=params.get('word_encoder', 'gru'),
+                      **kwargs)
+
+
+def load_model(model_id, char_vocab_size, device='cpu', model_dir='model_', paramstore=None,
+               **kwargs):
+    paramstore = ParamStore() if paramstore is None else paramstore
+    params = paramstore[model_id]
+    if params is None:
+        raise KeyError('Unknown model {}'.format(model_id))
+    model = build_model(params, char_vocab_size, **kwargs)
+    model.load_state_dict(
+        torch.load(os.path.join(model_dir, model_id + '.pt'), map_location=device))
+    model.to(device)
+    model.eval()
+    return model, params
+
+
+class StreamingSession:
+    '''
+    Scores a review incrementally as its sentences arrive.
+
+    Each update runs the word-level encoder over the new sentence only and advances
+    sent_encoder by one step from the cached state, so its cost does not depend on how
+    long the review already is. The new sentence is scored as if the review ended there;
+    rescore() runs the full bidirectional sent_encoder over every sentence so far.
+    '''
+    def __init__(self, model, featurizer, book_id=None):
+        self.model = model
+        self.featurizer = featurizer
+        self.book_id = book_id
+        self.device = next(model.parameters()).device
+
+        model.eval()
+        self.ab_mv = None
+        if model.attent_type == "coAtt":
+            doc_ab = torch.from_numpy(featurizer.encode_keys(book_id)).unsqueeze(0)
+            with torch.no_grad():
+                self.ab_mv = model.project_keywords(doc_ab.to(self.device), [book_id])
+        self.reset()
+
+    def reset(self):
+        self.word_h = self.model.init_hidden(1).to(self.device)
+        self.fwd_h = torch.zeros(1, self.model.cell_dim, device=self.device)
+        self.sentlv_sent_encs = []
+
+    def __len__(self):
+        return len(self.sentlv_sent_encs)
+
+    def add_words(self, words):
+        sent, sent_df_idf, sent_chars = self.featurizer.encode_words(words, self.book_id)
+        sent = torch.from_numpy(sent).unsqueeze(1).to(self.device)
+        sent_df_idf = torch.from_numpy(sent_df_idf).unsqueeze(1).to(self.device)
+        sent_chars = torch.from_numpy(sent_chars).unsqueeze(1).to(self.device)
+
+        with torch.no_grad():
+            sentlv_sent_enc, self.word_h = self.model.encode_sentence(
+                sent, self.word_h, sent_df_idf, sent_chars, self.ab_mv)
+            doclv_sent_enc, self.fwd_h = self.model.sent_encoder_step(sentlv_sent_enc, self.fwd_h)
+            pred = self.model.out_linear(doclv_sent_enc)
+        self.sentlv_sent_encs.append(sentlv_sent_enc)
+        return torch.sigmoid(pred).item()
+
+    def add_sentence(self, sentence):
+        '''
+        Returns the spoiler probability of the new sentence.
+        '''
+        return self.add_words(self.featurizer.tokenize(sentence))
+
+    def rescore(self):
+        '''
+        Returns the spoiler probabilities of all sentences so far, using both directions of
+        sent_encoder over the whole review.
+        '''
+        if not self.sentlv_sent_encs:
+            return []
+        with torch.no_grad():
+            sentlv_sent_encs = torch.stack(self.sentlv_sent_encs)
+            sent_h0 = self.model.init_hidden(1).to(self.device)
+            doclv_sent_enc, _ = self.model.sent_encoder(sentlv_sent_encs, sent_h0)
+            preds = self.model.out_linear(doclv_sent_enc).view(-1)
+        return torch.sigmoid(preds).tolist()
@@ -0,0 +1,108 @@
+'''
+Load test for server.py: concurrent keep-alive clients posting reviews to /score.
+'''
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import random
+import time
+
+import numpy as np
+
+
+def load_reviews(fp, limit):
+    reviews = []
+    with gzip.open(fp, 'rt') as fin:
+        for line in itertools.islice(fin, limit):
+            d = json.loads(line)
+            reviews.append({
+                'book_id': d['book_id'],
+                'sentences': [label_sent[1] for label_sent in d['review_sentences']]
+            })
+    return reviews
+
+
+def synthetic_reviews(n, seed=0):
+    rng = random.Random(seed)
+    words = ['book', 'plot', 'ending', 'character', 'loved', 'twist', 'dies', 'chapter', 'read']
+    return [{
+        'book_id': str(rng.randint(0, 100)),
+        'sentences': [
+            ' '.join(rng.choices(words, k=rng.randint(3, 20))) for _ in range(rng.randint(1, 30))
+        ]
+    } for _ in range(n)]
+
+
+async def request(reader, writer, method, path, obj=None):
+    body = json.dumps(obj).encode() if obj is not None else b''
+    writer.write('{} {} HTTP/1.1\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.
+                 format(method, path, len(body)).encode() + body)
+    await writer.drain()
+    status = await reader.readline()
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    payload = await reader.readexactly(int(headers['content-length']))
+    return status.decode().split(' ', 1)[1].strip(), json.loads(payload)
+
+
+async def client(host, port, reviews, n_requests, latencies, errors):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for review in itertools.islice(itertools.cycle(reviews), n_requests):
+            start_time = time.perf_counter()
+            status, _ = await request(reader, writer, 'POST', '/score', review)
+            latencies.append((time.perf_counter() - start_time) * 1000)
+            if not status.startswith('200'):
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run(args, reviews):
+    latencies, errors = [], []
+    per_client = args.requests // args.concurrency
+    start_time = time.perf_counter()
+    await asyncio.gather(*[
+        client(args.host, args.port, random.Random(i).sample(reviews, len(reviews)), per_client,
+               latencies, errors) for i in range(args.concurrency)
+    ])
+    elapsed = time.perf_counter() - start_time
+
+    print('{} requests | {} errors | {:.1f} requests/sec'.format(len(latencies), len(errors),
+                                                                len(latencies) / elapsed))
+    print('latency ms | p50 {:.1f} | p95 {:.1f} | p99 {:.1f} | max {:.1f}'.format(
+        *np.percentile(latencies, [50, 95, 99, 100])))
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, metrics = await request(reader, writer, 'GET', '/metrics')
+    writer.close()
+    for name, value in metrics.items():
+        print('{}: {}'.format(name, json.dumps(value)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--reviews', help='gzip JSON lines review dump, synthetic if omitted')
+    parser.add_argument('--n-reviews', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--requests', type=int, default=5000)
+    args = parser.parse_args(argv)
+
+    if args.reviews:
+        reviews = load_reviews(args.reviews, args.n_reviews)
+    else:
+        reviews = synthetic_reviews(args.n_reviews)
+    asyncio.run(run(args, reviews))
+
+
+if __name__ == '__main__':
+    main()
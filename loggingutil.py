@@ -1,6 +1,13 @@
+import atexit
+import copy
+import json
 import logging
+import os
+import queue
 import sys
+import threading
 from logging import FileHandler
+from logging.handlers import QueueHandler, QueueListener
 FORMATTER = logging.Formatter("%(asctime)s — %(name)s — %(levelname)s — %(message)s")
 LOG_FILE = "app.log"
 
@@ -11,16 +18,125 @@ def get_console_handler():
     return console_handler
 
 
-def get_file_handler():
-    file_handler = FileHandler(LOG_FILE)
-    file_handler.setFormatter(FORMATTER)
+def get_file_handler(fp=LOG_FILE, formatter=FORMATTER):
+    file_handler = FileHandler(fp)
+    file_handler.setFormatter(formatter)
     return file_handler
 
 
+class JsonFormatter(logging.Formatter):
+    '''
+    One JSON object per record: the time, the logger name and the items of a dict message.
+    '''
+    def format(self, record):
+        obj = {'time': record.created, 'logger': record.name}
+        if isinstance(record.msg, dict):
+            obj.update(record.msg)
+        else:
+            obj['message'] = record.getMessage()
+        return json.dumps(obj)
+
+
+class _ChannelQueueHandler(QueueHandler):
+    def __init__(self, channel, keep_msg):
+        super().__init__(None)
+        self.channel = channel
+        self.keep_msg = keep_msg
+
+    def prepare(self, record):
+        if self.keep_msg:
+            # leave dict messages to the JsonFormatter of the listener
+            return copy.copy(record)
+        return super().prepare(record)
+
+    def enqueue(self, record):
+        # a forked child gets a copy of the queue without the listener thread
+        if self.channel.pid != os.getpid():
+            self.channel.start()
+        super().enqueue(record)
+
+
+class _Channel:
+    '''
+    Handlers run in a QueueListener thread, loggers only put records on a queue.
+    '''
+    def __init__(self, handlers, keep_msg=False):
+        self.handlers = handlers
+        self.queue_handler = _ChannelQueueHandler(self, keep_msg)
+        self.listener = None
+        self.start()
+
+    def start(self):
+        self.pid = os.getpid()
+        self.queue_handler.queue = queue.SimpleQueue()
+        self.listener = QueueListener(self.queue_handler.queue,
+                                      *self.handlers,
+                                      respect_handler_level=True)
+        self.listener.start()
+
+    def stop(self):
+        if self.listener is not None and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            # restarted by the next record
+            self.pid = None
+        for handler in self.handlers:
+            handler.flush()
+
+
+_lock = threading.Lock()
+_log_channel = None
+_metrics_channels = {}
+
+
+def _get_channel():
+    global _log_channel
+    with _lock:
+        if _log_channel is None:
+            _log_channel = _Channel([get_console_handler(), get_file_handler()])
+        return _log_channel
+
+
 def get_logger(logger_name):
+    '''
+    Loggers share one console and app.log handler pair per process, written from a background
+    thread. Repeated calls return the same logger without adding handlers.
+    '''
     logger = logging.getLogger(logger_name)
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(get_console_handler())
-    logger.addHandler(get_file_handler())
+    queue_handler = _get_channel().queue_handler
+    if queue_handler not in logger.handlers:
+        logger.addHandler(queue_handler)
     logger.propagate = False
     return logger
+
+
+def get_metrics_logger(name, fp):
+    '''
+    JSON lines channel for structured numbers, e.g. logger.info({'step': 1, 'loss': 0.5}) appends
+    {"time": ..., "logger": "metrics.<name>", "step": 1, "loss": 0.5} to fp.
+    '''
+    logger = logging.getLogger('metrics.' + name)
+    with _lock:
+        channel = _metrics_channels.get(fp)
+        if channel is None:
+            channel = _Channel([get_file_handler(fp, JsonFormatter())], keep_msg=True)
+            _metrics_channels[fp] = channel
+    logger.setLevel(logging.INFO)
+    if channel.queue_handler not in logger.handlers:
+        logger.addHandler(channel.queue_handler)
+    logger.propagate = False
+    return logger
+
+
+def shutdown():
+    '''
+    Writes out the queued records and stops the listener threads, also run at exit.
+    '''
+    with _lock:
+        for channel in [_log_channel] + list(_metrics_channels.values()):
+            if channel is not None:
+                channel.stop()
+
+
+atexit.register(shutdown)
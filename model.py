@@ -1,7 +1,11 @@
+import collections
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from profiling import StageTimer
+
 
 class WordAttentionLayer(nn.Module):
     def __init__(self, in_dim, att_dim):
@@ -17,7 +21,8 @@ class WordAttentionLayer(nn.Module):
         '''
         mu = torch.tanh(self.linear(x))
         v_mu = torch.sum(mu * self.v, dim=2)
-        att_w = F.softmax(v_mu, dim=0)
+        # softmax in fp32 under autocast
+        att_w = F.softmax(v_mu.float(), dim=0)
         return torch.sum(att_w.unsqueeze(2) * x, dim=0)
 
 
@@ -29,24 +34,125 @@ class CoWordAttentionLayer(nn.Module):
         self.linear_sent = nn.Linear(sent_in_dim, att_dim)
         # self.v = torch.tensor(att_dim, dtype=torch.float32, requires_grad=True)
 
-    def forward(self, x, ab):
+    def project_ab(self, ab):
+        '''
+        Input size ab: (batch_size, max_n_key, in_dim)
+        Output size: (batch_size, att_dim, max_n_key)
+        '''
+        mv = torch.tanh(self.linear_ab(ab))
+        return mv.permute(0, 2, 1)
+
+    def forward(self, x, ab=None, mv=None):
         '''
         Input size x: (seq_len, batch_size, in_dim)
         Input size ab: (batch_size, max_n_key, in_dim)
+        Input size mv: (batch_size, att_dim, max_n_key), precomputed by project_ab
         Output size: (batch_size, in_dim)
         '''
         mu = torch.tanh(self.linear_sent(x))
-        mv = torch.tanh(self.linear_ab(ab))
+        if mv is None:
+            mv = self.project_ab(ab)
 
         mu = mu.permute(1, 0, 2)
-        mv = mv.permute(0, 2, 1)
         att_w = mu.matmul(mv)  # batch, seq_len, max_n_key
 
         att_w = torch.max(att_w, 2)[0]
 
-        att_w = F.softmax(att_w, dim=1)
+        att_w = F.softmax(att_w.float(), dim=1)
         output = att_w.unsqueeze(1).matmul(x.permute(1, 0, 2))
-        return output.squeeze()
+        return output.squeeze(1)
+
+
+class KeywordProjectionCache:
+    '''
+    LRU cache of projected book keywords, keyed by book id, keyword count, dtype and device.
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key):
+        mv = self._cache.get(key)
+        if mv is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return mv
+
+    def put(self, key, mv):
+        self._cache[key] = mv
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class TieredEmbedding(nn.Module):
+    '''
+    Embedding of ids sorted by decreasing frequency, in tiers split at cutoffs. Tier i has
+    emb_size // div**i dimensions, projected to emb_size, so rare words cost fewer parameters
+    and optimizer state.
+    '''
+    def __init__(self, vocab_size, emb_size, cutoffs, div=4, padding_idx=0, sparse=False):
+        super().__init__()
+        self.emb_size = emb_size
+        self.bounds = list(zip([0] + list(cutoffs), list(cutoffs) + [vocab_size]))
+        if any(start >= end for start, end in self.bounds):
+            raise ValueError('cutoffs must increase within (0, {}): {}'.format(vocab_size, cutoffs))
+        self.tiers = nn.ModuleList()
+        self.projs = nn.ModuleList()
+        for i, (start, end) in enumerate(self.bounds):
+            dim = max(1, emb_size // div**i)
+            self.tiers.append(
+                nn.Embedding(end - start,
+                             dim,
+                             padding_idx if i == 0 else None,
+                             sparse=sparse))
+            # the head tier has emb_size dimensions, no projection
+            self.projs.append(nn.Identity() if i == 0 else nn.Linear(dim, emb_size, bias=False))
+
+    def forward(self, ids):
+        '''
+        Input size: any
+        Output size: (*ids.size(), emb_size)
+        '''
+        # the head tier holds most of the tokens, look up all ids in it and overwrite the rest
+        out = self.tiers[0](ids.clamp(max=self.bounds[0][1] - 1))
+        for (start, end), tier, proj in zip(self.bounds[1:], self.tiers[1:], self.projs[1:]):
+            mask = (ids >= start) & (ids < end)
+            if mask.any():
+                out = out.index_put((mask, ), proj(tier(ids[mask] - start)).to(out.dtype))
+        return out
+
+
+class ConvWordEncoder(nn.Module):
+    '''
+    Drop-in for the bidirectional word GRU: a convolution over each window of kernel_size
+    words, with 2 * cell_dim channels. Windows are independent, so all positions are computed
+    at once instead of step by step. The hidden state is passed through unchanged.
+    '''
+    def __init__(self, in_dim, cell_dim, kernel_size=3):
+        super().__init__()
+        self.conv = nn.Conv1d(in_dim, 2 * cell_dim, kernel_size, padding=kernel_size // 2)
+
+    def forward(self, x, h0=None):
+        '''
+        Input size: (seq_len, batch, in_dim)
+        Output size: (seq_len, batch, 2 * cell_dim), h0
+        '''
+        out = F.relu(self.conv(x.permute(1, 2, 0)))
+        return out.permute(2, 0, 1), h0
 
 
 class SpoilerNet(nn.Module):
@@ -62,7 +168,12 @@ class SpoilerNet(nn.Module):
                  use_char,
                  char_vocab_size,
                  dropout_rate=0.5,
-                 pretrained_emb=None):
+                 pretrained_emb=None,
+                 ab_cache_size=0,
+                 emb_cutoffs=None,
+                 emb_div=4,
+                 sparse_emb=False,
+                 word_encoder='gru'):
         super().__init__()
 
         self.cell_dim = cell_dim
@@ -73,7 +184,18 @@ class SpoilerNet(nn.Module):
         self.use_char = use_char
         self.attent_type = attent_type
 
-        self.emb_layer = nn.Embedding(vocab_size, emb_size, 0)
+        if emb_cutoffs:
+            if pretrained_emb is not None:
+                raise ValueError('pretrained_emb needs a single embedding table, not emb_cutoffs')
+            self.emb_layer = TieredEmbedding(vocab_size, emb_size, emb_cutoffs, emb_div, 0,
+                                             sparse_emb)
+        else:
+            # sparse gradients need torch.optim.SparseAdam, see trainer.make_optimizer
+            self.emb_layer = nn.Embedding(vocab_size, emb_size, 0, sparse=sparse_emb)
+        if pretrained_emb is not None:
+            # (vocab_size, emb_size), e.g. from embeddings.load_pretrained
+            with torch.no_grad():
+                self.emb_layer.weight.copy_(torch.as_tensor(pretrained_emb))
         # self.sentlv_word_emb_size = emb_size + 1 if use_idf else emb_size
         if use_idf and use_char:
             self.sentlv_word_emb_size = emb_size + char_emb_size + 1
@@ -86,7 +208,12 @@ class SpoilerNet(nn.Module):
 
         print("sentlv_word_emb_size,", self.sentlv_word_emb_size)
 
-        self.word_encoder = nn.GRU(self.sentlv_word_emb_size, cell_dim, bidirectional=True)
+        if word_encoder == 'conv':
+            self.word_encoder = ConvWordEncoder(self.sentlv_word_emb_size, cell_dim)
+        elif word_encoder == 'gru':
+            self.word_encoder = nn.GRU(self.sentlv_word_emb_size, cell_dim, bidirectional=True)
+        else:
+            raise ValueError('Unknown word_encoder {}'.format(word_encoder))
 
         if attent_type == "coAtt":
             self.word_att = CoWordAttentionLayer(emb_size, 2 * cell_dim, att_dim)
@@ -103,33 +230,64 @@ class SpoilerNet(nn.Module):
 
         self.drop = nn.Dropout(dropout_rate)
 
+        # keyword projections only depend on the book, memoize them for inference
+        self.ab_cache = KeywordProjectionCache(ab_cache_size) if ab_cache_size else None
+
+        # forward stage timings, enabled by the training loop when instrumenting
+        self.timer = StageTimer(enabled=False)
+
+    def train(self, mode=True):
+        if mode and self.ab_cache is not None:
+            self.ab_cache.clear()
+        return super().train(mode)
+
+    def load_state_dict(self, *args, **kwargs):
+        if self.ab_cache is not None:
+            self.ab_cache.clear()
+        return super().load_state_dict(*args, **kwargs)
+
+    def _apply(self, *args, **kwargs):
+        # to(), cuda(), half() and the like, cached projections keep the old device and dtype
+        if self.ab_cache is not None:
+            self.ab_cache.clear()
+        return super()._apply(*args, **kwargs)
+
     def init_hidden(self, batch_size):
         return torch.zeros(2, batch_size, self.cell_dim)
 
-    def forward(self, x, word_h0, sent_h0, x_df_idf=None, chars=None, doc_ab=None):
+    def project_keywords(self, doc_ab, book_ids=None):
         '''
-        x size: (batch, sent_seq_len, word_seq_len)
-        chars: (batch, sent_seq_len, word_seq_len, max_n_chars)
         doc_ab: (batch, max_n_key)
+        book_ids: optional sequence of batch book ids, enables the LRU cache in eval mode
+        Output size: (batch, att_dim, max_n_key)
+        '''
+        if self.ab_cache is None or self.training or book_ids is None:
+            return self.word_att.project_ab(self.emb_layer(doc_ab))
+
+        # the projection dtype differs under autocast, and the device after a move
+        device_type = doc_ab.device.type
+        dtype = (torch.get_autocast_dtype(device_type) if torch.is_autocast_enabled(device_type)
+                 else self.word_att.linear_ab.weight.dtype)
+        keys = [(book_id, doc_ab.size(1), dtype, doc_ab.device) for book_id in book_ids]
+        mvs = [self.ab_cache.get(key) for key in keys]
+        miss_idx = [i for i, mv in enumerate(mvs) if mv is None]
+        if miss_idx:
+            miss_mv = self.word_att.project_ab(self.emb_layer(doc_ab[miss_idx])).detach()
+            for i, mv in zip(miss_idx, miss_mv):
+                self.ab_cache.put(keys[i], mv)
+                mvs[i] = mv
+        return torch.stack(mvs)
+
+    def encode_sentence(self, sent, word_h0, sent_df_idf=None, sent_chars=None, ab_mv=None):
+        '''
+        sent size: (word_seq_len, batch)
+        sent_df_idf: (word_seq_len, batch)
+        sent_chars: (word_seq_len, batch, max_n_chars)
+        ab_mv: (batch, att_dim, max_n_key), from project_keywords
+        Output size: (batch, num_directions * hidden_size), word_h0
         '''
-        doc_ab = self.emb_layer(doc_ab)
-
-        x = x.permute(1, 0, 2)
-        # (sent_seq_len, batch, word_seq_len)
-        if self.use_idf:
-            x_df_idf = x_df_idf.permute(1, 0, 2)
         if self.use_char:
-            chars = chars.permute(1, 0, 2, 3)
-
-        sentlv_sent_enc_list = []
-        for i in range(len(x)):
-            sent = x[i]
-            sent = sent.permute(1, 0)
-            # (word_seq_len, batch)
-
-            if self.use_char:
-                sent_chars = chars[i].permute(1, 0, 2)
-                # (word_seq_len, batch, max_n_chars)
+            with self.timer.stage('char'):
                 word_seq_len = sent_chars.size()[0]
                 sent_out = []
 
@@ -149,13 +307,10 @@ class SpoilerNet(nn.Module):
                 char_sent_out = torch.stack(sent_out, dim=0)
                 # (word_seq_len, batch, emb)
 
-            if self.use_idf:
-                sent_df_idf = x_df_idf[i]
-                sent_df_idf = sent_df_idf.permute(1, 0).unsqueeze(2)
-
+        with self.timer.stage('word_encoder'):
             word_emb = self.emb_layer(sent)
             if self.use_idf:
-                word_emb = torch.cat((word_emb, sent_df_idf), 2)
+                word_emb = torch.cat((word_emb, sent_df_idf.unsqueeze(2)), 2)
             if self.use_char:
                 word_emb = torch.cat((word_emb, char_sent_out), 2)
 
@@ -164,10 +319,59 @@ class SpoilerNet(nn.Module):
 
             sentlv_word_encs = self.drop(sentlv_word_encs)
 
+        with self.timer.stage('attention'):
             if self.attent_type == "coAtt":
-                sentlv_sent_enc = self.word_att(sentlv_word_encs, doc_ab)
+                sentlv_sent_enc = self.word_att(sentlv_word_encs, mv=ab_mv)
             else:
                 sentlv_sent_enc = self.word_att(sentlv_word_encs)
+        return sentlv_sent_enc, word_h0
+
+    def sent_encoder_step(self, sentlv_sent_enc, fwd_h):
+        '''
+        Advances the forward direction of sent_encoder by one sentence. The backward
+        direction is that of a document ending at this sentence, i.e. a single step from
+        a zero state.
+        sentlv_sent_enc: (batch, num_directions * hidden_size)
+        fwd_h: (batch, hidden_size)
+        Output size: (batch, num_directions * hidden_size), fwd_h
+        '''
+        enc = self.sent_encoder
+        fwd_h = torch.gru_cell(sentlv_sent_enc, fwd_h, enc.weight_ih_l0, enc.weight_hh_l0,
+                               enc.bias_ih_l0, enc.bias_hh_l0)
+        bwd_h = torch.gru_cell(sentlv_sent_enc, torch.zeros_like(fwd_h),
+                               enc.weight_ih_l0_reverse, enc.weight_hh_l0_reverse,
+                               enc.bias_ih_l0_reverse, enc.bias_hh_l0_reverse)
+        return torch.cat((fwd_h, bwd_h), 1), fwd_h
+
+    def forward(self, x, word_h0, sent_h0, x_df_idf=None, chars=None, doc_ab=None, book_ids=None):
+        '''
+        x size: (batch, sent_seq_len, word_seq_len)
+        chars: (batch, sent_seq_len, word_seq_len, max_n_chars)
+        doc_ab: (batch, max_n_key)
+        book_ids: (batch), only used to look up the keyword projection cache
+        '''
+        with self.timer.stage('attention'):
+            ab_mv = (self.project_keywords(doc_ab, book_ids)
+                     if self.attent_type == "coAtt" else None)
+
+        x = x.permute(1, 0, 2)
+        # (sent_seq_len, batch, word_seq_len)
+        if self.use_idf:
+            x_df_idf = x_df_idf.permute(1, 0, 2)
+        if self.use_char:
+            chars = chars.permute(1, 0, 2, 3)
+
+        sentlv_sent_enc_list = []
+        for i in range(len(x)):
+            sent = x[i]
+            sent = sent.permute(1, 0)
+            # (word_seq_len, batch)
+
+            sent_df_idf = x_df_idf[i].permute(1, 0) if self.use_idf else None
+            sent_chars = chars[i].permute(1, 0, 2) if self.use_char else None
+
+            sentlv_sent_enc, word_h0 = self.encode_sentence(sent, word_h0, sent_df_idf,
+                                                            sent_chars, ab_mv)
             # (batch, num_directions * hidden_size)
 
             sentlv_sent_enc_list.append(sentlv_sent_enc)
@@ -175,15 +379,16 @@ class SpoilerNet(nn.Module):
         sentlv_sent_encs = torch.stack(sentlv_sent_enc_list)
         # (sent_seq_len, batch, num_directions * hidden_size)
 
-        doclv_sent_enc, sent_h0 = self.sent_encoder(sentlv_sent_encs, sent_h0)
-        # (sent_seq_len, batch, num_directions * hidden_size)
+        with self.timer.stage('sent_encoder'):
+            doclv_sent_enc, sent_h0 = self.sent_encoder(sentlv_sent_encs, sent_h0)
+            # (sent_seq_len, batch, num_directions * hidden_size)
 
-        doclv_sent_enc = self.drop(doclv_sent_enc)
+            doclv_sent_enc = self.drop(doclv_sent_enc)
 
-        doclv_sent_enc = doclv_sent_enc.permute(1, 0, 2)
-        # (batch, sent_seq_len, num_directions * hidden_size)
+            doclv_sent_enc = doclv_sent_enc.permute(1, 0, 2)
+            # (batch, sent_seq_len, num_directions * hidden_size)
 
-        doclv_sent_enc = self.out_linear(doclv_sent_enc)
+            doclv_sent_enc = self.out_linear(doclv_sent_enc)
 
         doclv_sent_enc = doclv_sent_enc.view(-1)
         # (batch * sent_seq_len)
@@ -1,6 +1,8 @@
-import collections
-import os
+import argparse
+import collections.abc
 import json
+import os
+import sqlite3
 import uuid
 
 
@@ -12,7 +14,7 @@ class UUIDv4Gen:
         return str(uuid.uuid4())[:8]
 
 
-class JsonStore(collections.MutableMapping):
+class JsonStore(collections.abc.MutableMapping):
     def __init__(self, root_dir):
         super().__init__()
         self.root_dir = root_dir
@@ -43,7 +45,7 @@ class JsonStore(collections.MutableMapping):
             os.remove(fp)
 
     def __iter__(self):
-        raise NotImplementedError()
+        return iter(self.keys())
 
     def __len__(self):
         return len(self.keys())
@@ -60,19 +62,220 @@ class JsonStore(collections.MutableMapping):
         return keyset
 
     def items(self):
-        raise AttributeError()
+        return ((key, self[key]) for key in self.keys())
 
     def values(self):
-        raise AttributeError()
+        return (self[key] for key in self.keys())
 
     def get(self, key):
         return self[key]
 
 
+def _sql_value(value):
+    # scalars are stored as is (booleans as 0/1), anything else as its JSON text
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return json.dumps(value)
+
+
+class RunIndex:
+    '''
+    SQLite index of the runs of a ParamStore: one row per run indexed by model name, and one
+    (key, value) row per param and per metric, indexed by key and value. Lookups, filters and
+    sorted top-k queries go through the indices instead of reading every JSON file.
+    '''
+    schema = '''
+    CREATE TABLE IF NOT EXISTS runs (model_id TEXT PRIMARY KEY, model_name TEXT);
+    CREATE INDEX IF NOT EXISTS runs_model_name ON runs (model_name);
+    CREATE TABLE IF NOT EXISTS params (model_id TEXT, key TEXT, value,
+                                       PRIMARY KEY (model_id, key)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS params_key_value ON params (key, value);
+    CREATE TABLE IF NOT EXISTS metrics (model_id TEXT, key TEXT, value,
+                                        PRIMARY KEY (model_id, key)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS metrics_key_value ON metrics (key, value);
+    '''
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.is_new = not os.path.exists(fp)
+        self.conn = sqlite3.connect(fp, timeout=30)
+        with self.conn:
+            self.conn.executescript(self.schema)
+
+    def put(self, model_id, obj, metrics_key='metrics_'):
+        '''
+        Replaces the rows of model_id with the params and metrics of obj.
+        '''
+        obj = dict(obj)
+        metrics = obj.pop(metrics_key, None) or {}
+        model_name = model_id.rsplit('_', 1)[0]
+        with self.conn:
+            self._delete(model_id)
+            self.conn.execute('INSERT INTO runs VALUES (?, ?)', (model_id, model_name))
+            self.conn.executemany('INSERT INTO params VALUES (?, ?, ?)',
+                                  [(model_id, k, _sql_value(v)) for k, v in obj.items()])
+            self.conn.executemany('INSERT INTO metrics VALUES (?, ?, ?)',
+                                  [(model_id, k, _sql_value(v)) for k, v in metrics.items()])
+
+    def _delete(self, model_id):
+        for table in ('runs', 'params', 'metrics'):
+            self.conn.execute('DELETE FROM {} WHERE model_id = ?'.format(table), (model_id, ))
+
+    def delete(self, model_id):
+        with self.conn:
+            self._delete(model_id)
+
+    def clear(self):
+        with self.conn:
+            for table in ('runs', 'params', 'metrics'):
+                self.conn.execute('DELETE FROM {}'.format(table))
+
+    def __len__(self):
+        return self.conn.execute('SELECT COUNT(*) FROM runs').fetchone()[0]
+
+    def keys(self):
+        return {row[0] for row in self.conn.execute('SELECT model_id FROM runs')}
+
+    def query(self, where=None, order_by=None, descending=True, limit=None, model_name=None):
+        '''
+        model_ids whose params equal every item of where, sorted by the metric order_by, or by
+        the param order_by if no run has such a metric. Runs without it come last.
+
+        A filtered query starts from the (key, value) index of its first where item, or from the
+        model_name index, and looks up the other filters of each match by primary key, so it
+        only reads the matching runs. A sorted query without filters, or whose filters match
+        most runs, walks the (key, value) index of order_by in order instead and stops after
+        limit matching runs.
+        '''
+        if order_by is None:
+            return self._filter(where, limit, model_name)
+
+        table = 'metrics' if self.conn.execute('SELECT 1 FROM metrics WHERE key = ? LIMIT 1',
+                                               (order_by, )).fetchone() else 'params'
+        order = 'DESC' if descending else 'ASC'
+        if where or model_name is not None:
+            # the largest rowid bounds the number of runs, and is read from the end of the tree
+            n_runs = self.conn.execute('SELECT MAX(rowid) FROM runs').fetchone()[0] or 0
+            sql, args, cond, cond_args = self._filter_clauses(where, model_name)
+            n_matches = len(
+                self.conn.execute('SELECT 1 {} {} LIMIT ?'.format(' '.join(sql), cond),
+                                  args + cond_args + [n_runs // 2 + 1]).fetchall())
+            if n_matches <= n_runs // 2:
+                # sorts the matches only, runs without order_by (a NULL value) last
+                sql.append('LEFT JOIN {} s ON s.model_id = q.model_id AND s.key = ?'.format(table))
+                sql = ['SELECT q.model_id'] + sql + [
+                    cond, 'ORDER BY s.value IS NULL, s.value {}'.format(order)
+                ]
+                args += [order_by] + cond_args
+                if limit is not None:
+                    sql.append('LIMIT ?')
+                    args.append(limit)
+                return [row[0] for row in self.conn.execute(' '.join(sql), args)]
+
+        # CROSS JOIN keeps the index scan as the outer loop
+        sql = ['SELECT s.model_id FROM {} s'.format(table)]
+        args = []
+        self._join_filters(sql, args, 's', where, model_name)
+        sql.append('WHERE s.key = ? ORDER BY s.value {}'.format(order))
+        args.append(order_by)
+        if limit is not None:
+            sql.append('LIMIT ?')
+            args.append(limit)
+        model_ids = [row[0] for row in self.conn.execute(' '.join(sql), args)]
+        if limit is None or len(model_ids) < limit:
+            sql, args, cond, cond_args = self._filter_clauses(where, model_name)
+            sql = ['SELECT q.model_id'] + sql + [
+                cond, 'AND' if cond else 'WHERE',
+                'NOT EXISTS (SELECT 1 FROM {} s WHERE s.model_id = q.model_id AND s.key = ?)'.
+                format(table)
+            ]
+            args += cond_args + [order_by]
+            if limit is not None:
+                sql.append('LIMIT ?')
+                args.append(limit - len(model_ids))
+            model_ids += [row[0] for row in self.conn.execute(' '.join(sql), args)]
+        return model_ids
+
+    def _join_filters(self, sql, args, alias, where, model_name):
+        for i, (key, value) in enumerate((where or {}).items()):
+            sql.append('CROSS JOIN params p{0} ON p{0}.model_id = {1}.model_id AND p{0}.key = ? '
+                       'AND p{0}.value = ?'.format(i, alias))
+            args += [key, _sql_value(value)]
+        if model_name is not None:
+            sql.append('CROSS JOIN runs r ON r.model_id = {}.model_id AND r.model_name = ?'.format(
+                alias))
+            args.append(model_name)
+
+    def _filter_clauses(self, where, model_name):
+        '''
+        FROM clauses and WHERE condition, with their args, of the runs matching where and
+        model_name as q. The first where item, or else model_name, is looked up through its
+        index, the remaining filters are joined on model_id.
+        '''
+        where = dict(where or {})
+        if where:
+            key = next(iter(where))
+            value = where.pop(key)
+            sql, cond, cond_args = ['FROM params q'], 'WHERE q.key = ? AND q.value = ?', [
+                key, _sql_value(value)
+            ]
+        elif model_name is not None:
+            sql, cond, cond_args = ['FROM runs q'], 'WHERE q.model_name = ?', [model_name]
+            model_name = None
+        else:
+            return ['FROM runs q'], [], '', []
+        args = []
+        self._join_filters(sql, args, 'q', where, model_name)
+        return sql, args, cond, cond_args
+
+    def _filter(self, where, limit, model_name):
+        sql, args, cond, cond_args = self._filter_clauses(where, model_name)
+        sql = ['SELECT q.model_id'] + sql + [cond]
+        args += cond_args
+        if limit is not None:
+            sql.append('LIMIT ?')
+            args.append(limit)
+        return [row[0] for row in self.conn.execute(' '.join(sql), args)]
+
+    def close(self):
+        self.conn.close()
+
+
 class ParamStore(JsonStore):
-    def __init__(self, root_dir='param_'):
+    '''
+    The JSON file of each run stays the source of truth, with the final metrics of the run
+    under 'metrics_'. Writes through the store also update the RunIndex, reindex() rebuilds
+    it from the files.
+    '''
+    metrics_key = 'metrics_'
+
+    def __init__(self, root_dir='param_', index_file='index.sqlite'):
         super().__init__(root_dir)
         self.idgen = UUIDv4Gen()
+        self.index = RunIndex(os.path.join(root_dir, index_file))
+        if self.index.is_new:
+            self.reindex()
+
+    def __setitem__(self, key, obj):
+        super().__setitem__(key, obj)
+        self.index.put(key, obj, self.metrics_key)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.index.delete(key)
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def reindex(self):
+        self.index.clear()
+        for key in super().keys():
+            obj = self[key]
+            if obj is not None:
+                self.index.put(key, obj, self.metrics_key)
 
     def add(self, model_name, obj):
         for key in map(lambda randkey: '_'.join((model_name, randkey)), self.idgen):
@@ -80,3 +283,59 @@ class ParamStore(JsonStore):
                 obj['id_'] = key
                 self[key] = obj
                 return key
+
+    def set_metrics(self, key, metrics):
+        '''
+        Merges metrics into the final metrics of a run.
+        '''
+        obj = self[key]
+        if obj is None:
+            raise KeyError(key)
+        obj.setdefault(self.metrics_key, {}).update(metrics)
+        self[key] = obj
+
+    def query(self, where=None, order_by=None, descending=True, limit=None, model_name=None):
+        return self.index.query(where, order_by, descending, limit, model_name)
+
+    def top_k(self, k, metric='dev_roc_auc', where=None, model_name=None):
+        '''
+        Records of the k runs with the highest metric, e.g. top_k(5, where={'use_char': True}).
+        '''
+        return [self[key] for key in self.query(where, metric, True, k, model_name)]
+
+
+def _parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query or rebuild the run index of param_/')
+    parser.add_argument('--root-dir', default='param_')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('reindex')
+    top = subparsers.add_parser('top')
+    top.add_argument('-k', type=int, default=10)
+    top.add_argument('--metric', default='dev_roc_auc')
+    top.add_argument('--where',
+                     nargs='*',
+                     default=[],
+                     metavar='KEY=VALUE',
+                     help='param filters, values parsed as JSON, e.g. use_char=true')
+    top.add_argument('--model-name')
+    args = parser.parse_args(argv)
+
+    paramstore = ParamStore(args.root_dir)
+    if args.command == 'reindex':
+        paramstore.reindex()
+        print('Indexed {} runs'.format(len(paramstore)))
+    elif args.command == 'top':
+        where = dict((k, _parse_value(v)) for k, v in (w.split('=', 1) for w in args.where))
+        for obj in paramstore.top_k(args.k, args.metric, where, args.model_name):
+            print(json.dumps(obj))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+'''
+Evaluation outputs cached per run, split and epoch in pred_/<model_id>/<split>_<epoch>.npz.
+Training keeps those of the best and the last dev epoch.
+
+Run as a script to recompute metrics offline: the dev threshold sweep of the best cached
+epoch, and test metrics at the selected threshold when test predictions were cached too.
+'''
+import argparse
+import glob
+import os
+import re
+
+import numpy as np
+
+from evaluation import StreamingMetrics
+
+
+def pred_dir(model_id, root_dir='pred_'):
+    return os.path.join(root_dir, model_id)
+
+
+def pred_file(model_id, split, epoch, root_dir='pred_'):
+    return os.path.join(pred_dir(model_id, root_dir), '{}_{:04d}.npz'.format(split, epoch))
+
+
+def cached_epochs(model_id, split, root_dir='pred_'):
+    epochs = []
+    for fp in glob.glob(os.path.join(pred_dir(model_id, root_dir), split + '_*.npz')):
+        match = re.fullmatch(re.escape(split) + r'_(\d+)\.npz', os.path.basename(fp))
+        if match:
+            epochs.append(int(match.group(1)))
+    return sorted(epochs)
+
+
+def save_preds(model_id, split, epoch, scores, loss, root_dir='pred_'):
+    '''
+    scores is the StreamingMetrics returned by trainer.evaluate.
+    '''
+    fp = pred_file(model_id, split, epoch, root_dir)
+    if not os.path.exists(os.path.dirname(fp)):
+        os.makedirs(os.path.dirname(fp))
+    tmp_fp = fp + '.tmp'
+    with open(tmp_fp, 'wb') as f:
+        np.savez(f, loss=loss, **scores.state_dict())
+    os.replace(tmp_fp, fp)
+    return fp
+
+
+def prune_preds(model_id, split, keep_epochs, root_dir='pred_'):
+    '''
+    Deletes the cached predictions of split for all epochs but keep_epochs, train.py keeps the
+    best and the last dev epoch as AsyncCheckpointer keeps its most recent checkpoints.
+    '''
+    for epoch in cached_epochs(model_id, split, root_dir):
+        if epoch not in keep_epochs:
+            os.remove(pred_file(model_id, split, epoch, root_dir))
+
+
+def load_preds(model_id, split, epoch, root_dir='pred_'):
+    '''
+    Returns the cached StreamingMetrics and loss.
+    '''
+    with np.load(pred_file(model_id, split, epoch, root_dir)) as state:
+        state = dict(state)
+    return StreamingMetrics.from_state_dict(state), state['loss'].item()
+
+
+def best_epoch(model_id, split='dev', root_dir='pred_'):
+    '''
+    Epoch with the highest cached ROC-AUC, the one train.py keeps as the model checkpoint.
+    '''
+    epochs = cached_epochs(model_id, split, root_dir)
+    if not epochs:
+        raise FileNotFoundError('No cached {} predictions for {}'.format(split, model_id))
+    roc_aucs = [load_preds(model_id, split, epoch, root_dir)[0].roc_auc() for epoch in epochs]
+    return epochs[int(np.argmax(roc_aucs))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('model_id')
+    parser.add_argument('--epoch', type=int, help='defaults to the best cached dev epoch')
+    parser.add_argument('--thresholds',
+                        type=float,
+                        nargs=3,
+                        default=[0.01, 0.51, 0.01],
+                        metavar=('START', 'STOP', 'STEP'))
+    parser.add_argument('--root-dir', default='pred_')
+    args = parser.parse_args(argv)
+
+    epoch = args.epoch
+    if epoch is None:
+        epoch = best_epoch(args.model_id, 'dev', args.root_dir)
+
+    ths = np.arange(*args.thresholds)
+    dev_scores, dev_loss = load_preds(args.model_id, 'dev', epoch, args.root_dir)
+    dev_precisions, dev_recalls, dev_f1s = dev_scores.threshold_sweep(ths)
+    max_f1_idx = np.argmax(dev_f1s)
+    print('| epoch {} | dev_loss {:.6f} | dev_f1 {:.3f} | dev_roc_auc {:.3f} |'.format(
+        epoch, dev_loss, dev_scores.f1(0.05), dev_scores.roc_auc()))
+    print('| best_th {:.2f} | dev_precision {:.3f} | dev_recall {:.3f} | best_dev_f1 {:.3f} |'.format(
+        ths[max_f1_idx], dev_precisions[max_f1_idx], dev_recalls[max_f1_idx],
+        dev_f1s[max_f1_idx]))
+
+    if epoch in cached_epochs(args.model_id, 'test', args.root_dir):
+        test_scores, test_loss = load_preds(args.model_id, 'test', epoch, args.root_dir)
+        _, _, test_f1s = test_scores.threshold_sweep(ths)
+        print('| test_loss {:.6f} | test_f1 {:.3f} | test_roc_auc {:.3f} | best_test_f1 {:.3f} |'.
+              format(test_loss, test_scores.f1(0.05), test_scores.roc_auc(),
+                     test_f1s[max_f1_idx]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+import collections
+import contextlib
+import os
+import resource
+import sys
+import time
+
+import torch
+
+
+class StageTimer:
+    '''
+    Accumulates wall time per named stage until pop(). A disabled timer only costs a
+    nullcontext per stage. On CUDA, stage boundaries synchronize so that kernels are
+    attributed to the stage that queued them. Stages also show up as torch.profiler ranges.
+    '''
+    _null = contextlib.nullcontext()
+
+    def __init__(self, enabled=True, device='cpu'):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == 'cuda'
+        self.times = collections.defaultdict(float)
+
+    def _sync(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        self._sync()
+        start = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+            self._sync()
+        self.times[name] += time.perf_counter() - start
+
+    def stage(self, name):
+        return self._timed(name) if self.enabled else self._null
+
+    def pop(self):
+        times = dict(self.times)
+        self.times.clear()
+        return times
+
+
+def peak_rss_mb():
+    '''
+    Peak resident set size of this process.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def metrics_file(model_id, root_dir='param_'):
+    '''
+    Step metrics of a run, next to its ParamStore entry.
+    '''
+    return os.path.join(root_dir, model_id + '.metrics.jsonl')
+
+
+def make_profiler(steps, trace_dir):
+    '''
+    torch.profiler over the optimizer steps in [start, stop) of the epoch it is used in, the
+    trace is written for TensorBoard to trace_dir. Returns None if steps is empty.
+    '''
+    if not steps:
+        return None
+    start, stop = steps
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    warmup = 1 if start > 0 else 0
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=start - warmup,
+                                                                   warmup=warmup,
+                                                                   active=stop - start,
+                                                                   repeat=1),
+                                  on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                                  record_shapes=True,
+                                  profile_memory=True)
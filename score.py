@@ -0,0 +1,221 @@
+'''
+Batch scoring of review dumps in the goodreads_reviews_spoiler.json.gz line format.
+
+Tokenization runs in a process pool ahead of the model, with a bounded number of chunks in
+flight so memory does not grow with the input size.
+'''
+import argparse
+import collections
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+
+import loggingutil
+from cascade import Cascade, cascade_file
+from inference import Featurizer, load_model
+from paramstore import ParamStore
+
+logger = loggingutil.get_logger('score')
+
+_featurizer = None
+
+
+def _init_worker(featurizer):
+    global _featurizer
+    _featurizer = featurizer
+
+
+def featurize_chunk(lines):
+    '''
+    Parses and encodes a chunk of raw record lines, in a worker process.
+    '''
+    meta, docs, doc_df_idfs, doc_chars, doc_abs = [], [], [], [], []
+    for line in lines:
+        d = json.loads(line)
+        sentences = [label_sent[1] for label_sent in d['review_sentences']]
+        doc, doc_df_idf, doc_char, doc_ab, _ = _featurizer.encode_doc(sentences, d['book_id'])
+        meta.append((d.get('review_id'), d['book_id'], min(len(sentences),
+                                                           _featurizer.max_n_sents)))
+        docs.append(doc)
+        doc_df_idfs.append(doc_df_idf)
+        doc_chars.append(doc_char)
+        doc_abs.append(doc_ab)
+    return meta, np.stack(docs), np.stack(doc_df_idfs), np.stack(doc_chars), np.stack(doc_abs)
+
+
+def generate_chunks(fp, chunk_size, limit=None):
+    with gzip.open(fp, 'rt') as fin:
+        lines = itertools.islice(fin, limit)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+
+
+def score_chunk(model, chunk, batch_size, device, cascade=None):
+    '''
+    With a cascade, only the docs it passes are scored by the model, the others score 0.
+    '''
+    meta, docs, doc_df_idfs, doc_chars, doc_abs = chunk
+    idx = np.arange(len(docs))
+    probs = np.zeros(docs.shape[:2], dtype=np.float32)
+    if cascade is not None:
+        idx = idx[cascade.gate(torch.from_numpy(docs).to(device),
+                               torch.from_numpy(doc_df_idfs).to(device))]
+    with torch.no_grad():
+        for start in range(0, len(idx), batch_size):
+            batch = idx[start:start + batch_size]
+            elems = torch.from_numpy(docs[batch]).to(device)
+            word_h0 = model.init_hidden(len(elems)).to(device)
+            sent_h0 = model.init_hidden(len(elems)).to(device)
+            preds, _, _ = model(elems,
+                                word_h0,
+                                sent_h0,
+                                x_df_idf=torch.from_numpy(doc_df_idfs[batch]).to(device),
+                                chars=torch.from_numpy(doc_chars[batch]).to(device),
+                                doc_ab=torch.from_numpy(doc_abs[batch]).to(device),
+                                book_ids=[meta[i][1] for i in batch])
+            probs[batch] = torch.sigmoid(preds).view(len(elems), -1).cpu().numpy()
+    return [(review_id, book_id, probs[i, :n_sents].tolist())
+            for i, (review_id, book_id, n_sents) in enumerate(meta)]
+
+
+class JsonlWriter:
+    def __init__(self, fp):
+        self.file = open(fp, 'w')
+
+    def write(self, scores):
+        for review_id, book_id, probs in scores:
+            self.file.write(
+                json.dumps({
+                    'review_id': review_id,
+                    'book_id': book_id,
+                    'sentence_probs': probs
+                }) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    '''
+    One row per sentence, written one row group per chunk.
+    '''
+    def __init__(self, fp):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is required for --format parquet')
+        self.pa = pa
+        self.schema = pa.schema([('review_id', pa.string()), ('book_id', pa.string()),
+                                 ('sentence_idx', pa.int32()), ('prob', pa.float32())])
+        self.writer = pq.ParquetWriter(fp, self.schema)
+
+    def write(self, scores):
+        columns = collections.defaultdict(list)
+        for review_id, book_id, probs in scores:
+            for i, prob in enumerate(probs):
+                columns['review_id'].append(review_id)
+                columns['book_id'].append(book_id)
+                columns['sentence_idx'].append(i)
+                columns['prob'].append(prob)
+        self.writer.write_table(self.pa.Table.from_pydict(dict(columns), schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('model_id')
+    parser.add_argument('input', help='gzip JSON lines review dump')
+    parser.add_argument('output')
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default='jsonl')
+    parser.add_argument('--data-file',
+                        help='preprocessed artifact with the frozen vocabulary, '
+                        'defaults to the one the model was trained on')
+    parser.add_argument('--keywords', default='data_/book_id_keywords.json')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--chunk-size', type=int, default=512)
+    parser.add_argument('--workers', type=int, default=max(1, multiprocessing.cpu_count() - 1))
+    parser.add_argument('--max-inflight',
+                        type=int,
+                        default=None,
+                        help='chunks queued ahead of the model, defaults to 2 * workers')
+    parser.add_argument('--ab-cache-size', type=int, default=10000)
+    parser.add_argument('--cascade',
+                        action='store_true',
+                        help='skip the reviews the first stage of cascade.py rules out')
+    parser.add_argument('--limit', type=int, default=None)
+    parser.add_argument('--log-every', type=int, default=100000)
+    args = parser.parse_args(argv)
+
+    device = torch.device(args.device)
+    max_inflight = args.max_inflight or 2 * args.workers
+
+    paramstore = ParamStore()
+    params = paramstore[args.model_id]
+    data_file = args.data_file or params['data_file']
+    logger.info('Loading vocabulary from {}'.format(data_file))
+    with open(data_file, 'rb') as f:
+        data = pickle.load(f)
+    keywords = None
+    if args.keywords and os.path.exists(args.keywords):
+        with open(args.keywords) as f:
+            keywords = json.load(f)
+    featurizer = Featurizer.from_artifact(data,
+                                          params['max_sent_len'],
+                                          params['max_doc_len'],
+                                          keywords=keywords)
+    model, _ = load_model(args.model_id,
+                          len(data['ctoi']),
+                          device=device,
+                          paramstore=paramstore,
+                          ab_cache_size=args.ab_cache_size)
+    del data
+    cascade = Cascade.load(cascade_file(args.model_id), device) if args.cascade else None
+
+    writer = ParquetWriter(args.output) if args.format == 'parquet' else JsonlWriter(args.output)
+    n_records = 0
+    n_logged = 0
+    start_time = time.time()
+    with multiprocessing.Pool(args.workers, _init_worker, (featurizer, )) as pool:
+        inflight = collections.deque()
+        chunks = generate_chunks(args.input, args.chunk_size, args.limit)
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is not None:
+                inflight.append(pool.apply_async(featurize_chunk, (chunk, )))
+                if len(inflight) < max_inflight:
+                    continue
+            # drain the oldest chunk while the pool works on the rest
+            while inflight and (chunk is None or len(inflight) >= max_inflight):
+                scores = score_chunk(model, inflight.popleft().get(), args.batch_size, device,
+                                     cascade)
+                writer.write(scores)
+                n_records += len(scores)
+                if n_records - n_logged >= args.log_every:
+                    n_logged = n_records
+                    logger.info('Scored {} records | {:.1f} records/sec'.format(
+                        n_records, n_records / (time.time() - start_time)))
+    writer.close()
+
+    elapsed = time.time() - start_time
+    print('Scored {} records in {:.1f}s | {:.1f} records/sec'.format(n_records, elapsed,
+                                                                     n_records / elapsed))
+    if cascade is not None:
+        print('Cascade passed {} of {} records to the model'.format(cascade.n_passed,
+                                                                    cascade.n_docs))
+
+
+if __name__ == '__main__':
+    main()
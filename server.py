@@ -0,0 +1,251 @@
+'''
+Local HTTP scoring service with micro-batching.
+
+POST /score {"book_id": ..., "sentences": [...]} returns {"sentence_probs": [...]}.
+GET /metrics returns queue depth, batch size and latency histograms.
+
+Concurrent requests are tokenized in a process pool off the event loop and collected into
+micro-batches of at most --max-batch-size requests, waiting at most --max-wait-ms for a batch
+to fill, before one SpoilerNet forward pass.
+'''
+import argparse
+import asyncio
+import bisect
+import concurrent.futures
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+
+import loggingutil
+from inference import Featurizer, load_model
+from paramstore import ParamStore
+from score import score_chunk
+
+logger = loggingutil.get_logger('server')
+
+_featurizer = None
+
+
+def _init_worker(featurizer):
+    global _featurizer
+    _featurizer = featurizer
+
+
+def featurize(sentences, book_id):
+    return _featurizer.encode_doc(sentences, book_id)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def to_dict(self):
+        return {
+            'buckets': ['<={}'.format(b) for b in self.buckets] + ['>{}'.format(self.buckets[-1])],
+            'counts': self.counts,
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.
+        }
+
+
+class MicroBatcher:
+    def __init__(self, model, featurizer, device, max_batch_size, max_wait, tokenize_pool):
+        self.model = model
+        self.featurizer = featurizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.tokenize_pool = tokenize_pool
+        # one thread so forward passes never overlap
+        self.model_pool = concurrent.futures.ThreadPoolExecutor(1)
+        self.queue = asyncio.Queue()
+
+        self.batch_sizes = Histogram([1, 2, 4, 8, 16, 32, 64, 128])
+        self.latencies_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000])
+        self.queue_depths = Histogram([0, 1, 2, 4, 8, 16, 32, 64, 128, 256])
+
+    async def score(self, sentences, book_id):
+        start_time = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        encoded = await loop.run_in_executor(self.tokenize_pool, featurize, sentences, book_id)
+        future = loop.create_future()
+        n_sents = min(len(sentences), self.featurizer.max_n_sents)
+        self.queue_depths.observe(self.queue.qsize())
+        await self.queue.put(((None, book_id, n_sents), encoded, future))
+        probs = await future
+        self.latencies_ms.observe((time.perf_counter() - start_time) * 1000)
+        return probs
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    def run_model(self, batch):
+        meta = [m for m, _, _ in batch]
+        docs, doc_df_idfs, doc_chars, doc_abs, _ = zip(*[encoded for _, encoded, _ in batch])
+        chunk = meta, np.stack(docs), np.stack(doc_df_idfs), np.stack(doc_chars), np.stack(doc_abs)
+        return score_chunk(self.model, chunk, len(batch), self.device)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            self.batch_sizes.observe(len(batch))
+            try:
+                scores = await loop.run_in_executor(self.model_pool, self.run_model, batch)
+            except Exception as e:
+                logger.exception('Scoring failed')
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, _, future), (_, _, probs) in zip(batch, scores):
+                future.set_result(probs)
+
+    def metrics(self):
+        return {
+            'queue_depth': self.queue.qsize(),
+            'queue_depth_on_arrival': self.queue_depths.to_dict(),
+            'batch_size': self.batch_sizes.to_dict(),
+            'latency_ms': self.latencies_ms.to_dict()
+        }
+
+
+async def read_request(reader):
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    method, path, _ = request_line.decode('latin-1').split(' ', 2)
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get('content-length', 0)))
+    return method, path, headers, body
+
+
+def write_response(writer, status, obj, keep_alive):
+    body = json.dumps(obj).encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                 'Connection: {}\r\n\r\n'.format(status, len(body),
+                                                'keep-alive' if keep_alive else 'close').encode())
+    writer.write(body)
+
+
+def make_handler(batcher):
+    async def handle(reader, writer):
+        try:
+            while True:
+                request = await read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if method == 'POST' and path == '/score':
+                    try:
+                        obj = json.loads(body)
+                        probs = await batcher.score(obj['sentences'], obj.get('book_id'))
+                        write_response(writer, '200 OK', {'sentence_probs': probs}, keep_alive)
+                    except (ValueError, KeyError, TypeError) as e:
+                        write_response(writer, '400 Bad Request', {'error': str(e)}, keep_alive)
+                    except Exception:
+                        # the connection stays usable, the traceback goes to the log only
+                        logger.exception('Request to /score failed')
+                        write_response(writer, '500 Internal Server Error',
+                                       {'error': 'internal error'}, keep_alive)
+                elif method == 'GET' and path == '/metrics':
+                    write_response(writer, '200 OK', batcher.metrics(), keep_alive)
+                else:
+                    write_response(writer, '404 Not Found', {'error': 'not found'}, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(batcher, host, port):
+    server = await asyncio.start_server(make_handler(batcher), host, port)
+    logger.info('Serving on {}:{}'.format(host, port))
+    batch_task = asyncio.create_task(batcher.run())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('model_id')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--data-file')
+    parser.add_argument('--keywords', default='data_/book_id_keywords.json')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--max-batch-size', type=int, default=32)
+    parser.add_argument('--max-wait-ms', type=float, default=10.)
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--ab-cache-size', type=int, default=10000)
+    args = parser.parse_args(argv)
+
+    device = torch.device(args.device)
+    paramstore = ParamStore()
+    params = paramstore[args.model_id]
+    with open(args.data_file or params['data_file'], 'rb') as f:
+        data = pickle.load(f)
+    keywords = None
+    if args.keywords and os.path.exists(args.keywords):
+        with open(args.keywords) as f:
+            keywords = json.load(f)
+    featurizer = Featurizer.from_artifact(data,
+                                          params['max_sent_len'],
+                                          params['max_doc_len'],
+                                          keywords=keywords)
+    model, _ = load_model(args.model_id,
+                          len(data['ctoi']),
+                          device=device,
+                          paramstore=paramstore,
+                          ab_cache_size=args.ab_cache_size)
+    del data
+
+    with concurrent.futures.ProcessPoolExecutor(args.workers,
+                                                initializer=_init_worker,
+                                                initargs=(featurizer, )) as tokenize_pool:
+        batcher = MicroBatcher(model, featurizer, device, args.max_batch_size,
+                               args.max_wait_ms / 1000, tokenize_pool)
+        try:
+            asyncio.run(serve(batcher, args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main()
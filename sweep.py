@@ -0,0 +1,238 @@
+'''
+Hyperparameter sweep over the train.py model.
+
+The dataset is loaded and padded once, moved to shared memory and handed to a pool of worker
+processes that each train one trial at a time with a fixed number of threads. Trials whose dev
+ROC-AUC falls below the median of the other trials at the same epoch are pruned. Every trial
+is recorded in the ParamStore with its final metrics, and its best model saved to model_/.
+'''
+import argparse
+import itertools
+import json
+import os
+import pickle
+import random
+import statistics
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+import loggingutil
+from dataloading import make_dataloader
+from dataset import split_datasets
+from inference import build_model
+from paramstore import ParamStore, UUIDv4Gen
+from trainer import evaluate, make_optimizer, train_one_epoch
+
+logger = loggingutil.get_logger('sweep')
+
+# train.py configuration, a search space overrides any of these
+DEFAULT_PARAMS = {
+    'max_sent_len': 15,
+    'max_doc_len': 30,
+    'cell_dim': 128,
+    'att_dim': 32,
+    'emb_size': 200,
+    'use_idf': True,
+    'use_char': True,
+    'char_emb_size': 64,
+    'char_cell_dim': 32,
+    'attent_type': 'coAtt',
+    'batch_size': 32,
+    'lr': 1e-3,
+}
+
+DEFAULT_SPACE = {
+    'cell_dim': [64, 128],
+    'att_dim': [16, 32],
+    'emb_size': [100, 200],
+    'use_idf': [True, False],
+    'use_char': [True, False],
+}
+
+
+class MedianPruner:
+    '''
+    Prunes a trial whose value at an epoch is below the median of the other trials at the same
+    epoch, once n_startup_trials of them have reached it. history is a list of
+    (trial, epoch, value) shared between processes.
+    '''
+    def __init__(self, history, n_startup_trials=4, n_warmup_epochs=1):
+        self.history = history
+        self.n_startup_trials = n_startup_trials
+        self.n_warmup_epochs = n_warmup_epochs
+
+    def report(self, trial, epoch, value):
+        self.history.append((trial, epoch, value))
+
+    def should_prune(self, trial, epoch, value):
+        if epoch < self.n_warmup_epochs:
+            return False
+        values = [v for t, e, v in list(self.history) if e == epoch and t != trial]
+        if len(values) < self.n_startup_trials:
+            return False
+        return value < statistics.median(values)
+
+
+def grid(space):
+    keys = list(space)
+    return [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+
+
+_ds_train = None
+_ds_dev = None
+_char_vocab_size = None
+_pruner = None
+
+
+def _init_worker(ds_train, ds_dev, char_vocab_size, pruner, n_threads):
+    global _ds_train, _ds_dev, _char_vocab_size, _pruner
+    _ds_train, _ds_dev, _char_vocab_size, _pruner = ds_train, ds_dev, char_vocab_size, pruner
+    torch.set_num_threads(n_threads)
+
+
+def run_trial(trial):
+    model_id, params, n_epochs, patience = trial
+    torch.manual_seed(params['seed'])
+
+    model = build_model(params, _char_vocab_size)
+    criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
+    optimizer = make_optimizer(model, params['lr'])
+    dl_train = make_dataloader(_ds_train, params['batch_size'], shuffle=True)
+    dl_dev = make_dataloader(_ds_dev, params['batch_size'])
+
+    metrics = {'dev_roc_aucs': [], 'dev_roc_auc': 0, 'pruned': False}
+    no_drop_epochs = 0
+    start_time = time.time()
+    for epoch in range(n_epochs):
+        train_one_epoch(epoch,
+                        model,
+                        dl_train,
+                        optimizer,
+                        criterion,
+                        params,
+                        'cpu',
+                        log_interval=0,
+                        n_prefetch=0)
+        _, dev_loss, dev_f1, dev_roc_auc = evaluate(model,
+                                                    dl_dev,
+                                                    criterion,
+                                                    params,
+                                                    'cpu',
+                                                    n_prefetch=0)
+        metrics['dev_roc_aucs'].append(dev_roc_auc)
+
+        if dev_roc_auc > metrics['dev_roc_auc']:
+            metrics.update(dev_roc_auc=dev_roc_auc,
+                           dev_f1=dev_f1,
+                           dev_loss=dev_loss,
+                           best_epoch=epoch)
+            torch.save(model.state_dict(), os.path.join('model_', model_id + '.pt'))
+            no_drop_epochs = 0
+        else:
+            no_drop_epochs += 1
+            if no_drop_epochs >= patience:
+                break
+
+        _pruner.report(model_id, epoch, dev_roc_auc)
+        if _pruner.should_prune(model_id, epoch, dev_roc_auc):
+            metrics['pruned'] = True
+            break
+
+    metrics['epochs'] = len(metrics['dev_roc_aucs'])
+    metrics['train_time'] = time.time() - start_time
+    return model_id, metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--space', help='JSON file mapping parameter names to lists of values')
+    parser.add_argument('--n-trials',
+                        type=int,
+                        help='random configurations of the grid, all of them if unset')
+    parser.add_argument('--data-file',
+                        default=os.path.join('data_/goodreads-reviews-spoiler',
+                                             'mappings_100000_all_ge5.pkl'))
+    parser.add_argument('--threads-per-trial', type=int, default=2)
+    parser.add_argument('--workers',
+                        type=int,
+                        help='concurrent trials, defaults to cpu_count // threads-per-trial')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--patience', type=int, default=3)
+    parser.add_argument('--prune-startup-trials', type=int, default=4)
+    parser.add_argument('--prune-warmup-epochs', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    space = DEFAULT_SPACE
+    if args.space:
+        with open(args.space) as f:
+            space = json.load(f)
+    configs = grid(space)
+    if args.n_trials and args.n_trials < len(configs):
+        configs = random.Random(args.seed).sample(configs, args.n_trials)
+    n_workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads_per_trial)
+
+    # max_sent_len and max_doc_len decide the padding, they are fixed for the whole sweep
+    max_sent_len = space.get('max_sent_len', [DEFAULT_PARAMS['max_sent_len']])
+    max_doc_len = space.get('max_doc_len', [DEFAULT_PARAMS['max_doc_len']])
+    if len(max_sent_len) > 1 or len(max_doc_len) > 1:
+        raise ValueError('max_sent_len and max_doc_len cannot be swept, the dataset is padded once')
+
+    logger.info('Loading {}'.format(args.data_file))
+    with open(args.data_file, 'rb') as f:
+        data = pickle.load(f)
+    ds_train, ds_dev, _ = split_datasets(data, max_sent_len[0], max_doc_len[0], 0.7, 0.1)
+    ds_train.share_memory()
+    ds_dev.share_memory()
+    char_vocab_size = len(data['ctoi'])
+    vocab_size = len(data['itow'])
+    del data
+
+    sweep_id = next(UUIDv4Gen())
+    paramstore = ParamStore()
+    if not os.path.exists('model_'):
+        os.makedirs('model_')
+    trials = {}
+    for config in configs:
+        params = dict(DEFAULT_PARAMS)
+        params.update(config)
+        params.update(data_file=args.data_file,
+                      vocab_size=vocab_size,
+                      amp='none',
+                      world_size=1,
+                      accum_steps=1,
+                      effective_batch_size=params['batch_size'],
+                      lr_scale='none',
+                      seed=args.seed,
+                      sweep_id=sweep_id)
+        model_id = paramstore.add('spoilernet', params)
+        trials[model_id] = params
+    logger.info('Sweep {}: {} trials, {} workers x {} threads'.format(
+        sweep_id, len(trials), n_workers, args.threads_per_trial))
+
+    ctx = mp.get_context('spawn')
+    with ctx.Manager() as manager:
+        pruner = MedianPruner(manager.list(), args.prune_startup_trials, args.prune_warmup_epochs)
+        with ctx.Pool(n_workers,
+                      initializer=_init_worker,
+                      initargs=(ds_train, ds_dev, char_vocab_size, pruner,
+                                args.threads_per_trial)) as pool:
+            jobs = [(model_id, params, args.epochs, args.patience)
+                    for model_id, params in trials.items()]
+            for model_id, metrics in pool.imap_unordered(run_trial, jobs):
+                paramstore.set_metrics(model_id, metrics)
+                logger.info('{} | {} epochs{} | dev_roc_auc {:.4f} | {:.0f}s'.format(
+                    model_id, metrics['epochs'], ' (pruned)' if metrics['pruned'] else '',
+                    metrics['dev_roc_auc'], metrics['train_time']))
+
+    keys = [k for k in space if len(space[k]) > 1]
+    for params in paramstore.top_k(len(trials), 'dev_roc_auc', {'sweep_id': sweep_id}):
+        logger.info('| {} | dev_roc_auc {:.4f} | {} |'.format(
+            params['id_'], params['metrics_']['dev_roc_auc'],
+            ' '.join('{}={}'.format(k, params[k]) for k in keys)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import functools
+import itertools
+import re
+import string
+import zlib
+
+from nltk.tokenize import NLTKWordTokenizer, word_tokenize
+from nltk.corpus import stopwords
+
+STOP_WORDS = set(stopwords.words('english'))
+
+_PUNC_TABLE = str.maketrans('', '', string.punctuation)
+_HTTP_RE = re.compile(r'(http|https)://\S+')
+_DIGITS_RE = re.compile(r'\d+')
+_SENT_END_RE = re.compile(r'[.?!]')
+_FINAL_SENT_END_RE = re.compile(r'[.?!]\.*["\')\]}]*\s*$')
+_KEEP_WORDS = frozenset(['^http', '^num'])
+
+# Substrings without which a NLTKWordTokenizer pattern cannot match, by pattern. The
+# substitutions only add spaces and turn '"' into quote pairs, so a gate checked on the input
+# holds at every step. Patterns not listed here always run.
+_TREEBANK_GATES = {
+    r'([«“‘„]|[`]+)': ('«', '“', '‘', '„', '`'),
+    r'^\"': ('"', ),
+    r'(``)': ('`', '"'),
+    '([ \\(\\[{<])(\\"|\\\'{2})': ('"', "''"),
+    r"(?i)(?<!\w)(\')(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)": ("'", ),
+    '([^\\.])(\\.)([\\]\\)}>"\\\'»”’ ]*)\\s*$': ('.', ),
+    r'([:,])([^\d])': (':', ','),
+    r'([:,])$': (':', ','),
+    r'\.{2,}': ('..', ),
+    r'[;@#$%&]': tuple(';@#$%&'),
+    r'[\u2012-\u2015]': ('\u2012', '\u2013', '\u2014', '\u2015'),
+    '([^\\.])(\\.)([\\]\\)}>"\\\']*)\\s*$': ('.', ),
+    r'[?!]': ('?', '!'),
+    r"([^'])' ": ("'", ),
+    r'[*]': ('*', ),
+    r'[\]\[\(\)\{\}\<\>]': tuple('[](){}<>'),
+    r'--': ('--', ),
+    r'([»”’])': ('»', '”', '’'),
+    r"''": ("''", ),
+    r'"': ('"', ),
+    r"([^' ])('[sS]|'[mM]|'[dD]|') ": ("'", '"'),
+    r"([^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T) ": ("'", ),
+    r'(?i)\b(can)(?#X)(not)\b': ('cannot', ),
+    r"(?i)\b(d)(?#X)('ye)\b": ("d'ye", ),
+    r'(?i)\b(gim)(?#X)(me)\b': ('gimme', ),
+    r'(?i)\b(gon)(?#X)(na)\b': ('gonna', ),
+    r'(?i)\b(got)(?#X)(ta)\b': ('gotta', ),
+    r'(?i)\b(lem)(?#X)(me)\b': ('lemme', ),
+    r"(?i)\b(more)(?#X)('n)\b": ("more'n", ),
+    r'(?i)\b(wan)(?#X)(na)(?=\s)': ('wanna', ),
+    r"(?i) ('t)(?#X)(is)\b": ("'tis", ),
+    r"(?i) ('t)(?#X)(was)\b": ("'twas", ),
+}
+
+
+def _gated(steps):
+    return [(_TREEBANK_GATES.get(regexp.pattern), regexp, substitution)
+            for regexp, substitution in steps]
+
+
+_tb = NLTKWordTokenizer
+_TREEBANK_STEPS = _gated(_tb.STARTING_QUOTES + _tb.PUNCTUATION +
+                         [_tb.PARENS_BRACKETS, _tb.DOUBLE_DASHES])
+# after padding the text with spaces
+_TREEBANK_PADDED_STEPS = _gated(
+    _tb.ENDING_QUOTES + [(regexp, r' \1 \2 ') for regexp in _tb.CONTRACTIONS2 + _tb.CONTRACTIONS3])
+
+
+def remove_punc(token):
+    return token.translate(_PUNC_TABLE)
+
+
+def get_sent_words_reference(sent):
+    '''
+    Reference implementation of get_sent_words, kept for the conformance check in
+    bench/tokenizer.py.
+    '''
+    # case-folding
+    sent = sent.lower()
+
+    # replace http
+    sent = re.sub(r'(http|https)://\S+', '^http', sent)
+
+    # replace digits
+    sent = re.sub(r'\d+', ' ^num ', sent)
+
+    # tokenize
+    words = word_tokenize(sent)
+
+    # split '-'
+    words = itertools.chain(*map(lambda w: w.split('-'), words))
+
+    # remove punctuation
+    words = map(lambda w: remove_punc(w) if w not in ['^http', '^num'] else w, words)
+
+    # remove empty
+    words = filter(lambda w: w, words)
+
+    # remove stopwords
+    words = filter(lambda w: w not in STOP_WORDS, words)
+
+    # stemming
+    # words = map(lambda w: _porter.stem(w), words)
+
+    words = list(words)
+    return words
+
+
+def treebank_tokenize(text):
+    '''
+    Same as NLTKWordTokenizer().tokenize(text), skipping the patterns whose gate is not in text.
+    '''
+    lower = text.lower()
+    for gate, regexp, substitution in _TREEBANK_STEPS:
+        if gate is None or any(g in lower for g in gate):
+            text = regexp.sub(substitution, text)
+    text = ' ' + text + ' '
+    for gate, regexp, substitution in _TREEBANK_PADDED_STEPS:
+        if gate is None or any(g in lower for g in gate):
+            text = regexp.sub(substitution, text)
+    return text.split()
+
+
+def normalize(sent):
+    sent = sent.lower()
+    sent = _HTTP_RE.sub('^http', sent)
+    return _DIGITS_RE.sub(' ^num ', sent)
+
+
+def is_single_sentence(text):
+    '''
+    True if Punkt cannot split text: its only sentence-ending character is at the end, followed
+    by nothing but periods, closing quotes and brackets.
+    '''
+    final = _FINAL_SENT_END_RE.search(text)
+    end = final.start() if final else len(text)
+    return _SENT_END_RE.search(text, 0, end) is None
+
+
+class Tokenizer:
+    '''
+    Same output as get_sent_words_reference. Reviews come already split into sentences, so
+    for most inputs the Punkt sentence splitting of word_tokenize is skipped and the gated
+    treebank_tokenize is called directly; anything Punkt could split goes through
+    word_tokenize. Results of the last cache_size distinct sentences are memoized.
+    '''
+    def __init__(self, cache_size=1 << 16, stop_words=STOP_WORDS):
+        self.stop_words = stop_words
+        self._words = self._tokenize
+        if cache_size:
+            self._words = functools.lru_cache(cache_size)(self._tokenize)
+
+    def word_tokenize(self, text):
+        if is_single_sentence(text):
+            # punkt leaves out trailing whitespace, which changes how quotes are split
+            return treebank_tokenize(text.rstrip())
+        return word_tokenize(text)
+
+    def _tokenize(self, sent):
+        words = []
+        stop_words = self.stop_words
+        for token in self.word_tokenize(normalize(sent)):
+            for word in token.split('-'):
+                if word not in _KEEP_WORDS:
+                    word = word.translate(_PUNC_TABLE)
+                if word and word not in stop_words:
+                    words.append(word)
+        return tuple(words)
+
+    def __call__(self, sent):
+        return list(self._words(sent))
+
+    def cache_info(self):
+        return self._words.cache_info() if hasattr(self._words, 'cache_info') else None
+
+    def cache_clear(self):
+        if hasattr(self._words, 'cache_clear'):
+            self._words.cache_clear()
+
+
+_tokenizer = Tokenizer()
+
+
+def get_sent_words(sent):
+    return _tokenizer(sent)
+
+
+def hash_bucket(word, n_buckets):
+    # stable across processes, unlike hash()
+    return zlib.crc32(word.encode('utf8')) % n_buckets
+
+
+class WordIndex(dict):
+    '''
+    word -> id in itow. With n_hash_buckets, the last n_hash_buckets entries of itow are
+    buckets that words outside the vocabulary are hashed into, instead of all being <unk>.
+    '''
+    def __init__(self, itow, n_hash_buckets=0):
+        super().__init__((w, i) for i, w in enumerate(itow))
+        self.n_hash_buckets = n_hash_buckets
+        self.bucket_start = len(itow) - n_hash_buckets
+        self.unk_idx = self['<unk>']
+
+    def encode(self, word):
+        i = self.get(word)
+        if i is not None:
+            return i
+        if self.n_hash_buckets:
+            return self.bucket_start + hash_bucket(word, self.n_hash_buckets)
+        return self.unk_idx
+
+
+def get_label_sent_words(label_sents):
+    return [(lb_s[0], get_sent_words(lb_s[1])) for lb_s in label_sents]
@@ -1,18 +1,97 @@
 # %%
+import argparse
 import os
-import time
-import math
 import pickle
-from typing import Sequence
+import sys
+import time
 
 import numpy as np
 import torch
-import sklearn.metrics as metrics
+import torch.distributed as dist
 
 import loggingutil
-from dataset import GoodreadsReviewsSpoilerDataset
+from checkpoint import (AsyncCheckpointer, checkpoint_dir, get_rng_state, resolve_checkpoint,
+                        set_rng_state)
+from codecheck import verify_artifact
+from dataloading import EpochRandomSampler, make_dataloader
+from dataset import split_datasets
+from embeddings import load_pretrained
+from inference import load_model
 from model import SpoilerNet
 from paramstore import ParamStore
+from predcache import load_preds, prune_preds, save_preds
+from profiling import StageTimer, make_profiler, metrics_file
+from trainer import evaluate, make_optimizer, train_one_epoch, wrap_ddp
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--device', default='cuda:1' if torch.cuda.is_available() else 'cpu')
+parser.add_argument('--amp',
+                    choices=['none', 'bf16'],
+                    default='none',
+                    help='autocast the model forward pass, loss and softmaxes stay in fp32')
+parser.add_argument('--num-workers', type=int, default=2, help='DataLoader worker processes')
+parser.add_argument('--prefetch', type=int, default=2, help='batches kept ready on device')
+parser.add_argument('--distributed',
+                    action='store_true',
+                    help='data-parallel training over torchrun processes with the gloo backend')
+parser.add_argument('--accum-steps',
+                    type=int,
+                    default=1,
+                    help='batches of gradient accumulated per optimizer step')
+parser.add_argument('--lr-scale',
+                    choices=['none', 'linear', 'sqrt'],
+                    default='none',
+                    help='scale the learning rate with the effective batch size over batch_size')
+parser.add_argument('--resume', help='checkpoint file, or model id to resume from its latest')
+parser.add_argument('--ckpt-every', type=int, default=1, help='epochs between checkpoints')
+parser.add_argument('--keep-ckpts', type=int, default=3, help='checkpoints kept per run')
+parser.add_argument('--instrument',
+                    action='store_true',
+                    help='time every training step by stage into param_/<model_id>.metrics.jsonl')
+parser.add_argument('--profile-steps',
+                    type=int,
+                    nargs=2,
+                    metavar=('START', 'STOP'),
+                    help='torch.profiler trace of these steps of the first epoch, into prof_/')
+parser.add_argument('--pretrained-emb',
+                    metavar='PREFIX',
+                    help='initialize word embeddings from vectors converted by embeddings.py')
+parser.add_argument('--emb-cutoffs',
+                    type=int,
+                    nargs='+',
+                    help='word ids where the embedding tiers start, each tier div times narrower')
+parser.add_argument('--emb-div', type=int, default=4, help='dimension ratio of successive tiers')
+parser.add_argument('--sparse-emb',
+                    action='store_true',
+                    help='sparse embedding gradients, updated by SparseAdam')
+parser.add_argument('--cell-dim', type=int, default=128, help='GRU hidden size per direction')
+parser.add_argument('--no-char', action='store_true', help='leave out the char features')
+parser.add_argument('--word-encoder',
+                    choices=['gru', 'conv'],
+                    default='gru',
+                    help='bidirectional GRU or convolution over the words of a sentence')
+parser.add_argument('--distill-from',
+                    metavar='MODEL_ID',
+                    help='train against the sentence logits of this trained teacher run')
+parser.add_argument('--distill-alpha',
+                    type=float,
+                    default=0.5,
+                    help='weight of the teacher term in the loss, the labels get the rest')
+parser.add_argument('--distill-temp', type=float, default=2., help='distillation temperature')
+parser.add_argument('--eval-bins',
+                    type=int,
+                    help='histogram bins for evaluation metrics in bounded memory, exact if unset')
+args, _ = parser.parse_known_args()
+
+if args.distributed:
+    dist.init_process_group('gloo')
+    rank, world_size = dist.get_rank(), dist.get_world_size()
+    # split the cores between the local processes
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+else:
+    rank, world_size = 0, 1
+is_main = rank == 0
 
 _logger = loggingutil.get_logger('train')
 paramstore = ParamStore()
@@ -28,67 +107,73 @@ max_doc_len = 30
 batch_size = 32
 train_portion, dev_portion = 0.7, 0.1
 
+params['data_file'] = data_file
 params['max_sent_len'] = max_sent_len
 params['max_doc_len'] = max_doc_len
 # %%
 # Load
-with open(data_file, 'rb') as f:
-    data = pickle.load(f)
-doc_label_sents = data['doc_label_sents']
-doc_df_idf = data['doc_df_idf']
+# fail before training on an inconsistent artifact, or one changed since it was validated. Rank 0
+# verifies and writes the checksum file, the other ranks wait for its result before loading
+data, artifact_error = None, None
+if is_main:
+    with open(data_file, 'rb') as f:
+        data = pickle.load(f)
+    try:
+        verify_artifact(data_file, data)
+    except ValueError as e:
+        artifact_error = str(e)
+if args.distributed:
+    artifact_error_list = [artifact_error]
+    dist.broadcast_object_list(artifact_error_list, src=0)
+    artifact_error = artifact_error_list[0]
+if artifact_error is not None:
+    raise ValueError(artifact_error)
+if data is None:
+    with open(data_file, 'rb') as f:
+        data = pickle.load(f)
 itow = data['itow']
 ctoi = data["ctoi"]
-doc_key_encode = data['doc_key_encode']
-doc_char_encode = data['doc_char_encode']
-
 
 # %%
 # Split train, dev, test
-def train_dev_test_split_idx(rand_idx, d: Sequence, n_train: int, n_dev: int):
-    d_train = [d[idx] for idx in rand_idx[:n_train]]
-    d_dev = [d[idx] for idx in rand_idx[n_train:n_train + n_dev]]
-    d_test = [d[idx] for idx in rand_idx[n_train + n_dev:]]
-    return d_train, d_dev, d_test
-
-
-np.random.seed(0)
-
-np.random.seed(0)
-
-n_d = len(doc_label_sents)
-n_train = math.floor(n_d * train_portion)
-n_dev = math.floor(n_d * dev_portion)
-rand_idx = np.random.choice(n_d, n_d, replace=False)
-
-d_train, d_dev, d_test = train_dev_test_split_idx(rand_idx, doc_label_sents, n_train, n_dev)
-d_idf_train, d_idf_dev, d_idf_test = train_dev_test_split_idx(rand_idx, doc_df_idf, n_train, n_dev)
-d_key_train, d_key_dev, d_key_test = train_dev_test_split_idx(rand_idx, doc_key_encode, n_train,
-                                                              n_dev)
-d_char_train, d_char_dev, d_char_test = train_dev_test_split_idx(rand_idx, doc_char_encode, n_train,
-                                                                 n_dev)
-
-ds_train = GoodreadsReviewsSpoilerDataset(d_train, d_idf_train, d_key_train, itow, max_sent_len,
-                                          max_doc_len, ctoi, d_char_train)
-ds_dev = GoodreadsReviewsSpoilerDataset(d_dev, d_idf_dev, d_key_dev, itow, max_sent_len,
-                                        max_doc_len, ctoi, d_char_dev)
-ds_test = GoodreadsReviewsSpoilerDataset(d_test, d_idf_test, d_key_test, itow, max_sent_len,
-                                         max_doc_len, ctoi, d_char_test)
-dl_train = torch.utils.data.DataLoader(ds_train, batch_size=batch_size, shuffle=True)
-dl_dev = torch.utils.data.DataLoader(ds_dev, batch_size=batch_size)
-dl_test = torch.utils.data.DataLoader(ds_test, batch_size=batch_size)
+ds_train, ds_dev, ds_test = split_datasets(data, max_sent_len, max_doc_len, train_portion,
+                                           dev_portion)
+# seeded per epoch, so that --resume shuffles as the uninterrupted run
+if args.distributed:
+    train_sampler = torch.utils.data.distributed.DistributedSampler(ds_train, shuffle=True, seed=0)
+else:
+    train_sampler = EpochRandomSampler(ds_train, seed=0)
+dl_train = make_dataloader(ds_train,
+                           batch_size,
+                           shuffle=True,
+                           num_workers=args.num_workers,
+                           device=args.device,
+                           sampler=train_sampler)
+dl_dev = make_dataloader(ds_dev, batch_size, num_workers=args.num_workers, device=args.device)
+dl_test = make_dataloader(ds_test, batch_size, num_workers=args.num_workers, device=args.device)
 # %%
 model_name = 'spoilernet'
-cell_dim = 128
+cell_dim = args.cell_dim
 att_dim = 32
 vocab_size = len(itow)
 emb_size = 200
 use_idf = True
-use_char = True
+use_char = not args.no_char
 char_vocab_size = len(ctoi)
 char_emb_size = 64
 char_cell_dim = 32
 attent_type = "coAtt"
 
+pretrained_emb = None
+if args.pretrained_emb:
+    start_time = time.time()
+    pretrained_emb, emb_stats = load_pretrained(args.pretrained_emb, itow, data.get('wc'))
+    emb_size = pretrained_emb.shape[1]
+    _logger.info('Pretrained embeddings {} in {:.1f}s: {}'.format(args.pretrained_emb,
+                                                                  time.time() - start_time,
+                                                                  emb_stats))
+    params['pretrained_emb'] = args.pretrained_emb
+
 params['cell_dim'] = cell_dim
 params['att_dim'] = att_dim
 params['vocab_size'] = vocab_size
@@ -98,8 +183,41 @@ params['use_char'] = use_char
 params['char_emb_size'] = char_emb_size
 params['char_cell_dim'] = char_cell_dim
 params['attent_type'] = attent_type
-
-model_id = paramstore.add(model_name, params)
+params['word_encoder'] = args.word_encoder
+if args.emb_cutoffs:
+    params['emb_cutoffs'] = args.emb_cutoffs
+    params['emb_div'] = args.emb_div
+params['sparse_emb'] = args.sparse_emb
+params['n_hash_buckets'] = data.get('n_hash_buckets', 0)
+if args.distill_from:
+    params['distill_from'] = args.distill_from
+    params['distill_alpha'] = args.distill_alpha
+    params['distill_temp'] = args.distill_temp
+params['amp'] = args.amp
+params['world_size'] = world_size
+
+# effective batch across accumulation and ranks, relative to the batch size lr was tuned for
+base_lr = 1e-3
+effective_batch_size = batch_size * args.accum_steps * world_size
+lr_factor = effective_batch_size / batch_size
+lr = base_lr * {'none': 1., 'linear': lr_factor, 'sqrt': lr_factor**0.5}[args.lr_scale]
+params['accum_steps'] = args.accum_steps
+params['effective_batch_size'] = effective_batch_size
+params['lr_scale'] = args.lr_scale
+params['lr'] = lr
+
+resume_state = None
+if args.resume:
+    resume_state = torch.load(resolve_checkpoint(args.resume),
+                              map_location='cpu',
+                              weights_only=False)
+    model_id = resume_state['model_id']
+else:
+    model_id = paramstore.add(model_name, params) if is_main else None
+    if args.distributed:
+        model_id_list = [model_id]
+        dist.broadcast_object_list(model_id_list, src=0)
+        model_id = model_id_list[0]
 
 _logger = loggingutil.get_logger(model_id)
 
@@ -114,208 +232,194 @@ model = SpoilerNet(cell_dim=cell_dim,
                    char_emb_size=char_emb_size,
                    char_cell_dim=char_cell_dim,
                    use_char=use_char,
-                   char_vocab_size=char_vocab_size)
+                   char_vocab_size=char_vocab_size,
+                   pretrained_emb=pretrained_emb,
+                   emb_cutoffs=args.emb_cutoffs,
+                   emb_div=args.emb_div,
+                   sparse_emb=args.sparse_emb,
+                   word_encoder=args.word_encoder)
 criterion = torch.nn.BCEWithLogitsLoss(reduction='none')
 
-device = torch.device('cuda:1')
+device = torch.device(args.device)
+
+teacher, teacher_params = None, None
+if args.distill_from:
+    teacher, teacher_params = load_model(args.distill_from,
+                                         char_vocab_size,
+                                         device=device,
+                                         paramstore=paramstore)
+    if teacher_params['vocab_size'] != vocab_size:
+        raise ValueError('Teacher {} has vocab_size {}, the data {}'.format(
+            args.distill_from, teacher_params['vocab_size'], vocab_size))
+    _logger.info('Distilling from {} | alpha {} | temperature {}'.format(
+        args.distill_from, args.distill_alpha, args.distill_temp))
+amp_dtype = torch.bfloat16 if args.amp == 'bf16' else None
 model.to(device)
 criterion.to(device)
 
-optimizer = torch.optim.Adam(model.parameters())
-scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=30, gamma=0.1)
-
-
-# %% [markdown]
-# ## Training
-# %%
-def train_one_epoch(epoch,
-                    model,
-                    dataloader,
-                    optimizer,
-                    criterion,
-                    params,
-                    device,
-                    log_interval=1000):
-    model.to(device)
-    criterion.to(device)
-
-    model.train()
-
-    epoch_loss = 0
-    log_loss = 0
-    start_time = time.time()
-
-    for batch, (elems, labels, sentmasks, dfidf, chars, doc_ab) in enumerate(dataloader):
-        elems = elems.to(device)
-        labels = labels.float().view(-1).to(device)
-        sentmasks = sentmasks.view(-1).to(device)
-        doc_ab = doc_ab.to(device)
-
-        if params['use_idf']:
-            dfidf = dfidf.to(device)
-        if params['use_char']:
-            chars = chars.to(device)
-
-        optimizer.zero_grad()
-
-        word_h0 = model.init_hidden(len(elems)).to(device)
-        sent_h0 = model.init_hidden(len(elems)).to(device)
-
-        if params['use_idf'] and params['use_char']:
-            preds, word_h0, sent_h0 = model(elems,
-                                            word_h0,
-                                            sent_h0,
-                                            x_df_idf=dfidf,
-                                            chars=chars,
-                                            doc_ab=doc_ab)
-        elif params['use_char']:
-            preds, word_h0, sent_h0 = model(elems, word_h0, sent_h0, chars=chars, doc_ab=doc_ab)
-        elif params['use_idf']:
-            preds, word_h0, sent_h0 = model(elems, word_h0, sent_h0, x_df_idf=dfidf, doc_ab=doc_ab)
-        else:
-            preds, word_h0, sent_h0 = model(elems, word_h0, sent_h0, doc_ab=doc_ab)
-
-        loss = criterion(preds, labels)
-        loss *= sentmasks
-        loss = torch.sum(loss) / torch.count_nonzero(sentmasks)
-
-        loss.backward()
-        optimizer.step()
+model.timer = StageTimer(args.instrument, device)
+step_logger = None
+if args.instrument and is_main:
+    step_logger = loggingutil.get_metrics_logger(model_id,
+                                                 metrics_file(model_id, paramstore.root_dir))
+profiler = make_profiler(args.profile_steps, os.path.join('prof_', model_id)) if is_main else None
 
-        batch_loss = loss.item()
-        epoch_loss += batch_loss
-        log_loss += batch_loss
-
-        if log_interval and batch % log_interval == 0 and batch > 0:
-            cur_loss = log_loss / log_interval
-            elapsed = time.time() - start_time
-            print('| epoch {:3d} | {:5d} batches | {:5.2f} ms/batch  | '
-                  'loss {:5.2f} | ppl {:8.2f} |'.format(epoch, batch, elapsed * 1000 / log_interval,
-                                                        cur_loss, math.exp(cur_loss)))
-            log_loss = 0
-            start_time = time.time()
-
-    return epoch_loss / len(dataloader)
-
-
-def f1_score(y_true, y_pred, threshold=0.5):
-    y_pred_lb = y_pred >= threshold
-    return metrics.f1_score(y_true, y_pred_lb)
-
-
-def evaluate(model, dataloader, criterion, params, device='cpu'):
-    model.to(device)
-    criterion.to(device)
-
-    model.eval()
-
-    epoch_loss = 0
-    predss = []
-    labelss = []
-    sentmaskss = []
-    with torch.no_grad():
-        for elems, labels, sentmasks, dfidf, chars, doc_ab in dataloader:
-            elems = elems.to(device)
-            labels = labels.float().view(-1).to(device)
-            sentmasks = sentmasks.view(-1).to(device)
-            doc_ab = doc_ab.to(device)
-            if params['use_idf']:
-                dfidf = dfidf.to(device)
-            if params['use_char']:
-                chars = chars.to(device)
-
-            word_h0 = model.init_hidden(len(elems)).to(device)
-            sent_h0 = model.init_hidden(len(elems)).to(device)
-
-            if params['use_idf'] and params['use_char']:
-                preds, word_h0, sent_h0 = model(elems,
-                                                word_h0,
-                                                sent_h0,
-                                                x_df_idf=dfidf,
-                                                chars=chars,
-                                                doc_ab=doc_ab)
-            elif params['use_char']:
-                preds, word_h0, sent_h0 = model(elems, word_h0, sent_h0, chars=chars, doc_ab=doc_ab)
-            elif params['use_idf']:
-                preds, word_h0, sent_h0 = model(elems,
-                                                word_h0,
-                                                sent_h0,
-                                                x_df_idf=dfidf,
-                                                doc_ab=doc_ab)
-            else:
-                preds, word_h0, sent_h0 = model(elems, word_h0, sent_h0, doc_ab=doc_ab)
-
-            loss = criterion(preds, labels)
-            loss *= sentmasks
-            loss = torch.sum(loss) / torch.count_nonzero(sentmasks)
-
-            epoch_loss += loss.item()
-
-            labelss.append(labels)
-            predss.append(preds)
-            sentmaskss.append(sentmasks)
-
-        labels = torch.cat(labelss).detach().cpu().numpy()
-        preds = torch.sigmoid(torch.cat(predss).detach()).cpu().numpy()
-        sentmasks = torch.cat(sentmaskss).detach().cpu().numpy()
-        labels = labels[np.nonzero(sentmasks)]
-        preds = preds[np.nonzero(sentmasks)]
-
-        f1 = f1_score(labels, preds, 0.05)
-        roc_auc = metrics.roc_auc_score(labels, preds)
-
-    return labels, preds, epoch_loss / len(dataloader), f1, roc_auc
+# gradients are all-reduced across ranks, rank 0 evaluates, checkpoints and decides when to stop
+train_model = model
+if args.distributed:
+    train_model = wrap_ddp(model)
 
+optimizer = make_optimizer(model, lr)
+scheduler = torch.optim.lr_scheduler.StepLR(optimizer, step_size=30, gamma=0.1)
 
 # %%
-dev_roc_highest = 0
 patience = 3
-no_drop_epochs = 0
 n_epochs = 50
-for epoch in range(n_epochs):
+start_epoch = 0
+dev_roc_highest = 0
+best_epoch = None
+no_drop_epochs = 0
+if resume_state is not None:
+    model.load_state_dict(resume_state['model'])
+    optimizer.load_state_dict(resume_state['optimizer'])
+    scheduler.load_state_dict(resume_state['scheduler'])
+    set_rng_state(resume_state['rng'])
+    start_epoch = resume_state['epoch'] + 1
+    dev_roc_highest = resume_state['dev_roc_highest']
+    best_epoch = resume_state.get('best_epoch')
+    no_drop_epochs = resume_state['no_drop_epochs']
+    _logger.info('Resuming {} at epoch {}'.format(model_id, start_epoch))
+    resume_state = None
+
+# writes happen in the background, training only waits for the snapshot copy
+checkpointer = AsyncCheckpointer(checkpoint_dir(model_id), args.keep_ckpts) if is_main else None
+
+for epoch in range(start_epoch, n_epochs):
     if no_drop_epochs >= patience:
         break
     epoch_loss = 0
 
-    epoch_loss = train_one_epoch(epoch, model, dl_train, optimizer, criterion, params, device)
-
-    _, _, dev_loss, dev_f1, dev_roc_auc = evaluate(model, dl_dev, criterion, params, device)
-
-    _logger.info(
-        '| epoch {} | epoch_loss {:.6f} | dev_loss {:.6f} | dev_f1 {:.3f} | dev_roc_auc {:.3f}'.
-        format(epoch, epoch_loss, dev_loss, dev_f1, dev_roc_auc))
-
-    if dev_roc_auc > dev_roc_highest:
-        _logger.info("Saving model {}:{}".format(model_id, epoch))
-        dev_roc_highest = dev_roc_auc
-        torch.save(model.state_dict(), os.path.join('model_', model_id + '.pt'))
+    train_sampler.set_epoch(epoch)
+    epoch_profiler = profiler if epoch == start_epoch else None
+    if epoch_profiler is not None:
+        epoch_profiler.start()
+    start_time = time.time()
+    epoch_loss = train_one_epoch(epoch,
+                                 train_model,
+                                 dl_train,
+                                 optimizer,
+                                 criterion,
+                                 params,
+                                 device,
+                                 amp_dtype=amp_dtype,
+                                 n_prefetch=args.prefetch,
+                                 accum_steps=args.accum_steps,
+                                 step_log=step_logger.info if step_logger else None,
+                                 profiler=epoch_profiler,
+                                 teacher=teacher,
+                                 teacher_params=teacher_params,
+                                 distill_alpha=args.distill_alpha,
+                                 distill_temp=args.distill_temp)
+    train_time = time.time() - start_time
+    if epoch_profiler is not None:
+        epoch_profiler.stop()
+
+    improved = False
+    if is_main:
+        dev_scores, dev_loss, dev_f1, dev_roc_auc = evaluate(model, dl_dev, criterion, params,
+                                                             device, amp_dtype, args.prefetch,
+                                                             args.eval_bins)
+        save_preds(model_id, 'dev', epoch, dev_scores, dev_loss)
+
+        _logger.info(
+            '| epoch {} | epoch_loss {:.6f} | dev_loss {:.6f} | dev_f1 {:.3f} | dev_roc_auc {:.3f}'.
+            format(epoch, epoch_loss, dev_loss, dev_f1, dev_roc_auc))
+        _logger.info(
+            '| epoch {} | train {:.1f}s | {:.1f} docs/sec | world_size {} | effective_batch_size {} '
+            '| lr {:g} |'.format(epoch, train_time,
+                                 len(ds_train) / train_time, world_size, effective_batch_size,
+                                 lr))
+
+        improved = dev_roc_auc > dev_roc_highest
+        if improved:
+            _logger.info("Saving model {}:{}".format(model_id, epoch))
+            dev_roc_highest = dev_roc_auc
+            best_epoch = epoch
+            checkpointer.save_file(model.state_dict(), os.path.join('model_', model_id + '.pt'))
+        prune_preds(model_id, 'dev', {best_epoch, epoch})
+    if args.distributed:
+        improved_list = [improved]
+        dist.broadcast_object_list(improved_list, src=0)
+        improved = improved_list[0]
+
+    if improved:
         no_drop_epochs = 0
     else:
         no_drop_epochs += 1
 
+    if is_main and args.ckpt_every and (epoch + 1) % args.ckpt_every == 0:
+        checkpointer.save(
+            {
+                'model_id': model_id,
+                'epoch': epoch,
+                'model': model.state_dict(),
+                'optimizer': optimizer.state_dict(),
+                'scheduler': scheduler.state_dict(),
+                'rng': get_rng_state(),
+                'dev_roc_highest': dev_roc_highest,
+                'best_epoch': best_epoch,
+                'no_drop_epochs': no_drop_epochs
+            }, epoch)
+
+if checkpointer is not None:
+    checkpointer.close()
+
+if args.distributed:
+    dist.barrier()
+    dist.destroy_process_group()
+    if not is_main:
+        sys.exit(0)
+
 # %%
 # test
 # model_id='spoilernet_5b926d6e'
 
 model.load_state_dict(torch.load(os.path.join('model_', model_id + '.pt')))
 
-dev_label, dev_pred, _, _, _ = evaluate(model, dl_dev, criterion, params, device)
+# dev predictions of the best checkpoint were cached when it was evaluated
+if best_epoch is not None:
+    dev_scores, _ = load_preds(model_id, 'dev', best_epoch)
+else:
+    dev_scores, _, _, _ = evaluate(model, dl_dev, criterion, params, device, amp_dtype,
+                                   args.prefetch, args.eval_bins)
 
 ths = np.arange(0.01, 0.51, 0.01)
-dev_f1s = list(map(lambda th: f1_score(dev_label, dev_pred, th), ths))
-dev_f1s = np.array(dev_f1s)
+_, _, dev_f1s = dev_scores.threshold_sweep(ths)
 max_f1_idx = np.argmax(dev_f1s)
 
-test_label, test_pred, test_loss, test_f1, test_roc_auc = evaluate(model, dl_test, criterion,
-                                                                   params, device)
+test_scores, test_loss, test_f1, test_roc_auc = evaluate(model, dl_test, criterion, params, device,
+                                                         amp_dtype, args.prefetch, args.eval_bins)
+if best_epoch is not None:
+    save_preds(model_id, 'test', best_epoch, test_scores, test_loss)
 
 _logger.info('| test_loss {:.6f} | test_f1 {:.3f} | test_roc_auc {:.3f}'.format(
     test_loss, test_f1, test_roc_auc))
 
-test_f1s = list(map(lambda th: f1_score(test_label, test_pred, th), ths))
-test_f1s = np.array(test_f1s)
+_, _, test_f1s = test_scores.threshold_sweep(ths)
 
 _logger.info('| best_th {:.2f} | best_dev_f1 {:.3f} | best_test_f1 {:.3f} |'.format(
     ths[max_f1_idx], dev_f1s[max_f1_idx], test_f1s[max_f1_idx]))
 
+paramstore.set_metrics(
+    model_id, {
+        'best_epoch': best_epoch,
+        'dev_roc_auc': dev_roc_highest,
+        'test_loss': test_loss,
+        'test_f1': test_f1,
+        'test_roc_auc': test_roc_auc,
+        'best_th': ths[max_f1_idx].item(),
+        'best_dev_f1': dev_f1s[max_f1_idx].item(),
+        'best_test_f1': test_f1s[max_f1_idx].item()
+    })
+
 # %%
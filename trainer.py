@@ -0,0 +1,322 @@
+import contextlib
+import time
+
+import torch
+import torch.distributed as dist
+
+from dataloading import Prefetcher
+from evaluation import StreamingMetrics
+from profiling import peak_rss_mb
+
+
+def autocast(device, amp_dtype=None):
+    '''
+    Mixed-precision context for the model forward pass, a no-op if amp_dtype is None.
+    '''
+    return torch.autocast(torch.device(device).type,
+                          dtype=amp_dtype,
+                          enabled=amp_dtype is not None)
+
+
+def wrap_ddp(model):
+    '''
+    DistributedDataParallel for train_one_epoch. Some parameters get no gradient in a given
+    backward (char_lstm always, the char embedding without use_char, embedding tiers with no id
+    in the batch), so unused parameters are searched for on every backward. static_graph is not
+    an option, it fails on the no_sync backwards of gradient accumulation.
+    '''
+    return torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+
+
+def unwrap(model):
+    return model.module if isinstance(model, torch.nn.parallel.DistributedDataParallel) else model
+
+
+class SparseDenseAdam(torch.optim.Optimizer):
+    '''
+    SparseAdam for the parameters with sparse gradients, Adam for the others. Only the rows
+    of an embedding in the batch get their moments and weights updated.
+    '''
+    def __init__(self, sparse_params, dense_params, lr=1e-3):
+        self.sparse = torch.optim.SparseAdam(sparse_params, lr=lr)
+        self.dense = torch.optim.Adam(dense_params, lr=lr)
+        super().__init__(self.sparse.param_groups + self.dense.param_groups, {'lr': lr})
+        # share the groups, so that lr schedulers reach both optimizers
+        self.param_groups = self.sparse.param_groups + self.dense.param_groups
+
+    @torch.no_grad()
+    def step(self, closure=None):
+        loss = None
+        if closure is not None:
+            with torch.enable_grad():
+                loss = closure()
+        self.sparse.step()
+        self.dense.step()
+        return loss
+
+    def state_dict(self):
+        return {'sparse': self.sparse.state_dict(), 'dense': self.dense.state_dict()}
+
+    def load_state_dict(self, state_dict):
+        self.sparse.load_state_dict(state_dict['sparse'])
+        self.dense.load_state_dict(state_dict['dense'])
+
+
+def make_optimizer(model, lr):
+    '''
+    Adam, or SparseDenseAdam if the model has embeddings with sparse gradients.
+    '''
+    sparse_params = [
+        m.weight for m in unwrap(model).modules() if isinstance(m, torch.nn.Embedding) and m.sparse
+    ]
+    if not sparse_params:
+        return torch.optim.Adam(model.parameters(), lr=lr)
+    sparse_ids = set(map(id, sparse_params))
+    dense_params = [p for p in model.parameters() if id(p) not in sparse_ids]
+    return SparseDenseAdam(sparse_params, dense_params, lr=lr)
+
+
+def optimizer_state_mb(optimizer):
+    '''
+    Size of the moment buffers, those of SparseDenseAdam included.
+    '''
+    optimizers = [optimizer.sparse, optimizer.dense] if isinstance(optimizer,
+                                                                   SparseDenseAdam) else [optimizer]
+    return sum(t.numel() * t.element_size() for opt in optimizers for state in opt.state.values()
+               for t in state.values() if torch.is_tensor(t)) / 2**20
+
+
+def model_forward(model, params, elems, word_h0, sent_h0, dfidf, chars, doc_ab):
+    '''
+    Sentence logits, with the DF-IDF and char inputs the params of the model use.
+    '''
+    kwargs = {'doc_ab': doc_ab}
+    if params['use_idf']:
+        kwargs['x_df_idf'] = dfidf
+    if params['use_char']:
+        kwargs['chars'] = chars
+    preds, _, _ = model(elems, word_h0, sent_h0, **kwargs)
+    return preds
+
+
+def distill_loss(preds, teacher_preds, labels, criterion, alpha=0.5, temp=2.):
+    '''
+    Unreduced criterion on the labels, mixed with alpha of the criterion on the teacher
+    probabilities at temperature temp. The soft term is scaled by temp**2 to keep its gradients
+    on the scale of the hard one.
+    '''
+    soft_labels = torch.sigmoid(teacher_preds / temp)
+    return ((1 - alpha) * criterion(preds, labels) +
+            alpha * temp**2 * criterion(preds / temp, soft_labels))
+
+
+def windows(batches, size):
+    window = []
+    for batch in batches:
+        window.append(batch)
+        if len(window) == size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+def train_one_epoch(epoch,
+                    model,
+                    dataloader,
+                    optimizer,
+                    criterion,
+                    params,
+                    device,
+                    log_interval=1000,
+                    amp_dtype=None,
+                    n_prefetch=2,
+                    accum_steps=1,
+                    step_log=None,
+                    profiler=None,
+                    teacher=None,
+                    teacher_params=None,
+                    distill_alpha=0.5,
+                    distill_temp=2.):
+    '''
+    Each optimizer step accumulates gradients over accum_steps batches, the masked loss is
+    normalized by the number of sentences in the whole window (and across ranks).
+
+    With a teacher model (in eval mode, with its own teacher_params), the loss is distill_loss
+    against the teacher's sentence logits.
+
+    step_log, if given, is called with a record of each optimizer step: data wait and
+    host-to-device copy time, the model timer stages, backward and optimizer time, sentences
+    per second and peak RSS. Enable the model timer for the per-stage times. profiler is
+    stepped after each optimizer step.
+    '''
+    model.to(device)
+    criterion.to(device)
+
+    model.train()
+
+    is_ddp = isinstance(model, torch.nn.parallel.DistributedDataParallel)
+    timer = unwrap(model).timer
+
+    epoch_loss = 0
+    log_loss = 0
+    epoch_data_wait = 0
+    log_data_wait = 0
+    epoch_sents = 0
+    log_sents = 0
+    n_steps = 0
+    epoch_start_time = time.time()
+    start_time = time.time()
+
+    prefetch_params = params
+    if teacher is not None:
+        # move the inputs of either model
+        prefetch_params = dict(params,
+                               use_idf=params['use_idf'] or teacher_params['use_idf'],
+                               use_char=params['use_char'] or teacher_params['use_char'])
+    prefetcher = Prefetcher(dataloader, device, prefetch_params, n_prefetch)
+    h2d_time = 0
+    wait_start = time.perf_counter()
+    for batch, window in enumerate(windows(prefetcher, accum_steps)):
+        data_wait = time.perf_counter() - wait_start
+        epoch_data_wait += data_wait
+        log_data_wait += data_wait
+        step_start = time.perf_counter()
+
+        n_sents = sum(torch.count_nonzero(sentmasks) for _, _, sentmasks, _, _, _ in window)
+        local_sents = n_sents.item()
+        if is_ddp:
+            # DDP averages gradients over ranks, normalize by the global sentence count instead
+            dist.all_reduce(n_sents)
+            n_sents = n_sents / dist.get_world_size()
+
+        optimizer.zero_grad()
+
+        batch_loss = 0
+        for i, (elems, labels, sentmasks, dfidf, chars, doc_ab) in enumerate(window):
+            word_h0 = unwrap(model).init_hidden(len(elems)).to(device)
+            sent_h0 = unwrap(model).init_hidden(len(elems)).to(device)
+
+            # only all-reduce on the last backward of the window
+            sync = model.no_sync() if is_ddp and i < len(window) - 1 else contextlib.nullcontext()
+            with sync:
+                with timer.stage('forward'), autocast(device, amp_dtype):
+                    preds = model_forward(model, params, elems, word_h0, sent_h0, dfidf, chars,
+                                          doc_ab)
+                    if teacher is not None:
+                        teacher_h0 = teacher.init_hidden(len(elems)).to(device)
+                        with torch.no_grad():
+                            teacher_preds = model_forward(teacher, teacher_params, elems,
+                                                          teacher_h0, teacher_h0, dfidf, chars,
+                                                          doc_ab)
+
+                # loss stays in fp32
+                if teacher is None:
+                    loss = criterion(preds.float(), labels)
+                else:
+                    loss = distill_loss(preds.float(), teacher_preds.float(), labels, criterion,
+                                        distill_alpha, distill_temp)
+                loss *= sentmasks
+                loss = torch.sum(loss) / n_sents
+
+                with timer.stage('backward'):
+                    loss.backward()
+            batch_loss += loss.item()
+
+        with timer.stage('optimizer'):
+            optimizer.step()
+
+        n_steps += 1
+        epoch_loss += batch_loss
+        log_loss += batch_loss
+        epoch_sents += local_sents
+        log_sents += local_sents
+
+        if step_log is not None:
+            step_time = time.perf_counter() - step_start
+            record = {
+                'epoch': epoch,
+                'step': batch,
+                'loss': batch_loss,
+                'n_sents': local_sents,
+                'data_wait': data_wait,
+                'h2d': prefetcher.h2d_time - h2d_time,
+                'step_time': step_time,
+                'sents_per_sec': local_sents / (data_wait + step_time),
+                'peak_rss_mb': peak_rss_mb()
+            }
+            h2d_time = prefetcher.h2d_time
+            record.update(timer.pop())
+            step_log(record)
+
+        if profiler is not None:
+            profiler.step()
+
+        if log_interval and batch % log_interval == 0 and batch > 0:
+            cur_loss = log_loss / log_interval
+            elapsed = time.time() - start_time
+            print('| epoch {:3d} | {:5d} steps | {:5.2f} ms/step  | {:5.2f} ms/step data wait | '
+                  '{:8.1f} sents/s | loss {:5.2f} |'.format(epoch, batch,
+                                                            elapsed * 1000 / log_interval,
+                                                            log_data_wait * 1000 / log_interval,
+                                                            log_sents / elapsed, cur_loss))
+            log_loss = 0
+            log_data_wait = 0
+            log_sents = 0
+            start_time = time.time()
+
+        wait_start = time.perf_counter()
+
+    epoch_time = time.time() - epoch_start_time
+    if log_interval:
+        print('| epoch {:3d} | data wait {:.1f}s of {:.1f}s ({:.1%}), {:5.2f} ms/step | '
+              '{:8.1f} sents/s | peak rss {:.0f} MB |'.format(epoch, epoch_data_wait, epoch_time,
+                                                              epoch_data_wait / epoch_time,
+                                                              epoch_data_wait * 1000 /
+                                                              max(1, n_steps),
+                                                              epoch_sents / epoch_time,
+                                                              peak_rss_mb()))
+
+    # an empty loader, e.g. a rank with no shard left, trains nothing at loss 0
+    return epoch_loss / max(1, n_steps)
+
+
+def evaluate(model,
+             dataloader,
+             criterion,
+             params,
+             device='cpu',
+             amp_dtype=None,
+             n_prefetch=2,
+             n_bins=None):
+    '''
+    Returns the StreamingMetrics of the masked sentences, the loss, F1 at 0.05 and ROC-AUC.
+    Predictions are moved to the host batch by batch, see StreamingMetrics for n_bins.
+    '''
+    model.to(device)
+    criterion.to(device)
+
+    model.eval()
+
+    epoch_loss = 0
+    scores = StreamingMetrics(n_bins)
+    with torch.no_grad():
+        for elems, labels, sentmasks, dfidf, chars, doc_ab in Prefetcher(
+                dataloader, device, params, n_prefetch):
+            word_h0 = model.init_hidden(len(elems)).to(device)
+            sent_h0 = model.init_hidden(len(elems)).to(device)
+
+            with autocast(device, amp_dtype):
+                preds = model_forward(model, params, elems, word_h0, sent_h0, dfidf, chars,
+                                      doc_ab)
+            preds = preds.float()
+
+            loss = criterion(preds, labels)
+            loss *= sentmasks
+            loss = torch.sum(loss) / torch.count_nonzero(sentmasks)
+
+            epoch_loss += loss.item()
+
+            scores.update(torch.sigmoid(preds), labels, sentmasks)
+
+    return scores, epoch_loss / max(1, len(dataloader)), scores.f1(0.05), scores.roc_auc()